@@ -75,6 +75,7 @@ geoapp.DataHandler = function (arg) {
             }
             options.maxcount = maxcount;
             options.params.offset = 0;
+            delete options.params.cursor;
             options.params.format = 'list';
             options.data = null;
             options.startTime = new Date().getTime();
@@ -174,7 +175,14 @@ geoapp.DataHandler = function (arg) {
                 options.showTime);
         }
         if (callNext) {
+            /* Sources that return a cursor resume from it, which is faster
+             * than an offset.  Other sources use the offset. */
             options.params.offset += resp.datacount;
+            if (resp.cursor) {
+                options.params.cursor = resp.cursor;
+            } else {
+                delete options.params.cursor;
+            }
         }
         loadfunc.call(this, options, callNext, moreData);
         geoapp.activityLog.logSystem('load_data', 'datahandler', {
@@ -563,6 +571,7 @@ geoapp.dataHandlers.instagram = function (arg) {
         options.params.limit = options.maxcount;
         options.params._id_min = options.data.nextId;
         options.params.offset = 0;
+        delete options.params.cursor;
         delete options.params._id_max;
         if (moreData) {
             options.params.rand1_max = options.data.data[
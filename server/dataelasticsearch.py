@@ -32,9 +32,31 @@ import xml.sax.saxutils
 
 from girder import logger
 
+import datagrid
+
 urllib3.disable_warnings()
 
 
+def searchQuery(fieldName, value):
+    """
+    Convert a search string into an Elasticsearch query.
+
+    :param fieldName: the elasticsearch field name.
+    :param value: the search string.
+    :returns: the query.
+    """
+    return {
+        'simple_query_string': {
+            'fields': [fieldName],
+            'query': value,
+            'default_operator': 'AND',
+            # 'analyzer': 'english',
+            # Only in query_string:
+            # 'allow_leading_wildcard': True,
+        }
+    }
+
+
 class ViaElasticsearch():
 
     epoch = datetime.datetime.utcfromtimestamp(0)
@@ -128,6 +150,78 @@ class ViaElasticsearch():
             self.db = elasticsearch.Elasticsearch(**self.dbparams)
         return self.db
 
+    def densityGrid(self, params={}, latfield='latitude',
+                    lonfield='longitude', grid=None, **kwargs):
+        """
+        Count the documents that match a query in the cells of a spatial grid.
+        Columns are computed with a histogram aggregation on longitude and rows
+        with a range aggregation on latitude, so that web mercator grids are
+        binned exactly.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param latfield: the latitude field used for binning.
+        :param lonfield: the longitude field used for binning.
+        :param grid: a grid description from datagrid.makeGrid.
+        :returns: a dictionary of results in list format.  Each row is the
+                  column, row, and number of documents for a cell.  Empty cells
+                  are omitted.
+        """
+        if self.params.get('format') == 'gnip':
+            # gnip coordinates are stored as arrays, which can't be binned by
+            # latitude and longitude separately.
+            return {'error': 'Grids are not supported for this database.'}
+        db = self.connect()
+        starttime = time.time()
+        lat = self.fieldName.get(latfield, latfield)
+        lon = self.fieldName.get(lonfield, lonfield)
+        filters = self.findBaseFilters()
+        queries = []
+        query = self.findBaseQuery(0, 0)
+        self.findFilters(filters, queries, params, query)
+        filters.append({'range': {lon: {
+            'gte': grid['west'], 'lt': grid['east']}}})
+        filters.append({'range': {lat: {
+            'gt': grid['south'], 'lte': grid['north']}}})
+        self.findApplyFilters(query, filters, queries)
+        edges = datagrid.rowLatitudes(grid)
+        query['aggs'] = {'cols': {
+            'histogram': {
+                'field': lon,
+                'interval': grid['dx'],
+                'offset': grid['left'] % grid['dx'],
+                'min_doc_count': 1,
+            },
+            # Elasticsearch orders range buckets by their lower bound, so
+            # label each range with its row.
+            'aggs': {'rows': {'range': {'field': lat, 'ranges': [
+                {'key': str(row), 'from': edges[row + 1], 'to': edges[row]}
+                for row in xrange(grid['rows'])]}}},
+        }}
+        logger.info('Query: %s', json.dumps(query))
+        try:
+            res = db.search(body=json.dumps(query))
+        except (elasticsearch.ConnectionError,
+                elasticsearch.RequestError) as exc:
+            logger.info('Database error %s', str(exc).strip())
+            return None
+        data = []
+        for colBucket in res['aggregations']['cols']['buckets']:
+            col = int(round((colBucket['key'] - grid['left']) / grid['dx']))
+            for rowBucket in colBucket['rows']['buckets']:
+                if rowBucket['doc_count']:
+                    data.append([col, int(rowBucket['key']),
+                                 rowBucket['doc_count']])
+        fields = ['col', 'row', 'count']
+        result = {
+            'format': 'list',
+            'fields': fields,
+            'columns': {fields[col]: col for col in xrange(len(fields))},
+            'data': data,
+        }
+        logger.info('Query time: %5.3fs, %d cell%s', time.time() - starttime,
+                    len(data), 's' if len(data) != 1 else '')
+        return result
+
     def find(self, params={}, limit=50, offset=0, sort=None, fields=None,
              **kwargs):
         """
@@ -155,30 +249,9 @@ class ViaElasticsearch():
             'fields': fields,
             'columns': columns,
         }
-        filters = []
-        if self.params.get('format') == 'gnip':
-            if self.params.get('georequired', True):
-                if self.params.get('geoapproximate', False):
-                    filters.extend([{'bool': {'should': [
-                        {'exists': {'field': 'geo.coordinates'}},
-                        {'exists': {'field': 'location.geo.coordinates'}},
-                    ]}}])
-                else:
-                    filters.extend([{'exists': {'field': 'geo.coordinates'}}])
-        else:
-            filters.extend([{'exists': {'field': 'location.longitude'}}])
-        if 'filters' in self.params:
-            filters.extend(self.params['filters'])
+        filters = self.findBaseFilters()
         queries = []
-        query = {
-            'size': limit,
-            'from': offset,
-            'query': {}
-        }
-        query['query']['function_score'] = {
-            'random_score': {'seed': 1},
-            'boost_mode': 'replace',
-        }
+        query = self.findBaseQuery(limit, offset)
         query['_source'] = {
             'include': [self.fieldName[field] for field in fields
                         if field in self.fieldName]
@@ -188,14 +261,7 @@ class ViaElasticsearch():
         if not self.realTimeResultsInitialize(params, result, filters):
             return
         self.findFilters(filters, queries, params, query)
-        if len(filters):
-            query['query']['function_score']['filter'] = {
-                'bool': {'must': filters}
-            }
-        if len(queries):
-            query['query']['function_score']['query'] = {
-                'bool': {'must': queries}
-            }
+        self.findApplyFilters(query, filters, queries)
         # The realtime option would be better implemented if the _timestamp
         # mapping is enabled with store: true in Elasticsearch.
         # It would be nice if we could have a 'distinct' clause for
@@ -222,6 +288,63 @@ class ViaElasticsearch():
             's' if len(result['data']) != 1 else '')
         return result
 
+    def findApplyFilters(self, query, filters, queries):
+        """
+        Add filters and queries to the main ES query.
+
+        :param query: the main ES query.  Modified.
+        :param filters: a list of ES filters.
+        :param queries: a list of ES queries.
+        """
+        if len(filters):
+            query['query']['function_score']['filter'] = {
+                'bool': {'must': filters}
+            }
+        if len(queries):
+            query['query']['function_score']['query'] = {
+                'bool': {'must': queries}
+            }
+
+    def findBaseFilters(self):
+        """
+        Get the filters that are applied to every search of this database.
+
+        :returns: a list of ES filters.
+        """
+        filters = []
+        if self.params.get('format') == 'gnip':
+            if self.params.get('georequired', True):
+                if self.params.get('geoapproximate', False):
+                    filters.extend([{'bool': {'should': [
+                        {'exists': {'field': 'geo.coordinates'}},
+                        {'exists': {'field': 'location.geo.coordinates'}},
+                    ]}}])
+                else:
+                    filters.extend([{'exists': {'field': 'geo.coordinates'}}])
+        else:
+            filters.extend([{'exists': {'field': 'location.longitude'}}])
+        if 'filters' in self.params:
+            filters.extend(self.params['filters'])
+        return filters
+
+    def findBaseQuery(self, limit=50, offset=0):
+        """
+        Get the main ES query without any filters.  Results are scored
+        randomly so that they are in a consistent shuffled order.
+
+        :param limit: the number of results to return.
+        :param offset: the offset into the results.
+        :returns: the ES query.
+        """
+        return {
+            'size': limit,
+            'from': offset,
+            'query': {'function_score': {
+                'random_score': {'seed': 1},
+                'boost_mode': 'replace',
+            }},
+        }
+
     def findFilters(self, filters, queries, params, mainQuery):
         """
         Convert rest query parameters into Elasticsearch filters and queries.
@@ -257,16 +380,7 @@ class ViaElasticsearch():
                     # I would expect (for instance "coffee" doesn't match a
                     # string which contains "coffee.").  There are probably
                     # other options that would help.  Hashes are ignored, too.
-                    queries.append({
-                        'simple_query_string': {
-                            'fields': [fieldName],
-                            'query': value,
-                            'default_operator': 'AND',
-                            # 'analyzer': 'english',
-                            # Only in query_string:
-                            # 'allow_leading_wildcard': True,
-                        }
-                    })
+                    queries.append(searchQuery(fieldName, value))
                     # This is improved by having text analysis turned on.  We
                     # need to do more to generate logical processing, as
                     # presently it is a strick and process.
@@ -378,6 +492,70 @@ class ViaElasticsearch():
             data.append([item.get(field, None) for field in fields])
         return data
 
+    def histogram(self, params={}, bin='day', datefield=None, sums=None,
+                  **kwargs):
+        """
+        Count the documents that match a query in date bins using a
+        date_histogram aggregation.  The date field must be mapped as a date
+        in Elasticsearch.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param bin: the bin size.  One of hour, day, week, or month.
+        :param datefield: the date field used for binning.
+        :param sums: an optional list of numeric fields to total in each bin.
+        :returns: a dictionary of results in list format.  Each row is the
+                  start of the bin in epoch milliseconds, the number of
+                  documents in the bin, and then the total of each of the sums
+                  fields.
+        """
+        db = self.connect()
+        starttime = time.time()
+        sums = sums or []
+        filters = self.findBaseFilters()
+        queries = []
+        query = self.findBaseQuery(0, 0)
+        self.findFilters(filters, queries, params, query)
+        self.findApplyFilters(query, filters, queries)
+        histogram = {
+            'field': self.fieldName.get(datefield, datefield),
+            'interval': bin,
+            'min_doc_count': 1,
+        }
+        if bin == 'week':
+            # Elasticsearch weeks start on Monday; the client uses Sunday.
+            histogram['offset'] = '-1d'
+        query['aggs'] = {'histogram': {'date_histogram': histogram}}
+        sumaggs = {}
+        for pos, field in enumerate(sums):
+            if field in self.fieldName or field in self.fieldTable:
+                sumaggs['sum%d' % pos] = {'sum': {
+                    'field': self.fieldName.get(field, field)}}
+        if len(sumaggs):
+            query['aggs']['histogram']['aggs'] = sumaggs
+        logger.info('Query: %s', json.dumps(query))
+        try:
+            res = db.search(body=json.dumps(query))
+        except (elasticsearch.ConnectionError,
+                elasticsearch.RequestError) as exc:
+            logger.info('Database error %s', str(exc).strip())
+            return None
+        fields = ['date', 'count'] + [field + '_sum' for field in sums]
+        result = {
+            'format': 'list',
+            'fields': fields,
+            'columns': {fields[col]: col for col in xrange(len(fields))},
+            'bin': bin,
+            'datefield': datefield,
+            'data': [[bucket['key'], bucket['doc_count']] + [
+                bucket.get('sum%d' % pos, {}).get('value', None)
+                for pos in xrange(len(sums))]
+                for bucket in res['aggregations']['histogram']['buckets']],
+        }
+        logger.info('Query time: %5.3fs, %d bin%s', time.time() - starttime,
+                    len(result['data']), 's' if len(result['data']) != 1
+                    else '')
+        return result
+
     def instagramToData(self, fields, results):
         """
         Convert elasticsearch instagram results into our data list format.
@@ -411,6 +589,16 @@ class ViaElasticsearch():
             data.append([item.get(field, None) for field in fields])
         return data
 
+    def notifyKey(self):
+        """
+        Get a key that identifies the database used by this object.  This is
+        used to signal that new data is available.
+
+        :returns: a hashable key.
+        """
+        return ('elasticsearch', json.dumps(
+            self.dbparams.get('hosts'), sort_keys=True, default=str))
+
     def realTimeResultsFinalize(self, params, result):
         """
         Record the message ids that we have seen related to a realtime data
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains functions to encode query results for sending to the
+# client.
+
+import array
+import base64
+import json
+import struct
+import sys
+
+
+# Number of rows that are encoded and sent as a single chunk when streaming
+# results.
+JSONStreamChunkSize = 1000
+
+
+def convertRows(rows, fromFormat, toFormat, fields):
+    """
+    Convert rows between the list and dict formats without materializing the
+    whole data set.
+
+    :param rows: an iterable of rows.
+    :param fromFormat: 'list' if each row is a list of values in the order of
+                       fields, 'dict' if each row is a dictionary.
+    :param toFormat: 'list' or 'dict' for the output rows.
+    :param fields: the list of fields used to order or name the values.
+    :yields: converted rows.
+    """
+    if fromFormat == 'list' and toFormat != 'list':
+        for row in rows:
+            yield {fields[col]: row[col] for col in xrange(len(row))}
+    elif fromFormat != 'list' and toFormat == 'list':
+        for row in rows:
+            yield [row.get(field, None) for field in fields]
+    else:
+        for row in rows:
+            yield row
+
+
+def jsonDumps(value):
+    """
+    Dump a value to JSON.  We could let Girder convert the results into JSON,
+    but it is marginally faster to dump the JSON ourselves, since we can
+    exclude sorting and reduce whitespace.
+
+    :param value: the value to encode.
+    :returns: a JSON string.
+    """
+    return json.dumps(value, check_circular=False, separators=(',', ':'),
+                      sort_keys=False, default=str)
+
+
+def jsonStream(result, chunkSize=JSONStreamChunkSize):
+    """
+    Encode a result dictionary as JSON, yielding the output in pieces.  The
+    'data' value of the result may be a list or any iterable of rows.  All
+    other keys are sent before the data, so the client starts receiving bytes
+    as soon as the first rows are available.  The 'datacount' key, and any
+    keys that are added to the result while the data is being iterated (for
+    instance, by a backend that only knows some values once it has read all of
+    its rows), are sent after the data.
+
+    :param result: the result dictionary.  'datacount' is set in this
+                   dictionary.
+    :param chunkSize: the number of rows to encode per yielded piece.
+    :yields: JSON strings that concatenate to a single JSON object.
+    """
+    if result.get('data', None) is None:
+        yield jsonDumps(result)
+        return
+    header = {key: value for key, value in result.iteritems()
+              if key not in ('data', 'datacount')}
+    headerJson = jsonDumps(header)
+    yield headerJson[:-1] + (',' if len(header) else '') + '"data":['
+    count = 0
+    chunk = []
+    rows = result['data']
+    try:
+        for row in rows:
+            chunk.append(jsonDumps(row))
+            if len(chunk) >= chunkSize:
+                yield (',' if count else '') + ','.join(chunk)
+                count += len(chunk)
+                chunk = []
+    finally:
+        # If the client disconnects, close the rows now so that a database
+        # cursor behind them is released immediately rather than whenever
+        # the rows are garbage collected.
+        if hasattr(rows, 'close'):
+            rows.close()
+    if len(chunk):
+        yield (',' if count else '') + ','.join(chunk)
+        count += len(chunk)
+    result['datacount'] = count
+    trailer = {key: value for key, value in result.iteritems()
+               if key not in header and key != 'data'}
+    yield '],' + jsonDumps(trailer)[1:]
+
+
+# The binary encoding used in the columnar format for each field table data
+# type.  Javascript doesn't have 64-bit integer typed arrays, so epoch dates in
+# milliseconds and large ids are sent as float64, which is exact for integers
+# of these magnitudes.  Any field that isn't listed is dictionary encoded.
+ColumnarTypes = {
+    'bigint': 'float64',
+    'date': 'float64',
+    'float': 'float64',
+    'int': 'int32',
+}
+
+ColumnarArrayTypes = {
+    'float64': 'd',
+    'int32': 'i',
+}
+
+ColumnarMagic = 'GACF'
+ColumnarInt32Null = -2147483648
+
+
+def columnarEncode(result, fieldTable=None):
+    """
+    Encode a list-format result dictionary as a compact binary payload that
+    can be loaded directly into javascript typed arrays.  The payload is:
+      4 bytes: the ASCII characters GACF.
+      4 bytes: little-endian uint32 length of the JSON header.
+      the JSON header, padded with spaces to a multiple of 8 bytes.
+      one packed little-endian array per field, each padded to a multiple of
+    8 bytes.
+    The JSON header contains all of the non-data keys of the result, with
+    'format' set to 'columnar', plus 'datacount' and 'columnar', which is a
+    list with one entry per field in the order of the 'fields' list.  Each
+    entry has 'field', 'type' (one of float64, int32, or dict), 'offset' (the
+    byte offset of the array from the end of the padded header), and 'length'
+    (the number of elements).  Null float values are NaN.  Null int32 values
+    are -2147483648.  'dict' fields are int32 indices into a 'values' list in
+    their entry, with -1 for null.
+
+    :param result: the result dictionary.  This must be in 'list' format with
+                   a 'fields' list.  The 'data' value may be any iterable.
+                   'datacount' is set in this dictionary.
+    :param fieldTable: an optional ordered dictionary with the field types.
+                       Fields that aren't in the table are dictionary encoded.
+    :yields: binary strings that concatenate to the full payload.
+    """
+    fields = result['fields']
+    columns = []
+    for field in fields:
+        dtype = (fieldTable or {}).get(field, ('text', ))[0]
+        ctype = ColumnarTypes.get(dtype, 'dict')
+        column = {'field': field, 'type': ctype, 'array': array.array(
+            ColumnarArrayTypes.get(ctype, 'i'))}
+        if ctype == 'dict':
+            column['lookup'] = {}
+            column['values'] = []
+        columns.append(column)
+    count = 0
+    for row in result.get('data', None) or []:
+        for col, column in enumerate(columns):
+            columnarAppend(column, row[col])
+        count += 1
+    result['datacount'] = count
+    offset = 0
+    header = {key: value for key, value in result.iteritems()
+              if key != 'data'}
+    header['format'] = 'columnar'
+    header['columnar'] = []
+    for column in columns:
+        if sys.byteorder != 'little':
+            column['array'].byteswap()
+        column['bytes'] = column['array'].tostring()
+        column['array'] = None
+        entry = {
+            'field': column['field'],
+            'type': column['type'],
+            'offset': offset,
+            'length': count,
+        }
+        if column['type'] == 'dict':
+            entry['values'] = column['values']
+        header['columnar'].append(entry)
+        offset += len(column['bytes']) + (-len(column['bytes']) % 8)
+    headerJson = jsonDumps(header)
+    if isinstance(headerJson, unicode):
+        headerJson = headerJson.encode('utf8')
+    headerJson += ' ' * (-len(headerJson) % 8)
+    yield ColumnarMagic + struct.pack('<I', len(headerJson)) + headerJson
+    for column in columns:
+        yield column['bytes'] + '\x00' * (-len(column['bytes']) % 8)
+        column['bytes'] = None
+
+
+def columnarAppend(column, value):
+    """
+    Add a value to a column that is being encoded in the columnar format.
+
+    :param column: the column record.  Modified.
+    :param value: the value to add.
+    """
+    ctype = column['type']
+    if ctype == 'dict':
+        if value is None:
+            column['array'].append(-1)
+            return
+        if value not in column['lookup']:
+            column['lookup'][value] = len(column['values'])
+            column['values'].append(value)
+        column['array'].append(column['lookup'][value])
+    elif ctype == 'int32':
+        try:
+            column['array'].append(int(value))
+        except (TypeError, ValueError, OverflowError):
+            column['array'].append(ColumnarInt32Null)
+    else:
+        try:
+            column['array'].append(float(value))
+        except (TypeError, ValueError):
+            column['array'].append(float('nan'))
+
+
+def encodeResult(result, outputFormat, fields, fieldTable=None):
+    """
+    Convert a result dictionary to the requested format and encode it.
+
+    :param result: the result dictionary.  This is modified.
+    :param outputFormat: 'list', 'dict', or 'columnar'.
+    :param fields: the list of fields that were requested.  This is used if
+                   the result is not already in list format.
+    :param fieldTable: an optional ordered dictionary with the field types.
+    :yields: strings that concatenate to the encoded result.
+    """
+    listFormat = outputFormat in ('list', 'columnar')
+    if listFormat and result.get('format', '') != 'list':
+        result['fields'] = fields
+        result['columns'] = {fields[col]: col for col in xrange(len(fields))}
+        if 'data' in result:
+            result['data'] = convertRows(
+                result['data'], 'dict', 'list', fields)
+        result['format'] = 'list'
+    elif not listFormat and result.get('format', '') == 'list':
+        if 'data' in result:
+            result['data'] = convertRows(
+                result['data'], 'list', 'dict', result['fields'])
+        result['format'] = 'dict'
+        del result['columns']
+    if outputFormat == 'columnar':
+        return columnarEncode(result, fieldTable)
+    return jsonStream(result)
+
+
+def contentType(outputFormat):
+    """
+    Get the content type used for an output format.
+
+    :param outputFormat: 'list', 'dict', or 'columnar'.
+    :returns: the content type.
+    """
+    if outputFormat == 'columnar':
+        return 'application/octet-stream'
+    return 'application/json'
+
+
+def sseEvent(event, data, eventId=None):
+    """
+    Format a Server-Sent Events message.
+
+    :param event: the event type.
+    :param data: a string with the event data.  This must not contain any
+                 newlines, which is always true of our JSON encoding.
+    :param eventId: if not None, the event id.  A client that reconnects sends
+                    the last event id it received.
+    :returns: the formatted message.
+    """
+    lines = ['event: %s' % event]
+    if eventId is not None:
+        lines.append('id: %s' % eventId)
+    lines.append('data: %s' % data)
+    return '\n'.join(lines) + '\n\n'
+
+
+def cursorSort(sort):
+    """
+    Normalize a sort specification so that it can be compared to the sort
+    stored in a cursor.
+
+    :param sort: a list of tuples of the form (key, direction).
+    :returns: a list of [key, direction] lists, where direction is 1 or -1.
+    """
+    return [[str(key), -1 if direction == -1 else 1]
+            for key, direction in (sort or [])]
+
+
+def decodeCursor(cursor):
+    """
+    Decode a cursor token that was returned with a page of results.
+
+    :param cursor: the opaque cursor string.
+    :returns: a dictionary with 'sort', the normalized sort of the query that
+              returned the cursor, and 'values', the values of the sort keys
+              of the last row of that query.
+    """
+    try:
+        value = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor.')
+    if (not isinstance(value, dict) or
+            not isinstance(value.get('sort'), list) or
+            not isinstance(value.get('values'), list) or
+            len(value['sort']) != len(value['values'])):
+        raise ValueError('Invalid cursor.')
+    value['sort'] = cursorSort(value['sort'])
+    return value
+
+
+def cursorValues(cursor, sort):
+    """
+    Get the sort key values to resume a query from a cursor.
+
+    :param cursor: a decoded cursor or None.
+    :param sort: a list of tuples of the form (key, direction) with the sort
+                 that the query will use.
+    :returns: the list of sort key values of the last row that was returned,
+              or None if there is no cursor or it was for a different sort.
+    """
+    if not cursor or not sort or cursor['sort'] != cursorSort(sort):
+        return None
+    return cursor['values']
+
+
+def encodeCursor(sort, values):
+    """
+    Encode a cursor token that can be used to request the rows that follow a
+    particular row.
+
+    :param sort: a list of tuples of the form (key, direction).
+    :param values: the values of the sort keys of the last row.
+    :returns: the opaque cursor string.
+    """
+    return base64.urlsafe_b64encode(jsonDumps({
+        'sort': cursorSort(sort), 'values': values}))
+
+
+def trackCursor(rows, result, sort, keyFunc):
+    """
+    Yield rows, and, after the last row, add a 'cursor' to the result that
+    resumes the query after that row.  If the data is encoded with jsonStream,
+    the cursor is sent after the data.
+
+    :param rows: an iterable of rows.
+    :param result: the result dictionary.  Modified.
+    :param sort: a list of tuples of the form (key, direction) with the sort
+                 that the query used.
+    :param keyFunc: a function that is passed a row and returns the list of
+                    values of its sort keys.
+    :yields: the rows.
+    """
+    last = None
+    for row in rows:
+        last = row
+        yield row
+    if last is None:
+        return
+    values = keyFunc(last)
+    # Only simple values survive a round trip through JSON.
+    if all(isinstance(value, (int, long, float, basestring)) and
+           not isinstance(value, bool) for value in values):
+        result['cursor'] = encodeCursor(sort, values)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains functions for spatial grids used to aggregate data.
+
+import math
+
+
+# The largest latitude that can be shown in web mercator.
+MercatorMaxLatitude = 85.0511287798
+
+# The size in pixels of a web mercator tile.
+TileSize = 256
+
+# Z-order spatial keys interleave this many bits of longitude and latitude.
+# At 20 bits, a cell is about 0.00034 degrees of longitude.  The key must be
+# computed the same way as the zorder_key function in realtimemsg.pg.
+ZOrderBits = 20
+
+# A bounding box is converted to at most this many ranges of Z-order keys.
+ZOrderMaxRanges = 16
+
+
+def makeGrid(x0, y0, x1, y1, cols=None, rows=None, zoom=None, cellSize=1):
+    """
+    Describe a grid of cells covering a bounding box.  The grid is either
+    evenly spaced in latitude and longitude, or, if a zoom level is given,
+    evenly spaced in web mercator pixels at that zoom level.  Column 0 is the
+    west edge and row 0 is the north edge.
+
+    :param x0: the longitude of one corner of the bounding box.
+    :param y0: the latitude of one corner of the bounding box.
+    :param x1: the longitude of the opposite corner of the bounding box.
+    :param y1: the latitude of the opposite corner of the bounding box.
+    :param cols: the number of columns in a latitude and longitude grid.
+    :param rows: the number of rows in a latitude and longitude grid.
+    :param zoom: if not None, use a web mercator grid at this zoom level.
+    :param cellSize: the size of a cell in pixels for a web mercator grid.
+    :returns: a dictionary with west, east, south, and north (the bounding
+              box in degrees), cols, rows, mercator (a boolean), left and dx
+              (the west edge and width of a cell in degrees), top and dy (the
+              north edge and height of a cell, in degrees or, for mercator
+              grids, in projected units; see mercatorY), and, for mercator
+              grids, zoom and cellSize.
+    """
+    grid = {
+        'west': min(x0, x1),
+        'east': max(x0, x1),
+        'south': min(y0, y1),
+        'north': max(y0, y1),
+        'mercator': zoom is not None,
+    }
+    if zoom is not None:
+        grid['south'] = max(grid['south'], -MercatorMaxLatitude)
+        grid['north'] = min(grid['north'], MercatorMaxLatitude)
+        pixels = TileSize * 2 ** zoom
+        grid['zoom'] = zoom
+        grid['cellSize'] = cellSize
+        grid['dx'] = 360.0 * cellSize / pixels
+        grid['dy'] = 2 * math.pi * cellSize / pixels
+        grid['top'] = mercatorY(grid['north'])
+        bottom = mercatorY(grid['south'])
+        # Allow for rounding so that a tile's bounding box is an exact number
+        # of cells.
+        grid['cols'] = max(1, int(math.ceil(
+            (grid['east'] - grid['west']) / grid['dx'] - 1e-6)))
+        grid['rows'] = max(1, int(math.ceil(
+            (grid['top'] - bottom) / grid['dy'] - 1e-6)))
+    else:
+        grid['cols'] = cols
+        grid['rows'] = rows
+        grid['dx'] = float(grid['east'] - grid['west']) / cols
+        grid['dy'] = float(grid['north'] - grid['south']) / rows
+        grid['top'] = grid['north']
+    grid['left'] = grid['west']
+    return grid
+
+
+def mercatorLatitude(y):
+    """
+    Convert a web mercator projected y value to a latitude.
+
+    :param y: the projected value.
+    :returns: the latitude in degrees.
+    """
+    return math.degrees(2 * math.atan(math.exp(y)) - math.pi / 2)
+
+
+def mercatorY(latitude):
+    """
+    Convert a latitude to a web mercator projected y value.  This is in units
+    where the full width of the map is 2 pi.
+
+    :param latitude: the latitude in degrees.
+    :returns: the projected value.
+    """
+    return math.log(math.tan(math.pi / 4 + math.radians(latitude) / 2))
+
+
+def rowLatitudes(grid):
+    """
+    Get the latitudes of the edges between rows of a grid.
+
+    :param grid: a grid from makeGrid.
+    :returns: a list of rows + 1 latitudes from north to south.
+    """
+    edges = []
+    for row in xrange(grid['rows'] + 1):
+        y = grid['top'] - row * grid['dy']
+        edges.append(mercatorLatitude(y) if grid['mercator'] else y)
+    return edges
+
+
+def tileBounds(z, x, y):
+    """
+    Get the bounding box of a web mercator tile.
+
+    :param z: the zoom level of the tile.
+    :param x: the column of the tile, where 0 is at longitude -180.
+    :param y: the row of the tile, where 0 is the northernmost row.
+    :returns: west, south, east, north in degrees.
+    """
+    tiles = 2 ** z
+    west = 360.0 * x / tiles - 180
+    east = 360.0 * (x + 1) / tiles - 180
+    north = mercatorLatitude(math.pi * (1 - 2.0 * y / tiles))
+    south = mercatorLatitude(math.pi * (1 - 2.0 * (y + 1) / tiles))
+    return west, south, east, north
+
+
+def zorderCell(lat, lon):
+    """
+    Get the column and row of the Z-order grid cell that contains a point.
+
+    :param lat: the latitude in degrees.
+    :param lon: the longitude in degrees.
+    :returns: the column and row.
+    """
+    cells = 1 << ZOrderBits
+    x = int(math.floor((lon + 180.0) / 360.0 * cells))
+    y = int(math.floor((lat + 90.0) / 180.0 * cells))
+    return min(max(x, 0), cells - 1), min(max(y, 0), cells - 1)
+
+
+def zorderKey(lat, lon):
+    """
+    Get the Z-order key of a point.  Points that are near each other usually
+    have keys that are near each other, so an index on the key can answer
+    bounding box queries with a few range scans.
+
+    :param lat: the latitude in degrees, or None.
+    :param lon: the longitude in degrees, or None.
+    :returns: the key, or None if the point isn't known.
+    """
+    if lat is None or lon is None:
+        return None
+    x, y = zorderCell(float(lat), float(lon))
+    return zorderSpread(x) | (zorderSpread(y) << 1)
+
+
+def zorderRanges(west, south, east, north, maxRanges=ZOrderMaxRanges):
+    """
+    Get ranges of Z-order keys that include every point in a bounding box.
+    The box is divided like a quadtree until the number of ranges would
+    exceed the maximum, so the ranges can include some points outside of the
+    box.
+
+    :param west: the west edge of the box in degrees.
+    :param south: the south edge of the box in degrees.
+    :param east: the east edge of the box in degrees.
+    :param north: the north edge of the box in degrees.
+    :param maxRanges: the maximum number of ranges to return.
+    :returns: a sorted list of (first key, last key) tuples, both inclusive.
+    """
+    x0, y0 = zorderCell(min(south, north), min(west, east))
+    x1, y1 = zorderCell(max(south, north), max(west, east))
+    ranges = []
+    cells = [(0, 0)]
+    for level in xrange(ZOrderBits + 1):
+        size = 1 << (ZOrderBits - level)
+        partial = []
+        for cx, cy in cells:
+            left, bottom = cx * size, cy * size
+            if (left > x1 or left + size <= x0 or bottom > y1 or
+                    bottom + size <= y0):
+                continue
+            if (left >= x0 and left + size - 1 <= x1 and bottom >= y0 and
+                    bottom + size - 1 <= y1):
+                ranges.append(zorderCellRange(cx, cy, size))
+            else:
+                partial.append((cx, cy))
+        if (level == ZOrderBits or
+                len(ranges) + len(partial) * 4 > maxRanges * 4):
+            ranges.extend(zorderCellRange(cx, cy, size)
+                          for cx, cy in partial)
+            break
+        cells = [(cx * 2 + dx, cy * 2 + dy) for cx, cy in partial
+                 for dy in (0, 1) for dx in (0, 1)]
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    # Join the ranges with the smallest gaps between them until there are
+    # few enough.
+    while len(merged) > maxRanges:
+        pos = min(xrange(len(merged) - 1),
+                  key=lambda idx: merged[idx + 1][0] - merged[idx][1])
+        merged[pos:pos + 2] = [(merged[pos][0], merged[pos + 1][1])]
+    return merged
+
+
+def zorderCellRange(cx, cy, size):
+    """
+    Get the range of Z-order keys of a quadtree cell.
+
+    :param cx: the column of the cell in units of its size.
+    :param cy: the row of the cell in units of its size.
+    :param size: the width of the cell in finest grid cells.  This is a power
+                 of two.
+    :returns: the first and last key in the cell.
+    """
+    first = zorderSpread(cx * size) | (zorderSpread(cy * size) << 1)
+    return first, first + size * size - 1
+
+
+def zorderSpread(value):
+    """
+    Spread the bits of a value so that there is a zero bit between each of
+    them.
+
+    :param value: a non-negative integer of at most 32 bits.
+    :returns: the spread value.
+    """
+    value = (value | (value << 16)) & 0x0000FFFF0000FFFF
+    value = (value | (value << 8)) & 0x00FF00FF00FF00FF
+    value = (value | (value << 4)) & 0x0F0F0F0F0F0F0F0F
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
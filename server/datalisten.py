@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains a dedicated connection per Postgres database that listens
+# for notifications that new data has been ingested, and the functions that
+# ingest processes use to send them.
+
+import json
+import psycopg2
+import psycopg2.extensions
+import select
+import sys
+import threading
+import time
+import urllib2
+
+from girder import logger
+
+
+# Notifications about a table are sent on a channel named with this prefix
+# followed by the table name.
+ListenChannelPrefix = 'geoapp_'
+
+# The maximum duration in seconds that the listener waits for notifications
+# before checking if it has new channels to listen on.
+ListenCheckInterval = 5
+
+# After the listener's connection fails, wait this many seconds before
+# reconnecting, doubling up to the maximum for each successive failure.
+ListenReconnectDelay = 1
+ListenReconnectMaxDelay = 60
+
+Listeners = {}
+ListenersLock = threading.Lock()
+
+
+class PostgresListener():
+
+    def __init__(self, dbparams):
+        """
+        Hold a single connection to a database that listens for ingest
+        notifications and passes them to callbacks.  The connection is made
+        in a background thread when the first channel is added, and is
+        remade if it fails.
+
+        :param dbparams: the parameters passed to psycopg2.connect.
+        """
+        self.dbparams = dbparams
+        self.lock = threading.Lock()
+        self.callbacks = {}
+        self.listening = set()
+        self.connected = False
+        self.thread = None
+        self.counters = {'connects': 0, 'errors': 0, 'notifications': 0}
+
+    def dispatch(self, channel, payload):
+        """
+        Pass a notification to the callbacks of its channel.
+
+        :param channel: the channel of the notification.
+        :param payload: the decoded payload of the notification, or None if
+                        notifications may have been missed.
+        """
+        with self.lock:
+            callbacks = self.callbacks.get(channel, [])[:]
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception('Failed to handle notification on %s' % (
+                    channel, ))
+
+    def listen(self, channel, callback):
+        """
+        Call a function whenever a notification is received on a channel.
+
+        :param channel: the channel name.  See channelName.
+        :param callback: a function that is passed the decoded payload of
+                         each notification.  It is passed None whenever the
+                         listener connects, since notifications could have
+                         been missed while it wasn't connected.
+        """
+        with self.lock:
+            self.callbacks.setdefault(channel, []).append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def listenChannels(self, c):
+        """
+        Start listening on any channels that have been added since the last
+        call.
+
+        :param c: a cursor on the listening connection.
+        :returns: a list of the channels that were added.
+        """
+        with self.lock:
+            added = [channel for channel in self.callbacks
+                     if channel not in self.listening]
+        for channel in added:
+            c.execute('LISTEN "%s"' % channel.replace('"', '""'))
+            self.listening.add(channel)
+        return added
+
+    def receive(self, db, c):
+        """
+        Wait for notifications on a connection and dispatch them until the
+        connection fails.
+
+        :param db: the listening connection.
+        :param c: a cursor on the connection.
+        """
+        while True:
+            for channel in self.listenChannels(c):
+                # We can't know what was ingested before we started listening.
+                self.dispatch(channel, None)
+            self.connected = True
+            if select.select([db], [], [], ListenCheckInterval) == (
+                    [], [], []):
+                continue
+            db.poll()
+            while db.notifies:
+                notify = db.notifies.pop(0)
+                with self.lock:
+                    self.counters['notifications'] += 1
+                try:
+                    payload = json.loads(notify.payload)
+                except ValueError:
+                    payload = None
+                self.dispatch(notify.channel, payload)
+
+    def run(self):
+        """
+        Maintain the listening connection.  This runs in its own thread.
+        """
+        delay = ListenReconnectDelay
+        while True:
+            db = None
+            try:
+                db = psycopg2.connect(**self.dbparams)
+                db.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                self.listening = set()
+                with self.lock:
+                    self.counters['connects'] += 1
+                delay = ListenReconnectDelay
+                self.receive(db, db.cursor())
+            except (psycopg2.Error, select.error) as exc:
+                logger.info('Database listener error %s', str(exc).strip())
+                with self.lock:
+                    self.counters['errors'] += 1
+            self.connected = False
+            if db is not None:
+                try:
+                    db.close()
+                except psycopg2.Error:
+                    pass
+            time.sleep(delay)
+            delay = min(delay * 2, ListenReconnectMaxDelay)
+
+    def stats(self):
+        """
+        Get statistics about the listener.
+
+        :returns: a dictionary of statistics.
+        """
+        with self.lock:
+            stats = self.counters.copy()
+            stats['channels'] = sorted(self.callbacks)
+        stats['connected'] = self.connected
+        return stats
+
+
+def channelName(tableName):
+    """
+    Get the name of the channel used for notifications about a table.
+
+    :param tableName: the name of the table.
+    :returns: the channel name.
+    """
+    return ListenChannelPrefix + tableName
+
+
+def getListener(dbparams):
+    """
+    Get the listener for a database, creating it if necessary.  Access objects
+    that use the same database parameters share a listener.
+
+    :param dbparams: the parameters passed to psycopg2.connect.
+    :returns: the listener.
+    """
+    key = json.dumps(dbparams, sort_keys=True, default=str)
+    with ListenersLock:
+        if key not in Listeners:
+            Listeners[key] = PostgresListener(dbparams)
+        return Listeners[key]
+
+
+def listenerStats():
+    """
+    Get statistics about all of the listeners.
+
+    :returns: a dictionary of statistics for each listener, keyed by a
+              description of the database that doesn't include credentials.
+    """
+    with ListenersLock:
+        listeners = Listeners.values()
+    stats = {}
+    for listener in listeners:
+        name = '%s:%s/%s' % (
+            listener.dbparams.get('host', ''),
+            listener.dbparams.get('port', ''),
+            listener.dbparams.get('database') or 'dsn')
+        stats[name] = listener.stats()
+    return stats
+
+
+def notifyIngested(db, tableName, firstId, lastId):
+    """
+    Tell any listening servers that data has been added to a table.  This
+    commits the connection's transaction, since notifications are only sent
+    when a transaction commits.
+
+    :param db: a database connection.
+    :param tableName: the name of the table.
+    :param firstId: the smallest _id of the added rows.
+    :param lastId: the largest _id of the added rows.
+    """
+    c = db.cursor()
+    c.execute('SELECT pg_notify(%s, %s)', (
+        channelName(tableName),
+        json.dumps({'first': firstId, 'last': lastId})))
+    c.close()
+    db.commit()
+
+
+def notifyServer(url):
+    """
+    Tell a geoapp server that new data has been ingested so that clients
+    waiting for data are updated immediately.  This is for servers that
+    aren't listening for database notifications.  Failures are reported on
+    stderr but are otherwise ignored.
+
+    :param url: the url of the server's notify endpoint, such as
+                http://localhost:8001/api/v1/geoapp/notify?source=rtmsg.  If
+                None, do nothing.
+    """
+    if not url:
+        return
+    try:
+        urllib2.urlopen(urllib2.Request(url, data=''), timeout=10).read()
+    except Exception as exc:
+        sys.stderr.write('Failed to notify %s: %s\n' % (url, exc))
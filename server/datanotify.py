@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains a registry used to signal that new data is available.
+
+import threading
+import time
+
+
+class DataNotifier():
+
+    def __init__(self):
+        """
+        Track a version number for each data key.  Ingesting data increments
+        the version, and requests that are waiting for new data block until
+        the version changes.
+        """
+        self.condition = threading.Condition()
+        self.versions = {}
+        self.notifications = 0
+
+    def notify(self, key):
+        """
+        Signal that new data is available.
+
+        :param key: the data key.  See GeoAppResource.notifyKey.
+        """
+        with self.condition:
+            self.versions[key] = self.versions.get(key, 0) + 1
+            self.notifications += 1
+            self.condition.notify_all()
+
+    def stats(self):
+        """
+        Get statistics about notifications.
+
+        :returns: a dictionary of statistics.
+        """
+        with self.condition:
+            return {'keys': len(self.versions),
+                    'notifications': self.notifications}
+
+    def version(self, key):
+        """
+        Get the current version of a data key.  Get this before querying the
+        data, then pass it to wait.
+
+        :param key: the data key.
+        :returns: the version.
+        """
+        with self.condition:
+            return self.versions.get(key, 0)
+
+    def wait(self, key, version, timeout):
+        """
+        Wait until there is new data or a timeout expires.
+
+        :param key: the data key.
+        :param version: the version of the data key that the caller has
+                        already seen.
+        :param timeout: the maximum duration in seconds to wait.
+        :returns: True if there is new data, False if the timeout expired.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.versions.get(key, 0) == version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+class HighWaterMark():
+
+    def __init__(self):
+        """
+        Track the largest id in a table so that realtime queries don't need
+        to ask the database every time.  Ingest paths advance the mark
+        directly.  Since other processes may also add data, the mark is
+        refreshed from the database when it is older than the caller allows.
+        """
+        self.lock = threading.Lock()
+        self.value = None
+        self.refreshed = 0
+        self.refreshing = False
+        self.expired = False
+        self.counters = {'advances': 0, 'hits': 0, 'refreshes': 0}
+
+    def advance(self, value):
+        """
+        Record that data up to an id exists.
+
+        :param value: the id of newly added data.
+        """
+        with self.lock:
+            if value is not None and (self.value is None or
+                                      value > self.value):
+                self.value = value
+            self.counters['advances'] += 1
+
+    def current(self, maxAge):
+        """
+        Get the current mark.  If it is stale, one caller is asked to refresh
+        it; other callers get the stale value in the meantime.  Until the mark
+        has been read from the database once, every caller is asked to read
+        it.
+
+        :param maxAge: the maximum duration in seconds since the mark was
+                       read from the database.  None to never require a
+                       refresh once the mark is known.
+        :returns: the mark, or None if it isn't known.
+        :returns: True if the caller must read the mark from the database and
+                  call update.
+        """
+        with self.lock:
+            stale = self.refreshed == 0 or self.expired or (
+                maxAge is not None and time.time() - self.refreshed > maxAge)
+            if stale and (not self.refreshing or self.refreshed == 0):
+                self.refreshing = True
+                return self.value, True
+            self.counters['hits'] += 1
+            return self.value, False
+
+    def expire(self):
+        """
+        Require the next caller to read the mark from the database, such as
+        when data may have been added without the mark being advanced.
+        """
+        with self.lock:
+            self.expired = True
+
+    def stats(self):
+        """
+        Get statistics about the mark.
+
+        :returns: a dictionary of statistics.
+        """
+        with self.lock:
+            stats = self.counters.copy()
+            stats['value'] = self.value
+            return stats
+
+    def update(self, value, success=True):
+        """
+        Record the mark read from the database.
+
+        :param value: the largest id in the table.
+        :param success: False if the mark couldn't be read.  The next caller
+                        will try again.
+        """
+        with self.lock:
+            self.refreshing = False
+            if not success:
+                return
+            self.refreshed = time.time()
+            self.expired = False
+            self.counters['refreshes'] += 1
+            if value is not None and (self.value is None or
+                                      value > self.value):
+                self.value = value
+
+
+HighWaterMarks = {}
+HighWaterMarksLock = threading.Lock()
+
+
+def highWaterMark(key):
+    """
+    Get the high-water mark for a data key, creating it if necessary.
+
+    :param key: the data key.  See GeoAppResource.notifyKey.
+    :returns: a HighWaterMark object.
+    """
+    with HighWaterMarksLock:
+        if key not in HighWaterMarks:
+            HighWaterMarks[key] = HighWaterMark()
+        return HighWaterMarks[key]
+
+
+def highWaterMarkStats():
+    """
+    Get statistics about all of the high-water marks.  The keys are Postgres
+    notify keys without the dsn, since it may contain credentials.
+
+    :returns: a list of statistics dictionaries.
+    """
+    with HighWaterMarksLock:
+        marks = HighWaterMarks.items()
+    return [dict(mark.stats(), key=key[:4] + key[5:]) for key, mark in marks]
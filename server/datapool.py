@@ -0,0 +1,734 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains a bounded pool of Postgres connections that is shared by
+# every access object that uses the same database.
+
+import collections
+import json
+import psycopg2
+import psycopg2.extensions
+import random
+import threading
+import time
+
+from girder import logger
+
+
+# The maximum number of connections to each distinct database.  Should be less
+# than 90% of available connections to postgres based on its config between
+# all instances of the app that are running.  10 is conservative for two
+# databases with a few variations of the app hitting the same databases.
+PostgresPoolSize = 10
+
+# The maximum duration in seconds to wait for a connection when all of them
+# are in use.
+PostgresPoolWaitTimeout = 30
+
+# Connections that have been idle for longer than this many seconds are
+# checked with a trivial query before they are handed out.
+PostgresPoolCheckTime = 30
+
+# Idle connections are closed after this many seconds.  Connections that have
+# been checked out without any activity for longer than the abandon time plus
+# their statement timeout are assumed to belong to a request that will never
+# return them and are closed.  Readers of long results mark activity with
+# touch.
+PostgresPoolIdleTime = 300
+PostgresPoolAbandonTime = PostgresPoolIdleTime * 5
+
+# The interval in seconds at which the shared reaper thread runs.
+PostgresPoolReapInterval = 30
+
+# Client ids of the partitions of a parallel find are the owning client id
+# followed by this separator and the partition number.
+PartitionClientSeparator = '/part'
+
+# A replica whose connections fail is not used for this many seconds.
+PostgresReplicaEjectTime = 30
+
+Pools = {}
+PoolsLock = threading.Lock()
+Routers = {}
+ReaperThread = None
+
+
+class PoolTimeoutError(psycopg2.OperationalError):
+    """
+    All connections to a database were in use for longer than the pool's wait
+    timeout.  This is a psycopg2 error so that existing database error
+    handling applies to it.
+    """
+    pass
+
+
+class PostgresPool():
+
+    def __init__(self, dbparams, maxSize=PostgresPoolSize,
+                 waitTimeout=PostgresPoolWaitTimeout,
+                 idleTime=PostgresPoolIdleTime,
+                 abandonTime=PostgresPoolAbandonTime):
+        """
+        A pool of connections to one database with a hard maximum size.  When
+        every connection is in use, callers wait in the order they asked for
+        a connection.
+
+        :param dbparams: the parameters passed to psycopg2.connect.
+        :param maxSize: the maximum number of connections.
+        :param waitTimeout: the maximum duration in seconds to wait for a
+                            connection.
+        :param idleTime: the duration in seconds after which an unused
+                         connection is closed.
+        :param abandonTime: the duration in seconds after which a connection
+                            that hasn't been returned or touched is closed.
+                            Its statement timeout is added to this.
+        """
+        self.dbparams = dbparams
+        self.maxSize = maxSize
+        self.waitTimeout = waitTimeout
+        self.idleTime = idleTime
+        self.abandonTime = abandonTime
+        self.condition = threading.Condition(threading.RLock())
+        # Each entry is a dictionary with db (None while the connection is
+        # being opened), used, client, and time (of the last checkout,
+        # checkin, or touch).
+        self.entries = []
+        self.waiters = collections.deque()
+        self.counters = {
+            'checkouts': 0,
+            'waits': 0,
+            'waitTime': 0.0,
+            'maxWaitTime': 0.0,
+            'timeouts': 0,
+            'opened': 0,
+            'closed': 0,
+            'failedChecks': 0,
+        }
+
+    def cancel(self, client):
+        """
+        Cancel any query that is running for a client.  The connection is
+        returned to the pool when the query's owner checks it in.
+
+        :param client: the client whose queries should be cancelled.  This
+                       includes the partitions of the client's parallel
+                       queries.
+        """
+        if not client:
+            return
+        with self.condition:
+            for entry in self.entries:
+                if entry['db'] and clientOwns(client, entry['client']):
+                    entry['db'].cancel()
+
+    def checkin(self, db, client=None):
+        """
+        Return a connection to the pool.
+
+        :param db: the connection.
+        :param client: the client that used the connection.
+        """
+        with self.condition:
+            entry = self.findEntry(db)
+            if entry is None:
+                # The connection was closed by the reaper or was never part of
+                # the pool.
+                self.close(db)
+                return
+            if db.closed:
+                self.remove(entry)
+            else:
+                if (db.get_transaction_status() ==
+                        psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+                    # A cancelled or failed query leaves the transaction
+                    # aborted, so there is nothing to lose by rolling it back.
+                    try:
+                        db.rollback()
+                    except psycopg2.Error:
+                        self.remove(entry)
+                        self.condition.notify_all()
+                        return
+                entry['used'] = False
+                entry['client'] = None
+                entry['time'] = entry['checked'] = time.time()
+            self.condition.notify_all()
+
+    def checkout(self, client=None, reconnect=False, primary=False):
+        """
+        Get a connection from the pool, waiting if they are all in use.
+
+        :param client: if specified, cancel the client's existing queries and
+                       mark the connection as belonging to the client.  The
+                       cancelled queries' connections are returned to the pool
+                       by their owners.
+        :param reconnect: if True, don't use an idle connection; return a new
+                          connection, closing an idle connection if needed to
+                          make room.
+        :param primary: ignored, since a pool only has one database.  See
+                        ReplicaRouter.
+        :returns: a database connection.
+        """
+        if client:
+            self.cancel(client)
+        with self.condition:
+            entry = self.reserve(reconnect)
+            entry['client'] = client
+        db = entry['db']
+        if db is not None and self.needsCheck(entry):
+            db = self.check(entry)
+        if db is None:
+            db = self.open(entry)
+        return db
+
+    def check(self, entry):
+        """
+        Check if an idle connection still works.  If not, it is closed.
+
+        :param entry: the pool entry of the connection.  This has already been
+                      marked as in use.
+        :returns: the connection, or None if it didn't work.
+        """
+        db = entry['db']
+        try:
+            c = db.cursor()
+            c.execute('SELECT 1')
+            c.close()
+            entry['checked'] = time.time()
+            return db
+        except psycopg2.Error:
+            with self.condition:
+                self.counters['failedChecks'] += 1
+                self.close(db)
+                entry['db'] = None
+            return None
+
+    def close(self, db):
+        """
+        Close a connection, ignoring errors.
+
+        :param db: the connection.
+        """
+        try:
+            if not db.closed:
+                db.close()
+        except psycopg2.Error:
+            pass
+        with self.condition:
+            self.counters['closed'] += 1
+
+    def findEntry(self, db):
+        """
+        Find the pool entry for a connection.
+
+        :param db: the connection.
+        :returns: the entry or None.
+        """
+        for entry in self.entries:
+            if entry['db'] is db:
+                return entry
+        return None
+
+    def needsCheck(self, entry):
+        """
+        Check if a connection should be tested before it is used.
+
+        :param entry: the pool entry of the connection.
+        :returns: True if the connection should be tested.
+        """
+        return (entry['db'].closed or
+                time.time() - entry['checked'] > PostgresPoolCheckTime)
+
+    def open(self, entry):
+        """
+        Open a new connection for a pool entry that has been reserved.
+
+        :param entry: the pool entry.
+        :returns: the connection.
+        """
+        try:
+            db = psycopg2.connect(**self.dbparams)
+        except psycopg2.Error:
+            with self.condition:
+                self.entries.remove(entry)
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            entry['db'] = db
+            entry['checked'] = time.time()
+            entry['prepared'] = {}
+            entry['timeout'] = None
+            self.counters['opened'] += 1
+        return db
+
+    def outstanding(self):
+        """
+        Get the number of requests that are using or waiting for a
+        connection.
+
+        :returns: the number of requests.
+        """
+        with self.condition:
+            return len([entry for entry in self.entries
+                        if entry['used']]) + len(self.waiters)
+
+    def owns(self, db):
+        """
+        Check if a connection belongs to the pool.
+
+        :param db: the connection.
+        :returns: True if the connection is part of the pool.
+        """
+        with self.condition:
+            return self.findEntry(db) is not None
+
+    def preparedStatements(self, db):
+        """
+        Get the record of the statements that have been prepared on a
+        connection.  The record is discarded when the connection is closed.
+
+        :param db: the connection.
+        :returns: a dictionary that the caller may modify, or None if the
+                  connection isn't part of the pool.
+        """
+        with self.condition:
+            entry = self.findEntry(db)
+            if entry is None:
+                return None
+            return entry.setdefault('prepared', {})
+
+    def reap(self):
+        """
+        Close connections that have been idle too long and connections that
+        appear to have been abandoned.  The connections are taken out of the
+        pool with the lock held but closed after it is released, since closing
+        a connection waits for any statement that is running on it.
+        """
+        curtime = time.time()
+        reaped = []
+        with self.condition:
+            for entry in self.entries[:]:
+                if not entry['db']:
+                    continue
+                delta = curtime - entry['time']
+                # A statement can run this long before its owner touches the
+                # connection.
+                abandonTime = self.abandonTime + (
+                    entry.get('timeout') or 0) / 1000.0
+                if ((not entry['used'] and delta > self.idleTime) or
+                        delta > abandonTime):
+                    self.entries.remove(entry)
+                    reaped.append(entry)
+            self.condition.notify_all()
+        for entry in reaped:
+            if entry['used']:
+                logger.info('Closing abandoned database connection')
+                # Stop any running statement so that close doesn't wait for
+                # it.
+                try:
+                    entry['db'].cancel()
+                except psycopg2.Error:
+                    pass
+            self.close(entry['db'])
+
+    def remove(self, entry):
+        """
+        Remove an entry from the pool and close its connection.
+
+        :param entry: the pool entry.
+        """
+        with self.condition:
+            if entry in self.entries:
+                self.entries.remove(entry)
+        if entry['db']:
+            self.close(entry['db'])
+
+    def reserve(self, reconnect=False):
+        """
+        Wait for an idle connection or room for a new connection and reserve
+        it.  Callers are served in the order that they asked.  This must be
+        called with the condition held.
+
+        :param reconnect: if True, never use an idle connection; close one if
+                          needed to make room for a new connection.
+        :returns: the reserved pool entry.  If its db is None, the caller must
+                  open the connection.
+        """
+        starttime = time.time()
+        ticket = object()
+        self.waiters.append(ticket)
+        waited = False
+        try:
+            while True:
+                if self.waiters[0] is ticket:
+                    entry = self.reserveEntry(reconnect)
+                    if entry is not None:
+                        break
+                remaining = starttime + self.waitTimeout - time.time()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        'Timed out waiting for a database connection')
+                waited = True
+                self.condition.wait(remaining)
+        finally:
+            self.waiters.remove(ticket)
+            self.condition.notify_all()
+        waitTime = time.time() - starttime
+        self.counters['checkouts'] += 1
+        if waited:
+            self.counters['waits'] += 1
+            self.counters['waitTime'] += waitTime
+            self.counters['maxWaitTime'] = max(
+                self.counters['maxWaitTime'], waitTime)
+        entry['used'] = True
+        entry['time'] = time.time()
+        return entry
+
+    def reserveEntry(self, reconnect=False):
+        """
+        Get an idle connection or add an entry for a new connection if the
+        pool isn't full.  This must be called with the condition held.
+
+        :param reconnect: if True, never use an idle connection.
+        :returns: a pool entry or None if there is no room.
+        """
+        idle = [entry for entry in self.entries
+                if not entry['used'] and entry['db']]
+        if idle and not reconnect:
+            return idle[0]
+        if len(self.entries) >= self.maxSize:
+            if not idle:
+                return None
+            self.remove(idle[0])
+        entry = {'db': None, 'used': True, 'client': None,
+                 'time': time.time(), 'checked': time.time()}
+        self.entries.append(entry)
+        return entry
+
+    def statementTimeout(self, db, timeout):
+        """
+        Set the statement timeout of a connection unless it is already set to
+        that value.  The setting is committed immediately, so it outlasts any
+        later rollback.
+
+        :param db: the connection.
+        :param timeout: the timeout in milliseconds, or 0 for no timeout.
+        """
+        with self.condition:
+            entry = self.findEntry(db)
+            if entry is not None and entry.get('timeout') == timeout:
+                return
+        c = db.cursor()
+        c.execute('SET statement_timeout = %d' % timeout)
+        c.close()
+        db.commit()
+        with self.condition:
+            if entry is not None:
+                entry['timeout'] = timeout
+
+    def touch(self, db):
+        """
+        Record that a checked out connection is still in use, such as while
+        reading a long result, so that it isn't treated as abandoned.
+
+        :param db: the connection.
+        """
+        with self.condition:
+            entry = self.findEntry(db)
+            if entry is not None and entry['used']:
+                entry['time'] = time.time()
+
+    def stats(self):
+        """
+        Get statistics about the pool.
+
+        :returns: a dictionary of statistics.
+        """
+        with self.condition:
+            stats = self.counters.copy()
+            stats.update({
+                'maxSize': self.maxSize,
+                'inUse': len([entry for entry in self.entries
+                              if entry['used']]),
+                'idle': len([entry for entry in self.entries
+                             if not entry['used']]),
+                'waiters': len(self.waiters),
+            })
+            return stats
+
+
+class ReplicaRouter():
+
+    def __init__(self, primary, replicas):
+        """
+        Spread connections across the pools of streaming replicas of a
+        database, picking the replica with the fewest outstanding requests.
+        Queries that need the newest data use the primary database, as do all
+        queries when no replica is available.  A replica whose connections
+        fail is ejected for a while.  This has the same interface as a pool.
+
+        :param primary: the pool of the primary database.
+        :param replicas: a list of the pools of the replicas.
+        """
+        self.primary = primary
+        self.replicas = replicas
+        self.maxSize = sum(pool.maxSize for pool in replicas)
+        self.lock = threading.Lock()
+        # The time until which each ejected replica pool isn't used.
+        self.ejected = {}
+        self.counters = {'primary': 0, 'replica': 0, 'ejections': 0}
+
+    def candidates(self, primary=False):
+        """
+        Get the pools to try for a connection in order of preference.
+
+        :param primary: True to only use the primary database.
+        :returns: a list of pools.
+        """
+        if primary:
+            return [self.primary]
+        now = time.time()
+        with self.lock:
+            replicas = [pool for pool in self.replicas
+                        if self.ejected.get(pool, 0) <= now]
+        # Ties are broken randomly so that idle replicas share the load.
+        replicas.sort(key=lambda pool: (pool.outstanding(), random.random()))
+        return replicas + [self.primary]
+
+    def cancel(self, client):
+        """
+        Cancel any query that is running for a client on any database.
+
+        :param client: the client whose queries should be cancelled.
+        """
+        for pool in [self.primary] + self.replicas:
+            pool.cancel(client)
+
+    def checkin(self, db, client=None):
+        """
+        Return a connection to its pool.  If the connection to a replica was
+        lost, the replica is ejected.
+
+        :param db: the connection.
+        :param client: the client that used the connection.
+        """
+        pool = self.poolOf(db)
+        if db.closed and pool is not self.primary:
+            self.eject(pool)
+        pool.checkin(db, client)
+
+    def checkout(self, client=None, reconnect=False, primary=False):
+        """
+        Get a connection from the least busy available database.
+
+        :param client: if specified, cancel the client's existing queries and
+                       mark the connection as belonging to the client.
+        :param reconnect: if True, return a new connection.
+        :param primary: if True, use the primary database, such as for
+                        queries that must see the newest data.
+        :returns: a database connection.
+        """
+        if client:
+            self.cancel(client)
+        for pool in self.candidates(primary):
+            try:
+                db = pool.checkout(client, reconnect)
+            except PoolTimeoutError:
+                raise
+            except psycopg2.OperationalError:
+                if pool is self.primary:
+                    raise
+                self.eject(pool)
+                continue
+            with self.lock:
+                self.counters[
+                    'primary' if pool is self.primary else 'replica'] += 1
+            return db
+
+    def eject(self, pool):
+        """
+        Stop using a replica for a while.
+
+        :param pool: the pool of the replica.
+        """
+        logger.info('Ejecting database replica %s for %ds', poolName(pool),
+                    PostgresReplicaEjectTime)
+        with self.lock:
+            self.ejected[pool] = time.time() + PostgresReplicaEjectTime
+            self.counters['ejections'] += 1
+
+    def poolOf(self, db):
+        """
+        Get the pool that a connection belongs to.
+
+        :param db: the connection.
+        :returns: the pool.  Connections that aren't part of any pool are
+                  attributed to the primary, which closes them on checkin.
+        """
+        for pool in self.replicas:
+            if pool.owns(db):
+                return pool
+        return self.primary
+
+    def preparedStatements(self, db):
+        """
+        Get the record of the statements prepared on a connection.  See
+        PostgresPool.preparedStatements.
+
+        :param db: the connection.
+        :returns: a dictionary or None.
+        """
+        return self.poolOf(db).preparedStatements(db)
+
+    def statementTimeout(self, db, timeout):
+        """
+        Set the statement timeout of a connection.  See
+        PostgresPool.statementTimeout.
+
+        :param db: the connection.
+        :param timeout: the timeout in milliseconds, or 0 for no timeout.
+        """
+        self.poolOf(db).statementTimeout(db, timeout)
+
+    def stats(self):
+        """
+        Get statistics about the router.  The pools report their own
+        statistics.
+
+        :returns: a dictionary of statistics.
+        """
+        now = time.time()
+        with self.lock:
+            stats = self.counters.copy()
+            stats['ejected'] = sorted([
+                poolName(pool) for pool, until in self.ejected.items()
+                if until > now])
+        stats['replicas'] = [poolName(pool) for pool in self.replicas]
+        return stats
+
+    def touch(self, db):
+        """
+        Record that a connection is still in use.  See PostgresPool.touch.
+
+        :param db: the connection.
+        """
+        self.poolOf(db).touch(db)
+
+
+def clientOwns(client, entryClient):
+    """
+    Check if a pool entry's client belongs to a client, either because it is
+    the same client or because it is a partition of one of the client's
+    parallel queries.
+
+    :param client: the client id.
+    :param entryClient: the client id of a pool entry.
+    :returns: True if the entry belongs to the client.
+    """
+    return bool(entryClient) and (entryClient == client or (
+        entryClient.startswith(client + PartitionClientSeparator)))
+
+
+def getPool(dbparams):
+    """
+    Get the connection pool for a database, creating it if necessary.  Access
+    objects that use the same database parameters share a pool.
+
+    :param dbparams: the parameters passed to psycopg2.connect.
+    :returns: the pool.
+    """
+    global ReaperThread
+
+    key = json.dumps(dbparams, sort_keys=True, default=str)
+    with PoolsLock:
+        if key not in Pools:
+            Pools[key] = PostgresPool(dbparams)
+        if ReaperThread is None:
+            ReaperThread = threading.Thread(target=reapPools)
+            ReaperThread.daemon = True
+            ReaperThread.start()
+        return Pools[key]
+
+
+def getRouter(dbparams, replicas):
+    """
+    Get the replica router for a database, creating it if necessary.  Access
+    objects that use the same database and replicas share a router.
+
+    :param dbparams: the parameters passed to psycopg2.connect for the
+                     primary database.
+    :param replicas: a list of the parameters for each replica.
+    :returns: the router.
+    """
+    key = json.dumps([dbparams, replicas], sort_keys=True, default=str)
+    primary = getPool(dbparams)
+    replicaPools = [getPool(params) for params in replicas]
+    with PoolsLock:
+        if key not in Routers:
+            Routers[key] = ReplicaRouter(primary, replicaPools)
+        return Routers[key]
+
+
+def poolName(pool):
+    """
+    Describe the database of a pool without including credentials.
+
+    :param pool: the pool.
+    :returns: a string with the host, port, and database.
+    """
+    return '%s:%s/%s' % (
+        pool.dbparams.get('host', ''), pool.dbparams.get('port', ''),
+        pool.dbparams.get('database') or 'dsn')
+
+
+def poolStats():
+    """
+    Get statistics about all of the connection pools.
+
+    :returns: a dictionary of statistics for each pool, keyed by a
+              description of the database that doesn't include credentials.
+    """
+    with PoolsLock:
+        pools = Pools.values()
+    return {poolName(pool): pool.stats() for pool in pools}
+
+
+def reapPools():
+    """
+    Periodically close idle and abandoned connections in all pools.  This is
+    run in a single thread for the whole process.
+    """
+    while True:
+        time.sleep(PostgresPoolReapInterval)
+        with PoolsLock:
+            pools = Pools.values()
+        for pool in pools:
+            pool.reap()
+
+
+def routerStats():
+    """
+    Get statistics about all of the replica routers.
+
+    :returns: a dictionary of statistics for each router, keyed by a
+              description of its primary database.
+    """
+    with PoolsLock:
+        routers = Routers.values()
+    return {poolName(router.primary): router.stats() for router in routers}
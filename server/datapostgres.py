@@ -23,22 +23,105 @@ import calendar
 import cherrypy
 import datetime
 import dateutil.parser
+import itertools
 import psycopg2
 import psycopg2.errorcodes
+import Queue
 import re
 import time
 import threading
 
 from girder import logger
 
+import dataencode
+import datagrid
+import datalisten
+import datanotify
+import datapool
+import datarollup
 import geoapp
+import querycache
 
 
-# Per distinct database.  Should be less than 90% of available connections to
-# postgres based on its config between all instances of the app that are
-# running.  10 is conservative for two databases with a few variations of the
-# app hitting the same databases.
-PostgresPoolSize = 10
+# Number of rows to fetch from a database cursor at a time.  A source's
+# "itersize" configuration value overrides this.
+PostgresFetchSize = 10000
+
+# Queries with a limit of at least this many rows (or no limit) use a named
+# server-side cursor, so that rows are transferred from the database in
+# batches as they are sent to the client rather than all being buffered in
+# this process first.
+PostgresServerCursorRows = 50000
+
+# Used to generate unique names for server-side cursors.
+ServerCursorCounter = itertools.count(1)
+
+# The maximum number of prepared statements kept on each connection.  When
+# there are more, all of them are deallocated.
+PostgresPreparedMax = 100
+
+# Used to generate unique names for prepared statements.
+PreparedCounter = itertools.count(1)
+
+# Exports are sent in chunks of about this many bytes, and at most this many
+# chunks are buffered while waiting for the client to read them.
+PostgresExportChunkSize = 65536
+PostgresExportQueueSize = 16
+
+# The maximum number of concurrent queries used for one parallel find, and
+# the smallest limit for which a find is run in parallel.  A limit of 0 (no
+# limit) is always large enough.
+PostgresParallelMax = 8
+PostgresParallelMinRows = 50000
+# Each partition of a parallel find passes its rows to the reader in batches
+# of this many rows through a queue of at most this many batches, so a
+# partition only reads ahead of the reader by a bounded amount.
+PostgresParallelBatchRows = 1000
+PostgresParallelQueueSize = 8
+
+# The largest _id of a table is tracked in process.  It is read from the
+# database again if it is older than this many seconds when a realtime query
+# needs it; this can be changed per source with 'hwmmaxage'.  The maximum id
+# reported with instagram and taxi results is allowed to be much older.
+PostgresHighWaterMaxAge = 5
+PostgresMaxIdMaxAge = 300
+# While a listener is connected, ingest notifications keep the mark current,
+# so it is trusted this many times as long.  It is still read occasionally in
+# case data is added by a writer that doesn't send notifications.
+PostgresHighWaterListenFactor = 10
+
+# Search fields can have a stored tsvector column with this suffix, kept up
+# to date by a trigger and indexed with GIN.  Searches use it when it exists.
+PostgresSearchVectorSuffix = '_tsv'
+
+# A table can be split into monthly child tables (see utils/pgpartition.py).
+# The list of children is read from the database again after this many
+# seconds so that newly attached months are used.
+PostgresPartitionCheckTime = 300
+
+# The default statement timeout in seconds for queries, or 0 for none.  A
+# source's "timeout" configuration value overrides this, either for all of its
+# queries or per access method (such as find or histogram).
+PostgresStatementTimeout = 0
+
+
+def errorCode(exc):
+    """
+    Get the name of the error code of a database error.  A query that was
+    cancelled because it exceeded the statement timeout is reported as
+    STATEMENT_TIMEOUT rather than QUERY_CANCELED, which is otherwise used for
+    both.
+
+    :param exc: a psycopg2 exception.
+    :returns: the name of the error code.
+    """
+    try:
+        code = psycopg2.errorcodes.lookup(exc.pgcode)
+    except KeyError:
+        code = '%s' % exc.pgcode
+    if code == 'QUERY_CANCELED' and 'statement timeout' in str(exc):
+        code = 'STATEMENT_TIMEOUT'
+    return code
 
 
 def insertItemIntoPostgres(db, c, item, nodup=True):
@@ -50,7 +133,8 @@ def insertItemIntoPostgres(db, c, item, nodup=True):
     :param item: a dictionary of fields for the item.
     :param nodup: if True, make some effort to avoid duplciates.  This relies
                   on distinct msg_id values.
-    :return: True if the data was ingested, false otherwise.
+    :return: the _id of the new record if the data was ingested, False
+             otherwise.
     """
     if not item.get('msg_id', None):
         return False
@@ -77,10 +161,59 @@ def insertItemIntoPostgres(db, c, item, nodup=True):
     sql.extend(','.join(sqlkeys))
     sql.append(') VALUES (')
     sql.extend(','.join(sqlvals))
-    sql.append(')')
+    sql.append(') RETURNING _id')
     c.execute(''.join(sql), tuple(sqldata))
+    row = c.fetchone()
+    if row is None:
+        # If the table is partitioned by month, the row was routed to a child
+        # table and nothing is returned, but the _id still came from the
+        # sequence in this session.
+        c.execute("SELECT currval(pg_get_serial_sequence('messages', '_id'))")
+        row = c.fetchone()
+    newId = row[0]
+    rollupItemInPostgres(c, datarollup.MessagesRollup, item)
     db.commit()
-    return True
+    return newId
+
+
+def rollupItemInPostgres(c, rollup, item):
+    """
+    Add an item to a rollup table as part of the current transaction.  If the
+    rollup table doesn't exist, the item is not counted.
+
+    :param c: the database cursor.
+    :param rollup: the rollup description.  See datarollup.
+    :param item: a dictionary of fields for the item.
+    """
+    row = datarollup.rollupRow(rollup, item)
+    if row is None:
+        return
+    sql = datarollup.rollupMergeSql(rollup, datarollup.rollupValues(rollup))
+    c.execute('SAVEPOINT geoapp_rollup')
+    try:
+        try:
+            c.execute(sql, row)
+        except psycopg2.IntegrityError:
+            # Another transaction added the same rollup row first; now it
+            # can be updated.
+            c.execute('ROLLBACK TO SAVEPOINT geoapp_rollup')
+            c.execute(sql, row)
+    except psycopg2.ProgrammingError:
+        c.execute('ROLLBACK TO SAVEPOINT geoapp_rollup')
+    c.execute('RELEASE SAVEPOINT geoapp_rollup')
+
+
+def dollarParameters(sql):
+    """
+    Convert a query with psycopg2 %s placeholders to one with numbered $n
+    parameters, as used by PREPARE.
+
+    :param sql: the query.  Literal percent signs are written as %%.
+    :returns: the converted query.
+    """
+    counter = itertools.count(1)
+    return re.sub('%([%s])', lambda match: '%' if match.group(1) == '%' else
+                  '$%d' % next(counter), sql)
 
 
 def tsqueryAddToList(itemList, addArray):
@@ -187,12 +320,16 @@ def tsqueryParse(parts, quotes={}, tsq=None, depth=0):
     return curtsq, consume + reduced, include, exclude
 
 
-def tsqueryExact(sql, phrases, quotes, field):
+def tsqueryExact(sql, sqlval, phrases, quotes, field):
     """
     Given a list of phrases, add to an sql query to do a case insensitive
-    match if the phrase is either quoted or a hashtag.
+    match if the phrase is either quoted or a hashtag.  Each match is a
+    regular expression preceded by an ILIKE test for the phrase, both of
+    which can use a pg_trgm index on the field.
 
     :param sql: an array to append partial sql clauses to.  Modified.
+    :param sqlval: an array to append the values of the sql clauses to.
+                   Modified.
     :param phrase: a list of phrases to consider adding.  These are either
                    keys in the quotes dictionary, in which case they are
                    included, or plain strings, in which case they are only
@@ -200,19 +337,22 @@ def tsqueryExact(sql, phrases, quotes, field):
     :param quotes: a dictionary of quotes.
     :param field: name of the field to query.
     """
-    for phrase in set(phrases):
+    for phrase in sorted(set(phrases)):
         if phrase in quotes:
-            escval = re.escape(quotes[phrase])
-            escval = psycopg2.extensions.adapt(escval).getquoted()[1:-1]
-            sql.append(' AND ' + field + ' ~* E\'' + escval + '\'')
+            text = quotes[phrase]
+            regex = re.escape(text)
         elif phrase.startswith('#') and len(phrase) > 1:
-            escval = re.escape(phrase)
-            escval = psycopg2.extensions.adapt(escval).getquoted()[1:-1]
-            sql.append(' AND ' + field + ' ~* E\'(^|[^\\w#])' + escval +
-                       '($|[^\\w#])\'')
+            text = phrase
+            regex = '(^|[^\\w#])' + re.escape(phrase) + '($|[^\\w#])'
+        else:
+            continue
+        sql.append(' AND ' + field + ' ILIKE %s AND ' + field + ' ~* %s')
+        sqlval.append('%' + text.replace('\\', '\\\\').replace(
+            '%', '\\%').replace('_', '\\_') + '%')
+        sqlval.append(regex)
 
 
-def tsquerySearch(field, query):
+def tsquerySearch(field, query, vectorField=None):
     """
     Convert a string query into a Postgres tsquery.  Quoted sections require
     an exact case-insensitive match, as do #(hashtag) phrases.  All words are
@@ -223,11 +363,17 @@ def tsquerySearch(field, query):
 
     :param field: name of the field to query.
     :param query: the original text string.
+    :param vectorField: if not None, the name of a stored tsvector column of
+                        the field to use rather than computing the tsvector.
     :returns: a sql where clause with '%s' whereever a string that needs to be
               escaped is located.
     :returns: an array of strings that are needed for the sql where clause.
     """
-    sql = ['to_tsvector(\'english\', %s) @@ to_tsquery(\'english\', ' % field]
+    if vectorField:
+        sql = ['%s @@ to_tsquery(\'english\', ' % vectorField]
+    else:
+        sql = ['to_tsvector(\'english\', %s) @@ to_tsquery(\'english\', ' %
+               field]
     sqlval = []
     sql.append('%s')
 
@@ -249,16 +395,87 @@ def tsquerySearch(field, query):
     sqlval.append(tsq)
     sql.append(')')
     if len(include):
-        tsqueryExact(sql, include, quotes, field)
+        tsqueryExact(sql, sqlval, include, quotes, field)
     if len(exclude):
         subsql = []
-        tsqueryExact(subsql, exclude, quotes, field)
+        tsqueryExact(subsql, sqlval, exclude, quotes, field)
         if len(subsql):
             sql.extend([' AND NOT (true' + subsqlval + ')' for subsqlval in
                         subsql])
     return ''.join(sql), sqlval
 
 
+class CopyStreamWriter():
+
+    def __init__(self, activity=None):
+        """
+        A file-like object that psycopg2 writes COPY output to in one thread
+        and that yields the output in chunks in another.  The queue between
+        them is bounded, so the database is only read as fast as the client
+        reads the response.
+
+        :param activity: an optional function that is called whenever a chunk
+                         of output is queued.
+        """
+        self.activity = activity
+        self.queue = Queue.Queue(PostgresExportQueueSize)
+        self.buffer = []
+        self.size = 0
+        self.stopped = False
+        # copying is True while the COPY query is running.  The lock ensures
+        # that the query is only cancelled while the connection is still ours.
+        self.copying = False
+        self.lock = threading.Lock()
+
+    def close(self, error=None):
+        """
+        Mark the end of the output.
+
+        :param error: None if the output is complete, otherwise a string
+                      describing the error that ended it.
+        """
+        if not error:
+            self.flush()
+        self.put(('end', error))
+
+    def flush(self):
+        """
+        Queue any buffered output.
+        """
+        if self.size:
+            self.put(('data', ''.join(self.buffer)))
+            self.buffer = []
+            self.size = 0
+            if self.activity:
+                self.activity()
+
+    def put(self, item):
+        """
+        Add an item to the queue, waiting if it is full.
+
+        :param item: a tuple of the item type and value.
+        """
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        # Raising an exception in write aborts the COPY.
+        raise IOError('Export stopped')
+
+    def write(self, data):
+        """
+        Called by psycopg2 with each piece of COPY output.
+
+        :param data: the output.
+        """
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= PostgresExportChunkSize:
+            self.flush()
+
+
 class ViaPostgres():
 
     epoch = datetime.datetime.utcfromtimestamp(0)
@@ -266,23 +483,36 @@ class ViaPostgres():
     def __init__(self, db=None, **params):
         self.dbname = db
         self.dbparams = params.copy()
-        self.dbLock = threading.RLock()
-        self.dbpool = []
-        self.maxPoolSize = PostgresPoolSize
         if db is not None:
             self.dbparams['database'] = db
+        replicas = self.dbparams.pop('replicas', None) or []
         if not self.dbparams['database'] and not self.dbparams['dsn']:
             self.dbparams['dsn'] = 'parakon:taxi12r:taxi:taxi#1'
+        # Access objects for the same database share a pool of connections.
+        # If the database has read replicas, reads are spread across them.
+        # Writes and notifications always use the primary database.
+        if replicas:
+            self.pool = datapool.getRouter(self.dbparams, [
+                self.replicaParams(replica) for replica in replicas])
+        else:
+            self.pool = datapool.getPool(self.dbparams)
         self.useMilliseconds = False
         self.alwaysUseIdSort = True
         self.defaultSort = [('_id', 1)]
         self.maxId = None
         self.realtime = False
-        self.dbIdleTime = 300
-        self.dbAbandonTime = self.dbIdleTime * 5
-        self.closeThread = threading.Thread(target=self.closeWhenIdle)
-        self.closeThread.daemon = True
-        self.closeThread.start()
+        self.listener = None
+        self.columns = {}
+        # Each spatial key is the latitude and longitude fields of a location
+        # and the column of their Z-order key.  The key is only used if the
+        # table has the column.
+        self.spatialKeys = [('latitude', 'longitude', 'zkey')]
+        # The date field that the table may be partitioned on by month.
+        self.partitionField = None
+        self.partitions = None
+        self.partitionsChecked = 0
+        # A rollup table that can answer some histograms.  See datarollup.
+        self.rollup = None
 
     def adjustReturnFields(self, fields):
         """
@@ -308,7 +538,17 @@ class ViaPostgres():
                 newfields.append(field)
         return newfields
 
-    def connect(self, reconnect=False, client=None):
+    def cancelClient(self, client):
+        """
+        Cancel any query that is running for a client without taking a new
+        connection from the pool.  The connection is returned to the pool when
+        the query's owner disconnects.
+
+        :param client: the client whose queries should be cancelled.
+        """
+        self.pool.cancel(client)
+
+    def connect(self, reconnect=False, client=None, primary=False):
         """
         Connect to the database.
 
@@ -316,70 +556,34 @@ class ViaPostgres():
                           If 'fresh', create a new connection that the caller
                           is responsible for closing that isn't part of the
                           pool.  The client is ignored in this case.  If True,
-                          close any existing connections that aren't in use or
-                          are for this client, and return a new connection.
-        :param client: if None, use the next connection in the pool.  If
-                       specified, if this client is currently marked in use,
-                       cancel the client's existing query and return a
-                       connection from the pool for the client to use.
-        :return: a database object.
+                          return a new connection from the pool.
+        :param client: if specified, cancel the client's existing queries and
+                       mark the connection as belonging to the client.
+        :param primary: if True and the database has read replicas, use the
+                        primary database, such as for queries that must see
+                        the newest data.  A fresh connection always uses the
+                        primary database.
+        :return: a database object.  If every connection in the pool is in
+                 use for too long, datapool.PoolTimeoutError is raised.
         """
         if reconnect == 'fresh':
             return psycopg2.connect(**self.dbparams)
-        db = None
-        with self.dbLock:
-            if client:
-                for pos in range(len(self.dbpool) - 1, -1, -1):
-                    if self.dbpool[pos].get('client', None) == client:
-                        self.dbpool[pos]['db'].cancel()
-                        if reconnect:
-                            self.dbpool[pos:pos + 1] = []
-                        else:
-                            self.dbpool[pos]['used'] = False
-                            self.dbpool[pos]['client'] = None
-            if reconnect:
-                if len(self.dbpool) >= self.maxPoolSize:
-                    for pos in range(len(self.dbpool)):
-                        if not self.dbpool[pos]['used']:
-                            self.dbpool[pos]['db'].close()
-                            self.dbpool[pos:pos + 1] = []
-                            break
-            if not reconnect:
-                for pos in range(len(self.dbpool)):
-                    if not self.dbpool[pos]['used']:
-                        db = self.dbpool[pos]['db']
-                        self.dbpool[pos]['used'] = True
-                        self.dbpool[pos]['client'] = client
-                        self.dbpool[pos]['time'] = time.time()
-                        break
-            if not db:
-                db = psycopg2.connect(**self.dbparams)
-                self.dbpool.append({
-                    'db': db,
-                    'used': True,
-                    'client': client,
-                    'time': time.time()
-                })
-        return db
-
-    def closeWhenIdle(self):
-        """
-        Periodically check if the database has been used.  If not, close the
-        connection to free resources and allow easier management of the
-        database while the application is running.
-        """
-        while True:
-            with self.dbLock:
-                curtime = time.time()
-                for pos in range(len(self.dbpool) - 1, -1, -1):
-                    delta = curtime - self.dbpool[pos]['time']
-                    if ((not self.dbpool[pos]['used'] and
-                            delta > self.dbIdleTime) or
-                            delta > self.dbAbandonTime):
-                        # The old db connection will close when no process is
-                        # using it
-                        self.dbpool[pos:pos + 1] = []
-            time.sleep(30)
+        return self.pool.checkout(client, reconnect, primary)
+
+    def replicaParams(self, replica):
+        """
+        Get the connection parameters of a read replica.
+
+        :param replica: either the host name of the replica or a dictionary of
+                        the parameters that differ from the primary database.
+        :returns: the parameters passed to psycopg2.connect.
+        """
+        params = self.dbparams.copy()
+        if isinstance(replica, dict):
+            params.update(replica)
+        else:
+            params['host'] = replica
+        return params
 
     def checkMaxId(self, client=None):
         """
@@ -388,17 +592,102 @@ class ViaPostgres():
 
         :param client: the clientid to use for the database connection.
         """
-        if self.maxId is None and self.queryBase in ('instagram', 'taxi'):
-            db = self.connect(client=client)
-            c = db.cursor()
+        if self.queryBase in ('instagram', 'taxi'):
             try:
-                c.execute('SELECT max(_id) FROM %s' % self.tableName)
-                row = c.fetchone()
-                self.maxId = int(row[0])
+                self.maxId = int(self.highWaterMark(
+                    client, PostgresMaxIdMaxAge) or 0)
             except (psycopg2.Error, ValueError):
-                self.maxId = 0
-            c.close()
-            self.disconnect(db, client)
+                self.maxId = self.maxId or 0
+
+    def dataAdded(self, payload=None):
+        """
+        Record that data was added to the table by another process.
+
+        :param payload: a dictionary with the 'first' and 'last' _id of the
+                        added rows, or None if they aren't known.
+        """
+        mark = datanotify.highWaterMark(self.notifyKey())
+        if isinstance(payload, dict) and isinstance(
+                payload.get('last'), (int, long)):
+            mark.advance(payload['last'])
+        else:
+            mark.expire()
+
+    def dateToDb(self, value):
+        """
+        Convert a date query value to the units of the table's date columns.
+
+        :param value: a date string.
+        :returns: the date in the database's units.
+        """
+        return self.epochToDb(int((dateutil.parser.parse(value) - self.epoch)
+                                  .total_seconds()))
+
+    def densityGrid(self, params={}, latfield='latitude',
+                    lonfield='longitude', grid=None, **kwargs):
+        """
+        Count the rows that match a query in the cells of a spatial grid.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param latfield: the latitude field used for binning.
+        :param lonfield: the longitude field used for binning.
+        :param grid: a grid description from datagrid.makeGrid.
+        :param queryBase: a string used to ensure we are using keys appropriate
+                          to the asking query and to underlying database.
+        :param whereClauses: a list of extra where clauses that are anded to
+                             any other where clauses.
+        :returns: a dictionary of results in list format.  Each row is the
+                  column, row, and number of rows for a cell.  Empty cells are
+                  omitted.
+        """
+        client = params.get('clientid', '').strip()
+        if not client:
+            client = None
+        starttime = time.time()
+        queryToDbKeys, dbToQueryKeys = self.getKeyTables(
+            kwargs.get('queryBase', None))
+        lat = queryToDbKeys.get(latfield, latfield)
+        lon = queryToDbKeys.get(lonfield, lonfield)
+        if lat is None or lon is None:
+            return {'error': 'Location fields are not available.'}
+        y = lat
+        if grid['mercator']:
+            y = 'ln(tan(pi() / 4 + radians(%s) / 2))' % lat
+        sql = [
+            'SELECT floor((%s - %r) / %r)::int,' % (
+                lon, grid['left'], grid['dx']),
+            'floor((%r - %s) / %r)::int, count(*)' % (
+                grid['top'], y, grid['dy']),
+        ]
+        sqlval = []
+        self.findFrom(params, sql, sqlval, dbToQueryKeys, **kwargs)
+        sql.append('AND %s >= %r AND %s < %r AND %s > %r AND %s <= %r' % (
+            lon, grid['west'], lon, grid['east'], lat, grid['south'], lat,
+            grid['north']))
+        self.spatialKeySql({
+            lat: {'_min': grid['south'], '_max': grid['north']},
+            lon: {'_min': grid['west'], '_max': grid['east']}}, sql, sqlval)
+        sql.append('GROUP BY 1, 2')
+        sql = ' '.join(sql)
+        fields = ['col', 'row', 'count']
+        result = {
+            'format': 'list',
+            'fields': fields,
+            'columns': {fields[col]: col for col in xrange(len(fields))},
+        }
+        # The grid's bounds are part of the sql, so each pan or zoom is a new
+        # query that isn't worth preparing.
+        db, c = self.findQuery(result, params, sql, sqlval, client,
+                               timeout=self.queryTimeout('densityGrid'),
+                               prepare=False)
+        if not db and 'data' not in result:
+            return
+        if not c:
+            if db:
+                self.disconnect(db, client)
+            return result
+        result['data'] = list(self.findRows(db, c, client, starttime, result))
+        return result
 
     def disconnect(self, db, client=None):
         """
@@ -408,14 +697,182 @@ class ViaPostgres():
         :param db: the database connection to mark as finished.
         :param client: the client that owned this connection.
         """
-        with self.dbLock:
-            for pos in range(len(self.dbpool)):
-                if self.dbpool[pos]['db'] == db:
-                    self.dbpool[pos]['used'] = False
-                    self.dbpool[pos]['client'] = None
-                    if len(self.dbpool) > self.maxPoolSize:
-                        self.dbpool[pos:pos + 1] = []
+        self.pool.checkin(db, client)
+
+    def epochToDb(self, value):
+        """
+        Convert a time in seconds since the epoch to the units of the table's
+        date columns.
+
+        :param value: seconds since the epoch.
+        :returns: the time in the database's units.
+        """
+        if self.useMilliseconds is True:
+            value *= 1000
+        elif self.useMilliseconds:
+            value = (value - self.useMilliseconds) * 1000
+        return value
+
+    def executeQuery(self, db, c, sql, sqlval, named=False, timeout=0,
+                     prepare=True):
+        """
+        Execute a query.  Unless a named cursor is used or preparing is
+        disabled, the query is prepared on the connection the first time it
+        is used, and executed as a prepared statement after that, so queries
+        with the same shape but different values skip parsing and planning.
+
+        :param db: the database connection.
+        :param c: the cursor to execute the query on.
+        :param sql: sql to execute with a %s placeholder for each value.
+        :param sqlval: values to pass to sql execute.
+        :param named: True if c is a named cursor.
+        :param timeout: the statement timeout in milliseconds, or 0 for none.
+        :param prepare: False to not prepare the query, such as when its
+                        values are part of the sql, so that it is unlikely to
+                        be run again.
+        """
+        logger.info('Query: %s', c.mogrify(sql, sqlval))
+        prepared = None
+        if prepare and not named:
+            prepared = self.pool.preparedStatements(db)
+        if prepared is not None and sql not in prepared:
+            if len(prepared) >= PostgresPreparedMax:
+                c.execute('DEALLOCATE ALL')
+                prepared.clear()
+            name = 'geoapp_q%d' % next(PreparedCounter)
+            try:
+                c.execute('PREPARE %s AS %s' % (name, dollarParameters(sql)))
+                prepared[sql] = name
+            except psycopg2.ProgrammingError as exc:
+                # Some queries can't be prepared, such as when Postgres can't
+                # infer the type of a parameter.  Don't try them again.
+                logger.info('Not preparing query: %s', str(exc).strip())
+                db.rollback()
+                prepared[sql] = None
+        self.pool.statementTimeout(db, timeout)
+        if not prepared or not prepared.get(sql):
+            c.execute(sql, sqlval)
+            return
+        c.execute('EXECUTE %s%s' % (prepared[sql], '(%s)' % ','.join(
+            ['%s'] * len(sqlval)) if len(sqlval) else ''), sqlval)
+
+    def export(self, params={}, fields=None, outputFormat='csv', limit=0,
+               **kwargs):
+        """
+        Export data from a postgres database using COPY TO STDOUT.  The query
+        is run in a separate thread and its output is yielded as it arrives.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param fields: a list of fields to export, or None for all fields.
+        :param outputFormat: 'csv' or 'tsv'.  Both include a header row with
+                             the field names.
+        :param limit: the maximum number of rows to export, or 0 for all rows.
+        :param queryBase: a string used to ensure we are using keys appropriate
+                          to the asking query and to underlying database.
+        :param whereClauses: a list of extra where clauses that are anded to
+                             any other where clauses.
+        :returns: an iterator of strings with the exported data, or None if a
+                  database connection couldn't be made.
+        """
+        queryToDbKeys, dbToQueryKeys = self.getKeyTables(
+            kwargs.get('queryBase', None))
+        if not fields:
+            fields = [dbToQueryKeys.get(field, field)
+                      for field in self.fieldTable]
+        # Skip fields that this database doesn't have.
+        fields = [field for field in fields if
+                  queryToDbKeys.get(field, field) in self.fieldTable]
+        dbfields = self.adjustReturnFields(
+            [queryToDbKeys.get(field, field) for field in fields])
+        sql = ['SELECT', ','.join([
+            '%s AS %s' % (dbfield, field)
+            for dbfield, field in zip(dbfields, fields)])]
+        sqlval = []
+        self.findFrom(params, sql, sqlval, dbToQueryKeys, **kwargs)
+        if limit:
+            sql.append('LIMIT %d' % limit)
+        client = params.get('clientid', '').strip() or None
+        try:
+            db = self.connect(client=client)
+            c = db.cursor()
+        except psycopg2.Error as exc:
+            logger.info('Database error %s', str(exc).strip())
+            return None
+        # COPY can't use query parameters, so the values are escaped into the
+        # query.
+        sql = 'COPY (%s) TO STDOUT WITH CSV HEADER%s' % (
+            c.mogrify(' '.join(sql), sqlval),
+            ' DELIMITER E\'\\t\'' if outputFormat == 'tsv' else '')
+        logger.info('Query: %s', sql)
+        # A long export keeps its connection from looking abandoned.
+        writer = CopyStreamWriter(lambda: self.pool.touch(db))
+        return self.exportRows(db, c, sql, writer, client)
+
+    def exportCopy(self, db, c, sql, writer, client=None, timeout=0):
+        """
+        Run a COPY query, sending its output to a writer.  This is run in its
+        own thread.
+
+        :param db: the database connection.
+        :param c: a cursor on the connection.
+        :param sql: the COPY query.
+        :param writer: the CopyStreamWriter for the output.
+        :param client: the client that owns the connection.
+        :param timeout: the statement timeout in milliseconds, or 0 for none.
+        """
+        starttime = time.time()
+        error = None
+        writer.copying = True
+        try:
+            self.pool.statementTimeout(db, timeout)
+            c.copy_expert(sql, writer)
+        except (psycopg2.Error, IOError) as exc:
+            error = str(exc).strip()
+            logger.info('Export error %s', error)
+        finally:
+            with writer.lock:
+                writer.copying = False
+            c.close()
+            self.disconnect(db, client)
+        logger.info('Export time: %5.3fs', time.time() - starttime)
+        try:
+            writer.close(error)
+        except IOError:
+            pass
+
+    def exportRows(self, db, c, sql, writer, client=None):
+        """
+        Start an export and yield its output as it is produced.  The COPY
+        thread is only started once the output is read, so that it is always
+        stopped by this generator.  If the consumer stops early, the COPY is
+        cancelled.
+
+        :param db: the database connection used by the export.
+        :param c: a cursor on the connection.
+        :param sql: the COPY query.
+        :param writer: the CopyStreamWriter for the output.
+        :param client: the client that owns the connection.
+        :yields: strings of exported data.
+        """
+        try:
+            thread = threading.Thread(target=self.exportCopy, args=(
+                db, c, sql, writer, client, self.queryTimeout('export')))
+            thread.daemon = True
+            thread.start()
+            while True:
+                kind, value = writer.queue.get()
+                if kind == 'end':
+                    if value:
+                        # The response has already started, so the best we
+                        # can do is to end it with an obvious marker.
+                        yield '\n# Export failed: %s\n' % value
                     break
+                yield value
+        finally:
+            writer.stopped = True
+            with writer.lock:
+                if writer.copying:
+                    db.cancel()
 
     def find(self, params={}, limit=50, offset=0, sort=None, fields=None,
              **kwargs):
@@ -437,7 +894,18 @@ class ViaPostgres():
                           to the asking query and to underlying database.
         :param whereClauses: a list of extra where clauses that are anded to
                              any other where clauses.
-        :returns: a dictionary of results.
+        :param stream: if True, the 'data' value of the results is an iterator
+                       that yields rows as they are read from the database
+                       rather than a list.  The database connection is
+                       released when the iterator is exhausted.
+        :param cursor: a decoded cursor from a previous page of results.  If
+                       it is for the same sort, the query resumes after the
+                       last row of that page and the offset is ignored.
+        :param parallel: if more than 1, a large query may be split into this
+                         many ranges of its first sort key that are queried
+                         concurrently.  See findPartitions.
+        :returns: a dictionary of results.  If the sort keys are in the
+                  returned fields, this includes a 'cursor' for the next page.
         """
         client = params.get('clientid', '').strip()
         if not client:
@@ -454,19 +922,22 @@ class ViaPostgres():
             fields = [field[0] for field in self.fieldTable]
         fields = [field for field in fields if
                   queryToDbKeys.get(field, field) is not None]
+        # A cursor resumes after the sort keys of the last row, so other rows
+        # with the same keys would be skipped.  If the sort isn't unique, _id
+        # breaks ties when it is returned.
+        if not self.uniqueSort(sort) and '_id' in fields:
+            sort = list(sort) + [('_id', sort[-1][1])]
         dbfields = [queryToDbKeys.get(field, field) for field in fields]
         if hasattr(self, 'adjustReturnFields'):
             sql.append(','.join(self.adjustReturnFields(dbfields)))
         else:
             sql.append(','.join(dbfields))
-        sql.append('FROM %s WHERE true' % self.tableName)
-        if kwargs.get('whereClauses', None) and len(kwargs['whereClauses']):
-            sql.extend(['AND', ' AND '.join(kwargs['whereClauses'])])
         sqlval = []
-        self.params_to_sql(params, sql, sqlval, dbToQueryKeys)
-
-        self.findModifiers(sort, limit, offset, sql, queryToDbKeys)
-        sql = ' '.join(sql)
+        self.findFrom(params, sql, sqlval, dbToQueryKeys, **kwargs)
+        keyCols, resumed = self.findKeyset(
+            sort, fields, kwargs.get('cursor'), sql, sqlval, queryToDbKeys)
+        if resumed:
+            offset = 0
         columns = {fields[col]: col for col in xrange(len(fields))}
         result = {
             'format': 'list',
@@ -475,32 +946,400 @@ class ViaPostgres():
         }
         if self.maxId:
             result['maxid'] = self.maxId
-        db, c = self.findQuery(result, params, sql, sqlval, client)
-        if not db:
-            return
-        execTime = None
-        if c:
-            execTime = time.time()
+        ranges = self.findPartitions(
+            sql, sqlval, sort, limit, offset, queryToDbKeys, client,
+            kwargs.get('parallel'))
+        if ranges:
+            rows = self.findParallel(
+                result, params, sql, sqlval, sort, limit, ranges,
+                queryToDbKeys, client, starttime)
+        else:
+            self.findModifiers(
+                sort, limit, offset, sql, queryToDbKeys, sqlval)
+            db, c = self.findQuery(
+                result, params, ' '.join(sql), sqlval, client,
+                named=not limit or limit >= PostgresServerCursorRows,
+                timeout=self.queryTimeout('find'))
+            if not db and 'data' not in result:
+                return
+            if not c:
+                if db:
+                    self.disconnect(db, client)
+                return result
+            rows = self.findRows(db, c, client, starttime, result)
+        if keyCols is not None:
+            rows = dataencode.trackCursor(
+                rows, result, sort, lambda row: [row[col] for col in keyCols])
+        if kwargs.get('stream'):
+            result['data'] = rows
+        else:
+            result['data'] = list(rows)
+        return result
+
+    def findParallel(self, result, params, sql, sqlval, sort, limit, ranges,
+                     queryToDbKeys={}, client=None, starttime=None):
+        """
+        Run a find query as several concurrent queries, each on its own
+        database connection and each restricted to one range of the first
+        sort key.  Because the ranges are disjoint and in sort order, the
+        rows are combined by concatenating the partitions in order.  Each
+        partition streams its rows through a bounded queue, so later
+        partitions only read ahead a little while earlier ones are read.
+
+        :param result: the result dictionary.  If a partition fails, 'error'
+                       is set in this dictionary.
+        :param params: rest query parameters.
+        :param sql: list of sql phrases with the select and where clauses.
+        :param sqlval: values to pass to sql execute.
+        :param sort: the sort order of the query.
+        :param limit: the total number of rows to return, or 0 for all rows.
+        :param ranges: a list of (database key, low, high) tuples from
+                       findPartitions.
+        :param queryToDbKeys: a map to convert query parameters to database
+                              parameters.
+        :param client: the client that owns the query.
+        :param starttime: the time the find request started.
+        :returns: an iterator of rows.
+        """
+        # Partitions use their own client ids so that they get separate
+        # connections, but are cancelled with the owning client.
+        baseClient = client or 'parallel-%x' % id(result)
+        parts = []
+        for idx, (key, low, high) in enumerate(ranges):
+            partSql = sql + ['AND %s>=%%s AND %s<%%s' % (key, key)]
+            partVal = sqlval + [low, high]
+            self.findModifiers(
+                sort, limit, 0, partSql, queryToDbKeys, partVal)
+            part = {
+                'client': '%s%s%d' % (
+                    baseClient, datapool.PartitionClientSeparator, idx),
+                'done': threading.Event(),
+                'result': {},
+                'queue': Queue.Queue(PostgresParallelQueueSize),
+                'stopped': False,
+                'timeout': self.queryTimeout('find'),
+            }
+            thread = threading.Thread(target=self.findPartition, args=(
+                part, params, ' '.join(partSql), partVal, starttime))
+            thread.daemon = True
+            thread.start()
+            parts.append(part)
+        return self.findParallelRows(parts, result, limit)
+
+    def findParallelRows(self, parts, result, limit):
+        """
+        Yield the rows of the partitions of a parallel query in order.  Once
+        enough rows have been yielded or the reader stops, the partitions
+        are stopped and any that are still running are cancelled.
+
+        :param parts: a list of partitions from findParallel.
+        :param result: the result dictionary.  Modified if there is an error.
+        :param limit: the total number of rows to return, or 0 for all rows.
+        :yields: rows.
+        """
+        count = 0
+        try:
+            for part in parts:
+                # None marks the end of a partition's rows.
+                batch = part['queue'].get()
+                while batch is not None:
+                    for row in batch[:limit - count] if limit else batch:
+                        yield row
+                    count += len(batch)
+                    if limit and count >= limit:
+                        return
+                    batch = part['queue'].get()
+                if part['result'].get('error'):
+                    for key in ('error', 'timedout', 'elapsed'):
+                        if key in part['result']:
+                            result[key] = part['result'][key]
+                    return
+        finally:
+            for part in parts:
+                part['stopped'] = True
+                if not part['done'].is_set():
+                    self.cancelClient(part['client'])
+
+    def findPartition(self, part, params, sql, sqlval, starttime=None):
+        """
+        Run the query for one partition of a parallel query and pass its rows
+        to the partition's queue in batches.  This is run in its own thread.
+
+        :param part: the partition dictionary.  'result' is modified, and
+                     'done' is set when the query finishes.
+        :param params: rest query parameters.
+        :param sql: sql to execute.
+        :param sqlval: values to pass to sql execute.
+        :param starttime: the time the find request started.
+        """
+        try:
+            db, c = self.findQuery(
+                part['result'], params, sql, sqlval, part['client'],
+                named=True, timeout=part['timeout'])
+            if not db:
+                part['result'].setdefault('error', 'QUERY_FAILED')
+            elif not c:
+                self.disconnect(db, part['client'])
+            else:
+                rows = self.findRows(
+                    db, c, part['client'], starttime, part['result'])
+                try:
+                    batch = []
+                    for row in rows:
+                        batch.append(row)
+                        if len(batch) >= PostgresParallelBatchRows:
+                            if not self.findPartitionPut(part, batch):
+                                break
+                            batch = []
+                    if batch:
+                        self.findPartitionPut(part, batch)
+                finally:
+                    # Closing the rows releases the connection.
+                    rows.close()
+        finally:
+            part['done'].set()
+            self.findPartitionPut(part, None)
+
+    def findPartitionPut(self, part, batch):
+        """
+        Add a batch of rows to a partition's queue, waiting while it is full.
+
+        :param part: the partition dictionary.
+        :param batch: a list of rows, or None for the end of the rows.
+        :returns: True if the batch was queued, False if the partition was
+                  stopped.
+        """
+        while not part['stopped']:
             try:
-                result['data'] = data = c.fetchmany()
-                while data:
-                    data = c.fetchmany()
-                    if data:
-                        result['data'].extend(data)
-                c.close()
-            except psycopg2.Error as exc:
-                code = psycopg2.errorcodes.lookup(exc.pgcode)
-                logger.info('Database error %s - %s', str(exc).strip(), code)
+                part['queue'].put(batch, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def findPartitions(self, sql, sqlval, sort, limit, offset,
+                       queryToDbKeys={}, client=None, parallel=None):
+        """
+        Determine if a find query should be split into concurrent queries,
+        and, if so, get the ranges of the first sort key used for each
+        partition.  Only large queries without an offset that are sorted by
+        an integer or date column (such as rand1 or _id) are split.  The
+        ranges are based on the minimum and maximum of the column among the
+        rows that match the query, so the column should be indexed.
+
+        :param sql: list of sql phrases with the select and where clauses.
+        :param sqlval: values to pass to sql execute.
+        :param sort: the sort order of the query.
+        :param limit: the limit of the query.
+        :param offset: the offset of the query.
+        :param queryToDbKeys: a map to convert query parameters to database
+                              parameters.
+        :param client: the client used for the database connection.
+        :param parallel: the requested number of partitions.
+        :returns: a list of (database key, low, high) tuples in the order
+                  that the partitions should be returned, or None to not
+                  split the query.
+        """
+        if (not parallel or parallel < 2 or offset or self.realtime or
+                not sort or (limit and limit < PostgresParallelMinRows)):
+            return None
+        queryKey = sort[0][0]
+        key = queryToDbKeys.get(queryKey, queryKey)
+        keyType = self.fieldTable.get(key, ('', ))[0]
+        if keyType not in ('int', 'bigint', 'date'):
+            return None
+        db = self.connect(client=client)
+        c = db.cursor()
+        try:
+            # Replace the select list so that the bounds only cover the rows
+            # that match the query's filters.
+            c.execute(' '.join(['SELECT min(%s), max(%s)' % (key, key)] +
+                               sql[2:]), sqlval)
+            low, high = c.fetchone()
+        except psycopg2.Error:
+            low = high = None
+        c.close()
         self.disconnect(db, client)
-        if execTime:
-            curtime = time.time()
-            logger.info(
-                'Query time: %5.3fs for query, %5.3fs total, %d row%s',
-                execTime - starttime, curtime - starttime, len(result['data']),
-                's' if len(result['data']) != 1 else '')
-        return result
+        if low is None or high is None:
+            return None
+        high += 1
+        # Leave room in the pool for other requests.
+        count = min(int(parallel), PostgresParallelMax,
+                    max(2, self.pool.maxSize // 2))
+        bounds = [low + (high - low) * idx // count
+                  for idx in xrange(count + 1)]
+        ranges = [(key, bounds[idx], bounds[idx + 1]) for idx in xrange(count)
+                  if bounds[idx] < bounds[idx + 1]]
+        if sort[0][1] == -1:
+            ranges.reverse()
+        return ranges if len(ranges) > 1 else None
+
+    def findRows(self, db, c, client=None, starttime=None, result=None):
+        """
+        Yield the rows of a find query in batches, then close the cursor and
+        release the database connection.
+
+        :param db: the database connection used for the query.
+        :param c: the database cursor with the query results.
+        :param client: the client that owns the database connection.
+        :param starttime: the time the find request started.  Used for
+                          logging.
+        :param result: if not None, the result dictionary.  If a database
+                       error occurs while reading the rows, 'error' is set in
+                       this dictionary.
+        :yields: a row of data for each database row.
+        """
+        execTime = time.time()
+        count = 0
+        try:
+            data = c.fetchmany(c.itersize)
+            while data:
+                for row in data:
+                    yield row
+                count += len(data)
+                data = c.fetchmany(c.itersize)
+                # A long result keeps its connection from looking abandoned.
+                self.pool.touch(db)
+        except GeneratorExit:
+            logger.info('Client stopped reading after %d row%s', count,
+                        's' if count != 1 else '')
+            raise
+        except psycopg2.Error as exc:
+            code = errorCode(exc)
+            logger.info('Database error %s - %s', str(exc).strip(), code)
+            if result is not None:
+                result['error'] = code
+                if code == 'STATEMENT_TIMEOUT':
+                    # The rows that were sent are a partial result.
+                    result['timedout'] = True
+                    result['elapsed'] = round(
+                        time.time() - (starttime or execTime), 3)
+        finally:
+            # If the client went away, the cursor is still open.  A
+            # server-side cursor must be closed to release it in the
+            # database.
+            try:
+                c.close()
+            except psycopg2.Error:
+                pass
+            self.disconnect(db, client)
+        curtime = time.time()
+        logger.info(
+            'Query time: %5.3fs for query, %5.3fs total, %d row%s',
+            execTime - (starttime or execTime), curtime - (
+                starttime or execTime), count, 's' if count != 1 else '')
+
+    def findTables(self, params, altkeys={}):
+        """
+        Get the table expression that a query reads from.  If the table is
+        partitioned by month and the query is bounded on the partition field,
+        only the child tables that overlap the bounds are read, plus any rows
+        still in the parent table.  Postgres can skip children based on their
+        check constraints itself, but not when the bounds are parameters of a
+        prepared statement, so the children are chosen here.
 
-    def findModifiers(self, sort, limit, offset, sql, queryToDbKeys={}):
+        :param params: a dictionary of query restrictions.
+        :param altkeys: a dictionary of alternate names for keys.  See
+                        params_to_sql.
+        :returns: the table name or a subquery to use in a FROM clause.
+        """
+        field = self.partitionField
+        if not field:
+            return self.tableName
+        limits = []
+        for suffix in ('_min', '_max'):
+            value = params.get((altkeys.get(field) or field) + suffix,
+                               params.get(field + suffix))
+            limits.append(None if value is None else self.dateToDb(value))
+        if limits == [None, None]:
+            return self.tableName
+        low, high = limits
+        partitions = self.tablePartitions()
+        tables = [name for name, start, end in partitions
+                  if (low is None or end > low) and
+                  (high is None or start < high)]
+        if len(tables) == len(partitions):
+            return self.tableName
+        return '(%s) AS %s' % (' UNION ALL '.join(
+            ['SELECT * FROM ONLY %s' % self.tableName] +
+            ['SELECT * FROM %s' % name for name in tables]), self.tableName)
+
+    def findFrom(self, params, sql, sqlval, dbToQueryKeys={}, **kwargs):
+        """
+        Add the table and where clauses for a query to the sql.
+
+        :param params: a dictionary of query restrictions.
+        :param sql: a list of sql statement fragments.  Modified.
+        :param sqlval: a list of sql values to escape.  Modified.
+        :param dbToQueryKeys: a map to convert database parameters to query
+                              parameters.
+        :param whereClauses: a list of extra where clauses that are anded to
+                             any other where clauses.
+        """
+        sql.append('FROM %s WHERE true' % self.findTables(
+            params, dbToQueryKeys))
+        if kwargs.get('whereClauses', None) and len(kwargs['whereClauses']):
+            sql.extend(['AND', ' AND '.join(kwargs['whereClauses'])])
+        self.params_to_sql(params, sql, sqlval, dbToQueryKeys)
+
+    def findKeyset(self, sort, fields, cursor, sql, sqlval,
+                   queryToDbKeys={}):
+        """
+        Determine if a query can be paged with a cursor, and, if a cursor
+        from a previous page is given, add a where clause that resumes after
+        the last row of that page.  This requires that the sort is unique,
+        that every sort key is returned without conversion, and that all keys
+        are sorted in the same direction, so that a row comparison can be
+        used.
+
+        :param sort: the sort order of the query.
+        :param fields: the list of fields that will be returned.
+        :param cursor: a decoded cursor or None.
+        :param sql: list of sql phrases.  Modified.
+        :param sqlval: a list of sql values to escape.  Modified.
+        :param queryToDbKeys: a map to convert query parameters to database
+                              parameters.
+        :returns: keyCols: a list of the columns of the sort keys in the
+                  returned rows, or None if the query can't be paged with a
+                  cursor.
+        :returns: resumed: True if a where clause was added for the cursor.
+        """
+        if (not sort or len(set(dir == -1 for key, dir in sort)) != 1 or
+                not self.uniqueSort(sort)):
+            return None, False
+        dbkeys = [queryToDbKeys.get(key, key) for key, dir in sort]
+        for key, dbkey in zip([key for key, dir in sort], dbkeys):
+            if dbkey is None or key not in fields:
+                return None, False
+            if (self.fieldTable.get(dbkey, ('',))[0] == 'date' and
+                    self.useMilliseconds is not True):
+                return None, False
+        keyCols = [fields.index(key) for key, dir in sort]
+        values = dataencode.cursorValues(cursor, sort)
+        if values is None:
+            return keyCols, False
+        sql.append('AND (%s) %s (%s)' % (
+            ','.join(dbkeys), '<' if sort[0][1] == -1 else '>',
+            ','.join(['%s'] * len(values))))
+        sqlval.extend(values)
+        return keyCols, True
+
+    def uniqueSort(self, sort):
+        """
+        Check if a sort order gives every row a distinct position.  This is
+        true if the last key is _id or if it is the default sort, since the
+        random shuffle keys are effectively unique.
+
+        :param sort: the sort order of the query.
+        :returns: True if the sort is unique.
+        """
+        if not sort:
+            return False
+        return (sort[-1][0] == '_id' or dataencode.cursorSort(sort) ==
+                dataencode.cursorSort(self.defaultSort))
+
+    def findModifiers(self, sort, limit, offset, sql, queryToDbKeys={},
+                      sqlval=None):
         """
         Add sort, limit, and offsets to the sql query.
 
@@ -513,6 +1352,9 @@ class ViaPostgres():
         :param sql: list of sql phrases.  Modified.
         :param queryToDbKeys: a map to convert query parameters to database
                               parameters.
+        :param sqlval: if not None, a list of sql values to escape.  The limit
+                       and offset are added as values so that they don't
+                       change the shape of the query.  Modified.
         """
         if sort:
             sql.append('ORDER BY')
@@ -531,12 +1373,17 @@ class ViaPostgres():
                 sql.append(','.join(sorts))
             else:
                 sql[-1:] = []
-        if limit:
-            sql.append('LIMIT %d' % limit)
-        if offset:
-            sql.append('OFFSET %d' % offset)
+        for key, value in (('LIMIT', limit), ('OFFSET', offset)):
+            if not value:
+                continue
+            if sqlval is None:
+                sql.append('%s %d' % (key, value))
+            else:
+                sql.append(key + ' %s')
+                sqlval.append(int(value))
 
-    def findQuery(self, result, params, sql, sqlval, client=None):
+    def findQuery(self, result, params, sql, sqlval, client=None,
+                  named=False, timeout=0, prepare=True):
         """
         Perform the find query with a retry loop.
 
@@ -545,41 +1392,67 @@ class ViaPostgres():
         :param sql: sql to execute.
         :param sqlval: values to pass to sql execute.
         :param client: client for database access.
+        :param named: if True, use a named server-side cursor for the query.
+        :param timeout: the statement timeout in milliseconds, or 0 for none.
+        :param prepare: False to not run the query as a prepared statement.
+                        See executeQuery.
         :returns: the database connection and the database cursor with the
-                  query results.
+                  query results.  If a realtime query has no new data, the
+                  result's data is set to an empty list and both are None.
+                  If the query exceeds the timeout, the result's data is set
+                  to an empty list, its error, timedout, and elapsed values
+                  are set, and both are None.
         """
+        querytime = time.time()
+        if params.get('_id_max', None):
+            result['nextId'] = params['_id_max']
+        elif self.queryBase == 'message' and self.realtime:
+            try:
+                maxId = self.highWaterMark(client)
+            except psycopg2.Error as exc:
+                logger.info('Database error %s', str(exc).strip())
+                cherrypy.response.status = 500
+                return None, None
+            # We use this to guarantee that we don't get newer data than what
+            # we first saw.
+            result['nextId'] = maxId + 1 if maxId else 0
+            if str(result['nextId']) == params.get('_id_min', None):
+                result['data'] = []
+                return None, None
+            # The where clause is the first part of the query with
+            # parameters, so this parameter goes first.
+            sql = sql.replace(' WHERE true', ' WHERE _id<%s')
+            sqlval = [result['nextId']] + list(sqlval)
         maxretry = 3
         for retry in xrange(maxretry):
             db = None
             try:
-                db = self.connect(retry != 0, client)
+                # Replicas can lag, so realtime queries, which are bounded by
+                # the newest id, use the primary database.
+                db = self.connect(retry != 0, client, self.realtime)
                 c = db.cursor()
-                if params.get('_id_max', None):
-                    result['nextId'] = params['_id_max']
-                elif self.queryBase == 'message' and self.realtime:
-                    c.execute('SELECT max(_id) + 1 FROM %s' % self.tableName)
-                    row = c.fetchone()
-                    # We use this to guarantee that we don't get newer data than
-                    # what we first saw.
-                    result['nextId'] = row[0] if row[0] else 0
-                    if str(result['nextId']) == params.get('_id_min', None):
-                        result['data'] = []
-                        c.close()
-                        return db, None
-                    sql = sql.replace(' WHERE true', ' WHERE _id<%s' % str(
-                        result['nextId']))
-                logger.info('Query: %s', c.mogrify(sql, sqlval))
-                c.execute(sql, sqlval)
+                if named:
+                    # A named cursor can only run one query, so any other
+                    # queries use the plain cursor first.
+                    c.close()
+                    c = db.cursor(name='geoapp_%d' % next(ServerCursorCounter))
+                c.itersize = getattr(self, 'sourceConfig', {}).get(
+                    'itersize', PostgresFetchSize)
+                self.executeQuery(
+                    db, c, sql, sqlval, named, timeout, prepare)
                 break
             except psycopg2.Error as exc:
                 if db:
                     self.disconnect(db, client)
-                try:
-                    code = psycopg2.errorcodes.lookup(exc.pgcode)
-                except KeyError:
-                    code = '%s' % exc.pgcode
+                code = errorCode(exc)
                 logger.info('Database error %s - %s', str(exc).strip(), code)
-                if retry + 1 == maxretry or code == 'QUERY_CANCELED':
+                if code == 'STATEMENT_TIMEOUT':
+                    result.update({
+                        'data': [], 'error': code, 'timedout': True,
+                        'elapsed': round(time.time() - querytime, 3)})
+                    return None, None
+                if (retry + 1 == maxretry or code == 'QUERY_CANCELED' or
+                        isinstance(exc, datapool.PoolTimeoutError)):
                     cherrypy.response.status = 500
                     return None, None
         return db, c
@@ -602,6 +1475,181 @@ class ViaPostgres():
             dbToQueryKeys = geoapp.MsgToInstKeyTable
         return queryToDbKeys, dbToQueryKeys
 
+    def histogram(self, params={}, bin='day', datefield=None, sums=None,
+                  **kwargs):
+        """
+        Count the rows that match a query in date bins.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param bin: the bin size.  One of hour, day, week, or month.
+        :param datefield: the date field used for binning.
+        :param sums: an optional list of numeric fields to total in each bin.
+        :param queryBase: a string used to ensure we are using keys appropriate
+                          to the asking query and to underlying database.
+        :param whereClauses: a list of extra where clauses that are anded to
+                             any other where clauses.
+        :returns: a dictionary of results in list format.  Each row is the
+                  start of the bin in epoch milliseconds, the number of rows
+                  in the bin, and then the total of each of the sums fields.
+        """
+        client = params.get('clientid', '').strip()
+        if not client:
+            client = None
+        starttime = time.time()
+        sums = sums or []
+        queryToDbKeys, dbToQueryKeys = self.getKeyTables(
+            kwargs.get('queryBase', None))
+        dbdatefield = queryToDbKeys.get(datefield, datefield)
+        if dbdatefield is None:
+            return None
+        dbsums = [queryToDbKeys.get(field, field) for field in sums]
+        sql, sqlval = self.histogramRollup(
+            params, bin, dbdatefield, dbsums, dbToQueryKeys, **kwargs)
+        if sql is None:
+            sql = ['SELECT', self.histogramBinSql(dbdatefield, bin),
+                   ',count(*)']
+            for dbfield in dbsums:
+                sql.append(',sum(%s)::float8' % dbfield if dbfield else
+                           ',NULL')
+            self.findFrom(params, sql, sqlval, dbToQueryKeys, **kwargs)
+        sql.append('GROUP BY 1 ORDER BY 1')
+        sql = ' '.join(sql)
+        fields = ['date', 'count'] + [field + '_sum' for field in sums]
+        result = {
+            'format': 'list',
+            'fields': fields,
+            'columns': {fields[col]: col for col in xrange(len(fields))},
+            'bin': bin,
+            'datefield': datefield,
+        }
+        # Planning is a small part of the cost of an aggregation, so it isn't
+        # worth holding a prepared statement for each histogram shape.
+        db, c = self.findQuery(result, params, sql, sqlval, client,
+                               timeout=self.queryTimeout('histogram'),
+                               prepare=False)
+        if not db and 'data' not in result:
+            return
+        if not c:
+            if db:
+                self.disconnect(db, client)
+            return result
+        result['data'] = list(self.findRows(db, c, client, starttime, result))
+        return result
+
+    def histogramBinSql(self, field, bin):
+        """
+        Get the sql expression that computes the start of a date bin in epoch
+        milliseconds.  Bins are in UTC and weeks start on Sunday, matching the
+        bins the client uses.
+
+        :param field: the database name of the date field.
+        :param bin: the bin size.  One of hour, day, week, or month.
+        :returns: an sql expression.
+        """
+        if self.useMilliseconds is True:
+            seconds = '%s / 1000.0' % field
+        elif self.useMilliseconds:
+            seconds = '%s / 1000.0 + %d' % (field, self.useMilliseconds)
+        else:
+            seconds = field
+        timestamp = 'to_timestamp(%s) AT TIME ZONE \'UTC\'' % seconds
+        if bin == 'week':
+            trunc = ('date_trunc(\'week\', %s + interval \'1 day\') - '
+                     'interval \'1 day\'' % timestamp)
+        else:
+            trunc = 'date_trunc(\'%s\', %s)' % (bin, timestamp)
+        return '(extract(epoch FROM %s) * 1000)::bigint' % trunc
+
+    def histogramRollup(self, params, bin, datefield, sums, dbToQueryKeys={},
+                        **kwargs):
+        """
+        Start the sql for a histogram that is computed from the rollup table.
+        This is only possible if the rollup table has all of the sums, the
+        query is only restricted on the rollup's dimensions and on whole hours
+        of its date field, and the source isn't realtime, since realtime
+        results are limited to the rows up to the high-water mark.
+
+        :param params: a dictionary of query restrictions.
+        :param bin: the bin size.
+        :param datefield: the database name of the date field.
+        :param sums: a list of the database names of the fields to total.
+        :param dbToQueryKeys: a map to convert database parameters to query
+                              parameters.
+        :param whereClauses: a list of extra where clauses.
+        :returns: a list of sql statement fragments through the where clauses,
+                  or None if the rollup table can't be used.
+        :returns: a list of sql values to escape.
+        """
+        rollup = self.rollup
+        if (not rollup or self.realtime or self.useMilliseconds or
+                datefield != rollup['datefield']):
+            return None, []
+        # The rollup only counts rows that have its required field, which
+        # must be exactly what the where clauses ask for.
+        where = (['%s is not NULL' % rollup['required']]
+                 if rollup.get('required') else [])
+        if list(kwargs.get('whereClauses') or []) != where:
+            return None, []
+        columns = self.tableColumns(rollup['table'])
+        if not columns or [field for field in sums
+                           if field and field + '_sum' not in columns]:
+            return None, []
+        fieldTable = {field: self.fieldTable[field] for field in (
+            [datefield] + rollup['dimensions']) if field in self.fieldTable}
+        for field in self.fieldTable:
+            for suffix in ('', '_min', '_max', '_search'):
+                value = params.get((dbToQueryKeys.get(field) or field) +
+                                   suffix, params.get(field + suffix))
+                if value is None or (field in rollup['dimensions'] and
+                                     not suffix):
+                    continue
+                if (field != datefield or suffix not in ('_min', '_max') or
+                        self.dateToDb(value) % datarollup.RollupInterval):
+                    return None, []
+        sql = ['SELECT', self.histogramBinSql(datefield, bin),
+               ',sum(count)::bigint']
+        for field in sums:
+            sql.append(',sum(%s_sum)::float8' % field if field else ',NULL')
+        sql.append('FROM %s WHERE true' % rollup['table'])
+        sqlval = []
+        self.params_to_sql(params, sql, sqlval, dbToQueryKeys, fieldTable)
+        return sql, sqlval
+
+    def highWaterMark(self, client=None, maxAge=None):
+        """
+        Get the largest _id in the table.  This is tracked in process, so the
+        database is only asked when the tracked value is older than allowed.
+
+        :param client: the clientid to use if a database connection is needed.
+        :param maxAge: the maximum age in seconds of the tracked value.  None
+                       to use the source's 'hwmmaxage' setting.
+        :returns: the largest _id, or None if the table is empty.  A
+                  psycopg2.Error is raised if the database can't be read.
+        """
+        if maxAge is None:
+            maxAge = getattr(self, 'sourceConfig', {}).get(
+                'hwmmaxage', PostgresHighWaterMaxAge)
+        if self.listener is not None and self.listener.connected:
+            maxAge *= PostgresHighWaterListenFactor
+        mark = datanotify.highWaterMark(self.notifyKey())
+        value, refresh = mark.current(maxAge)
+        if not refresh:
+            return value
+        success = False
+        try:
+            db = self.connect(client=client, primary=True)
+            try:
+                c = db.cursor()
+                c.execute('SELECT max(_id) FROM %s' % self.tableName)
+                value = c.fetchone()[0]
+                c.close()
+            finally:
+                self.disconnect(db, client)
+            success = True
+        finally:
+            mark.update(value, success)
+        return value
+
     def ingestTwitter(self, db, c, data, ingestFrom=None, nodup=False):
         """
         Injest an object from Twitter.
@@ -612,7 +1660,8 @@ class ViaPostgres():
         :param ingestFrom: optional name of the ingest source.
         :param nodup: if True, make some effort to avoid duplciates.  This
                       relies on distinct msg_id values.
-        :return: True if the data was ingested, false otherwise.
+        :return: the _id of the new record if the data was ingested, False
+                 otherwise.
         """
         if 'timestamp_ms' in data:
             date = int(data['timestamp_ms'])
@@ -659,9 +1708,45 @@ class ViaPostgres():
                 data['entities']['urls'][0]['display_url'])
         if ingestFrom:
             item['ingest_source'] = ingestFrom
-        return insertItemIntoPostgres(db, c, item, nodup)
+        newId = insertItemIntoPostgres(db, c, item, nodup)
+        if newId:
+            datanotify.highWaterMark(self.notifyKey()).advance(newId)
+        return newId
+
+    def listenForData(self, callback):
+        """
+        Listen for notifications that other processes have added data to the
+        table.  While the listener is connected, the table's high-water mark
+        is only read from the database after the listener reconnects.
+
+        :param callback: a function that is passed the payload of each
+                         notification after the high-water mark is updated.
+                         See dataAdded.
+        """
+        self.listener = datalisten.getListener(self.dbparams)
+        self.listener.listen(datalisten.channelName(self.tableName), callback)
 
-    def params_to_sql(self, params, sql, sqlval, altkeys={}):
+    def notifyIngested(self, db, firstId, lastId):
+        """
+        Tell listening servers that data has been added to the table.
+
+        :param db: the database connection used to add the data.
+        :param firstId: the smallest _id of the added rows.
+        :param lastId: the largest _id of the added rows.
+        """
+        datalisten.notifyIngested(db, self.tableName, firstId, lastId)
+
+    def notifyKey(self):
+        """
+        Get a key that identifies the database table used by this object.
+        This is used to signal that new data is available.
+
+        :returns: a hashable key.
+        """
+        return ('postgres', ) + tuple(self.dbparams.get(key) for key in (
+            'host', 'port', 'database', 'dsn')) + (self.tableName, )
+
+    def params_to_sql(self, params, sql, sqlval, altkeys={}, fieldTable=None):
         """
         Convert params to sql.
 
@@ -672,8 +1757,11 @@ class ViaPostgres():
                         a database key name, and the values are the query key
                         names.  This can be used to convert db parameters to
                         query parameters.
+        :param fieldTable: the fields that can be restricted.  None for all of
+                           the fields of the table.
         """
-        for field in self.fieldTable:
+        bounds = {}
+        for field in (fieldTable or self.fieldTable):
             for comp, suffix in [('=', ''), ('>=', '_min'), ('<', '_max'),
                                  ('search', '_search')]:
                 if (altkeys.get(field, None) is not None and
@@ -689,23 +1777,23 @@ class ViaPostgres():
                         continue
                     if isinstance(value, (int, float, long)):
                         value = str(value)
-                    subsql, subvalues = tsquerySearch(field, value)
+                    vector = self.searchVector(field)
+                    subsql, subvalues = querycache.memoize(
+                        querycache.SearchCache, ('postgres', field, vector,
+                                                 value),
+                        tsquerySearch, field, value, vector)
                     sql.append('AND ' + subsql)
                     sqlval.extend(subvalues)
                 elif dtype == 'date':
-                    value = int((dateutil.parser.parse(value) - self.epoch)
-                                .total_seconds())
-                    if self.useMilliseconds is True:
-                        value *= 1000
-                    elif self.useMilliseconds:
-                        value = (value - self.useMilliseconds) * 1000
-                    sql.append('AND ' + field + comp + '%d' % value)
+                    sql.append('AND ' + field + comp + '%s')
+                    sqlval.append(self.dateToDb(value))
                 elif dtype in ('int', 'bigint'):
-                    value = int(value)
-                    sql.append('AND ' + field + comp + '%d' % value)
+                    sql.append('AND ' + field + comp + '%s')
+                    sqlval.append(int(value))
                 elif dtype == 'float':
-                    value = float(value)
-                    sql.append('AND ' + field + comp + '%f' % value)
+                    sql.append('AND ' + field + comp + '%s')
+                    sqlval.append(float(value))
+                    bounds.setdefault(field, {})[suffix] = float(value)
                 elif dtype == 'commalist' and ',' in str(value) and not suffix:
                     value = str(value).split(',')
                     sql.append('AND ' + field + ' IN (%s' +
@@ -715,3 +1803,129 @@ class ViaPostgres():
                     value = str(value)
                     sql.append('AND ' + field + comp + '%s')
                     sqlval.append(value)
+        self.spatialKeySql(bounds, sql, sqlval)
+
+    def queryTimeout(self, method):
+        """
+        Get the statement timeout for the queries of an access method.  The
+        source's "timeout" configuration value is either a number of seconds
+        or a dictionary of seconds by method name, with an optional 'default'
+        entry.
+
+        :param method: the name of the access method, such as find,
+                       histogram, densityGrid, or export.
+        :returns: the timeout in milliseconds, or 0 for no timeout.
+        """
+        timeout = getattr(self, 'sourceConfig', {}).get(
+            'timeout', PostgresStatementTimeout)
+        if isinstance(timeout, dict):
+            timeout = timeout.get(method, timeout.get(
+                'default', PostgresStatementTimeout))
+        return int(float(timeout or 0) * 1000)
+
+    def searchVector(self, field):
+        """
+        Get the stored tsvector column of a search field.
+
+        :param field: the name of the search field in the database.
+        :returns: the name of the column, or None if there isn't one.
+        """
+        column = field + PostgresSearchVectorSuffix
+        return column if self.tableColumns().get(column) == 'tsvector' else None
+
+    def spatialKeySql(self, bounds, sql, sqlval):
+        """
+        Add a where clause that limits a location to a bounding box using the
+        index of its Z-order key.  This is in addition to the clauses on the
+        latitude and longitude, since the key ranges include some locations
+        outside of the box.
+
+        :param bounds: a dictionary whose keys are fields in the database and
+                       whose values are dictionaries that may contain '_min'
+                       and '_max' values.
+        :param sql: a list of sql statement fragments.  Modified.
+        :param sqlval: a list of sql values to escape.  Modified.
+        """
+        for lat, lon, key in self.spatialKeys:
+            limits = [bounds.get(field, {}).get(suffix) for field in (lon, lat)
+                      for suffix in ('_min', '_max')]
+            if None in limits or self.tableColumns().get(key) != 'bigint':
+                continue
+            ranges = datagrid.zorderRanges(
+                limits[0], limits[2], limits[1], limits[3])
+            sql.append('AND (' + ' OR '.join(
+                [key + ' BETWEEN %s AND %s'] * len(ranges)) + ')')
+            for first, last in ranges:
+                sqlval.extend([first, last])
+
+    def tableColumns(self, tableName=None):
+        """
+        Get the columns of a table.  These are looked up once.
+
+        :param tableName: the name of the table.  None for this object's
+                          table.
+        :returns: a dictionary of column names and their data types.  This is
+                  empty if the columns couldn't be determined.
+        """
+        tableName = tableName or self.tableName
+        if tableName not in self.columns:
+            try:
+                db = self.connect()
+                try:
+                    c = db.cursor()
+                    c.execute(
+                        'SELECT column_name, data_type FROM '
+                        'information_schema.columns WHERE table_name = %s '
+                        'AND table_schema = ANY (current_schemas(false))',
+                        (tableName, ))
+                    self.columns[tableName] = dict(c.fetchall())
+                    c.close()
+                finally:
+                    self.disconnect(db)
+            except psycopg2.Error as exc:
+                logger.info('Database error %s', str(exc).strip())
+                return {}
+        return self.columns[tableName]
+
+    def tablePartitions(self):
+        """
+        Get the monthly child tables of the table.  These are looked up again
+        every PostgresPartitionCheckTime seconds, since months can be attached
+        while the server is running.
+
+        :returns: a list of (name, start, end) tuples, where start and end are
+                  the range of the partition field in the database's units,
+                  end exclusive.  This is empty if the table isn't
+                  partitioned or its children couldn't be determined.
+        """
+        if (self.partitions is None or time.time() - self.partitionsChecked >
+                PostgresPartitionCheckTime):
+            try:
+                db = self.connect()
+                try:
+                    c = db.cursor()
+                    c.execute(
+                        'SELECT relname FROM pg_inherits JOIN pg_class ON '
+                        'pg_class.oid = inhrelid WHERE inhparent = '
+                        '%s::regclass', (self.tableName, ))
+                    names = [row[0] for row in c.fetchall()]
+                    c.close()
+                finally:
+                    self.disconnect(db)
+            except psycopg2.Error as exc:
+                logger.info('Database error %s', str(exc).strip())
+                return []
+            pattern = re.compile('^%s_p(\\d{4})(\\d{2})$' % re.escape(
+                self.tableName))
+            partitions = []
+            for name in sorted(names):
+                match = pattern.match(name)
+                if match:
+                    year, month = int(match.group(1)), int(match.group(2))
+                    start = calendar.timegm((year, month, 1, 0, 0, 0))
+                    end = start + calendar.monthrange(year, month)[1] * 86400
+                    partitions.append((name, self.epochToDb(start),
+                                       self.epochToDb(end)))
+            self.partitions = partitions
+            self.partitionsChecked = time.time()
+        return self.partitions
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains the description of rollup tables, which hold the number
+# of rows and the totals of some numeric columns for each hour and each
+# combination of a few low-cardinality columns.  Date histograms can be
+# computed from a rollup table instead of the rows themselves.  The loaders
+# and the ingest path add to them, so the functions here don't depend on
+# the rest of the server.
+
+# The rollup tables have one row per this many seconds.  The date column of a
+# rollup table holds the start of the hour in epoch seconds.
+RollupInterval = 3600
+
+# Each rollup has:
+#   table: the name of the rollup table.
+#   datefield: the date column that is rolled up.  The rollup table uses the
+#       same name for the start of the hour.
+#   dimensions: the columns that rows are grouped by.  Missing values are
+#       stored as empty strings.
+#   sums: the numeric columns that are totaled.  The rollup table names each
+#       total (column)_sum.
+#   required: if set, only rows where this column is not null are counted.
+TripsRollup = {
+    'table': 'trips_rollup',
+    'datefield': 'pickup_datetime',
+    'dimensions': ['region', 'service', 'ingest_source', 'payment_type'],
+    'sums': ['passenger_count', 'trip_distance', 'fare_amount', 'tip_amount',
+             'tolls_amount', 'total_amount'],
+}
+MessagesRollup = {
+    'table': 'messages_rollup',
+    'datefield': 'msg_date',
+    'dimensions': ['region', 'service', 'ingest_source'],
+    'sums': [],
+    'required': 'latitude',
+}
+
+
+def rollupAdd(rollup, rows, item):
+    """
+    Add an item to a dictionary of rollup rows.
+
+    :param rollup: the rollup description.
+    :param rows: a dictionary whose keys are tuples of the start of the hour
+                 and the dimension values and whose values are lists of the
+                 count and the totals.  Modified.
+    :param item: a dictionary with the values of a row.
+    """
+    row = rollupRow(rollup, item)
+    if row is None:
+        return
+    key = tuple(row[:len(rollup['dimensions']) + 1])
+    values = row[len(key):]
+    if key not in rows:
+        rows[key] = values
+        return
+    totals = rows[key]
+    totals[0] += values[0]
+    for idx in xrange(1, len(values)):
+        if values[idx] is not None:
+            totals[idx] = values[idx] + (totals[idx] or 0)
+
+
+def rollupColumns(rollup):
+    """
+    Get the columns of a rollup table.
+
+    :param rollup: the rollup description.
+    :returns: a list of column names in table order.
+    """
+    return ([rollup['datefield']] + rollup['dimensions'] + ['count'] +
+            [field + '_sum' for field in rollup['sums']])
+
+
+def rollupCopySql(rollup, rows):
+    """
+    Get the sql that adds rows to a rollup table, creating the table if
+    necessary.  The rows are copied into a temporary table and then merged.
+
+    :param rollup: the rollup description.
+    :param rows: a dictionary of rows.  See rollupAdd.
+    :returns: the sql.
+    """
+    table = rollup['table']
+    sql = [rollupTableSql(rollup), '\nCREATE TEMPORARY TABLE %s_load '
+           '(LIKE %s);\nCOPY %s_load (%s) FROM stdin;\n' % (
+               table, table, table, ','.join(rollupColumns(rollup)))]
+    for key in sorted(rows):
+        sql.append('\t'.join([
+            '\\N' if col is None else unicode(col).replace('\\', '\\\\')
+            .replace('\t', ' ').replace('\n', ' ').replace('\r', ' ')
+            for col in list(key) + rows[key]]) + '\n')
+    sql.append('\\.\n')
+    sql.append(rollupMergeSql(rollup, 'SELECT * FROM %s_load' % table) +
+               ';\n')
+    sql.append('DROP TABLE %s_load;\n' % table)
+    return ''.join(sql)
+
+
+def rollupMergeSql(rollup, source):
+    """
+    Get the sql that adds rows to a rollup table.  Existing rows are
+    incremented, and other rows are inserted.
+
+    :param rollup: the rollup description.
+    :param source: a query that returns the rollup columns in table order,
+                   such as a VALUES list.
+    :returns: the sql statement.
+    """
+    table = rollup['table']
+    keys = [rollup['datefield']] + rollup['dimensions']
+    match = ' AND '.join(['r.%s = l.%s' % (key, key) for key in keys])
+    updates = ['count = r.count + l.count'] + [
+        '%s_sum = coalesce(r.%s_sum + l.%s_sum, r.%s_sum, l.%s_sum)' % (
+            (field, ) * 5) for field in rollup['sums']]
+    columns = ','.join(rollupColumns(rollup))
+    return (
+        'WITH l (%s) AS (%s), updated AS (UPDATE %s AS r SET %s FROM l '
+        'WHERE %s) INSERT INTO %s (%s) SELECT * FROM l WHERE NOT EXISTS '
+        '(SELECT 1 FROM %s AS r WHERE %s)' % (
+            columns, source, table, ', '.join(updates), match, table,
+            columns, table, match))
+
+
+def rollupRow(rollup, item):
+    """
+    Get the rollup row of a single item.
+
+    :param rollup: the rollup description.
+    :param item: a dictionary with the values of a row.
+    :returns: a list of the start of the hour, the dimension values, a count
+              of 1, and the values of the sums fields, or None if the item
+              isn't counted.
+    """
+    if rollup.get('required') and item.get(rollup['required']) is None:
+        return None
+    try:
+        date = int(float(item[rollup['datefield']]))
+    except (KeyError, TypeError, ValueError):
+        return None
+    row = [date - date % RollupInterval]
+    for field in rollup['dimensions']:
+        value = item.get(field)
+        row.append(unicode(value) if value is not None else u'')
+    row.append(1)
+    for field in rollup['sums']:
+        try:
+            row.append(float(item[field]))
+        except (KeyError, TypeError, ValueError):
+            row.append(None)
+    return row
+
+
+def rollupValues(rollup):
+    """
+    Get a source for rollupMergeSql with a single row whose values are sql
+    parameters, such as from rollupRow.
+
+    :param rollup: the rollup description.
+    :returns: the VALUES list.
+    """
+    return 'VALUES (%s)' % ','.join(
+        ['%s::int'] + ['%s::text'] * len(rollup['dimensions']) +
+        ['%s::bigint'] + ['%s::float8'] * len(rollup['sums']))
+
+
+def rollupTableSql(rollup):
+    """
+    Get the sql that creates a rollup table if it doesn't exist.
+
+    :param rollup: the rollup description.
+    :returns: the sql.
+    """
+    keys = [rollup['datefield']] + rollup['dimensions']
+    columns = (['%s int NOT NULL' % rollup['datefield']] +
+               ['%s text NOT NULL' % field for field in rollup['dimensions']] +
+               ['count bigint NOT NULL'] +
+               ['%s_sum double precision' % field for field in rollup['sums']])
+    return 'CREATE TABLE IF NOT EXISTS %s (\n    %s,\n    UNIQUE (%s)\n);\n' % (
+        rollup['table'], ',\n    '.join(columns), ', '.join(keys))
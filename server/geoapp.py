@@ -20,6 +20,7 @@
 # This file exposes endpoints to get taxi and other geoapp data.
 
 import base64
+import calendar
 import cherrypy
 import collections
 import datetime
@@ -30,9 +31,11 @@ import json
 import pymongo
 import random
 import re
+import threading
 import time
 import urllib
 import urllib2
+import uuid
 
 import girder.api.rest
 from girder import logger
@@ -42,7 +45,14 @@ from girder.api.describe import Description
 from girder.api.rest import RestException
 
 import dataelasticsearch
+import dataencode
+import datagrid
+import datalisten
+import datapool
+import datanotify
 import datapostgres
+import datarollup
+import querycache
 
 
 GeoappUser = {
@@ -91,6 +101,12 @@ TaxiFieldTableRand = collections.OrderedDict(TaxiFieldTable.items() + [
     ('_id',               ('bigint', 'Ingest Order')),
 ])
 
+# The Z-order key columns of the pickup and dropoff locations in Postgres.
+TaxiSpatialKeys = [
+    ('pickup_latitude', 'pickup_longitude', 'pickup_zkey'),
+    ('dropoff_latitude', 'dropoff_longitude', 'dropoff_zkey'),
+]
+
 
 class TaxiViaMongo():
 
@@ -119,6 +135,9 @@ class TaxiViaMongo():
     }
     RevTable = {v: k for k, v in KeyTable.items()}
 
+    # True if dates are stored as epoch milliseconds rather than as dates.
+    datesInMilliseconds = False
+
     def __init__(self, dbUri=None, **params):
         self.dbUri = dbUri
         db_connection = self.getDbConnection()
@@ -193,6 +212,72 @@ class TaxiViaMongo():
         ]}
         return result
 
+    def keysetQuery(self, sort, values):
+        """
+        Get a query that selects the rows that follow a particular row in a
+        sort order.
+
+        :param sort: a list of tuples of the form (database key, direction).
+        :param values: the values of the sort keys of the row.
+        :returns: a mongo query.
+        """
+        clauses = []
+        for pos in xrange(len(sort)):
+            clause = {sort[idx][0]: values[idx] for idx in xrange(pos)}
+            clause[sort[pos][0]] = {
+                '$lt' if sort[pos][1] == -1 else '$gt': values[pos]}
+            clauses.append(clause)
+        return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+    def densityGrid(self, params={}, latfield='pickup_latitude',
+                    lonfield='pickup_longitude', grid=None, **kwargs):
+        """
+        Count the trips that match a query in the cells of a spatial grid using
+        a $group aggregation.  Only latitude and longitude grids are
+        supported.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param latfield: the latitude field used for binning.
+        :param lonfield: the longitude field used for binning.
+        :param grid: a grid description from datagrid.makeGrid.
+        :returns: a dictionary of results in list format.  Each row is the
+                  column, row, and number of trips for a cell.  Empty cells are
+                  omitted.
+        """
+        if grid['mercator']:
+            return {'error': 'Web mercator grids are not supported for this '
+                    'database.'}
+        query, _, _ = self.processParams(params, None, [latfield])
+        lat = self.KeyTable.get(latfield, latfield)
+        lon = self.KeyTable.get(lonfield, lonfield)
+        query = {'$and': [query, {
+            lon: {'$gte': grid['west'], '$lt': grid['east']},
+            lat: {'$gt': grid['south'], '$lte': grid['north']},
+        }]}
+        colExpr = {'$divide': [{'$subtract': ['$' + lon, grid['left']]},
+                               grid['dx']]}
+        rowExpr = {'$divide': [{'$subtract': [grid['top'], '$' + lat]},
+                               grid['dy']]}
+        pipeline = [{'$match': query}, {'$group': {
+            '_id': {
+                'c': {'$subtract': [colExpr, {'$mod': [colExpr, 1]}]},
+                'r': {'$subtract': [rowExpr, {'$mod': [rowExpr, 1]}]},
+            },
+            'count': {'$sum': 1},
+        }}]
+        logger.info('Query %r', (pipeline, ))
+        res = self.trips.aggregate(pipeline, allowDiskUse=True)
+        # Older versions of pymongo return a dictionary rather than a cursor
+        res = res['result'] if isinstance(res, dict) else list(res)
+        fields = ['col', 'row', 'count']
+        return {
+            'format': 'list',
+            'fields': fields,
+            'columns': {fields[col]: col for col in xrange(len(fields))},
+            'data': [[int(row['_id']['c']), int(row['_id']['r']),
+                      row['count']] for row in res],
+        }
+
     def getDbConnection(self):
         """
         Connect to local mongo database named 'taxi' or to the specified
@@ -222,6 +307,66 @@ class TaxiViaMongo():
             return dateutil.parser.parse(value)
         return value
 
+    def histogram(self, params={}, bin='day', datefield=None, sums=None,
+                  **kwargs):
+        """
+        Count the trips that match a query in date bins using a $group
+        aggregation.
+
+        :param params: a dictionary of query restrictions.  See find.
+        :param bin: the bin size.  One of hour, day, week, or month.
+        :param datefield: the date field used for binning.
+        :param sums: an optional list of numeric fields to total in each bin.
+        :returns: a dictionary of results in list format.  Each row is the
+                  start of the bin in epoch milliseconds, the number of trips
+                  in the bin, and then the total of each of the sums fields.
+        """
+        sums = [field for field in (sums or []) if field in TaxiFieldTable]
+        query, _, _ = self.processParams(params, None, [datefield])
+        date = '$' + self.KeyTable.get(datefield, datefield)
+        epoch = datetime.datetime.utcfromtimestamp(0)
+        if self.datesInMilliseconds:
+            ms, date = date, {'$add': [epoch, date]}
+        else:
+            ms = {'$subtract': [date, epoch]}
+        if bin == 'month':
+            binId = {'y': {'$year': date}, 'm': {'$month': date}}
+        else:
+            interval, offset = {
+                'hour': (3600000, 0),
+                'day': (86400000, 0),
+                # The epoch is a Thursday; weeks start on Sunday.
+                'week': (604800000, 259200000),
+            }[bin]
+            binId = {'$subtract': [ms, {'$mod': [
+                {'$subtract': [ms, offset]}, interval]}]}
+        group = {'_id': binId, 'count': {'$sum': 1}}
+        for pos, field in enumerate(sums):
+            group['sum%d' % pos] = {
+                '$sum': '$' + self.KeyTable.get(field, field)}
+        pipeline = [{'$match': query}, {'$group': group}]
+        logger.info('Query %r', (pipeline, ))
+        res = self.trips.aggregate(pipeline, allowDiskUse=True)
+        # Older versions of pymongo return a dictionary rather than a cursor
+        res = res['result'] if isinstance(res, dict) else list(res)
+        data = []
+        for row in res:
+            if bin == 'month':
+                row['_id'] = calendar.timegm(datetime.datetime(
+                    row['_id']['y'], row['_id']['m'], 1).utctimetuple()) * 1000
+            data.append([row['_id'], row['count']] + [
+                row.get('sum%d' % pos) for pos in xrange(len(sums))])
+        data.sort()
+        fields = ['date', 'count'] + [field + '_sum' for field in sums]
+        return {
+            'format': 'list',
+            'fields': fields,
+            'columns': {fields[col]: col for col in xrange(len(fields))},
+            'bin': bin,
+            'datefield': datefield,
+            'data': data,
+        }
+
 
 class TaxiViaMongoCompact(TaxiViaMongo):
 
@@ -250,6 +395,8 @@ class TaxiViaMongoCompact(TaxiViaMongo):
     }
     RevTable = {v: k for k, v in KeyTable.items()}
 
+    datesInMilliseconds = True
+
     epoch = datetime.datetime.utcfromtimestamp(0)
 
     def find(self, params={}, limit=50, offset=0, sort=None, fields=None,
@@ -270,9 +417,26 @@ class TaxiViaMongoCompact(TaxiViaMongo):
         :param allowUnsorted: if true, and the entire data set will be returned
                               (rather than being restricted by limit), then
                               return the data unsorted.
-        :returns: a dictionary of results.
+        :param cursor: a decoded cursor from a previous page of results.  If
+                       it is for the same sort, the query resumes after the
+                       last row of that page and the offset is ignored.
+        :returns: a dictionary of results, including a 'cursor' for the next
+                  page if the query is sorted.
         """
+        if sort and sort[-1][0] != '_id':
+            # A cursor resumes after the sort keys of the last row, so _id
+            # breaks ties to keep rows with the same keys from being skipped.
+            sort = list(sort) + [('_id', sort[-1][1])]
+        querySort = sort
         query, sort, mfields = self.processParams(params, sort, fields)
+        values = dataencode.cursorValues(kwargs.get('cursor'), querySort)
+        if values is not None:
+            query = {'$and': [query, self.keysetQuery(sort, values)]}
+            offset = 0
+        if sort:
+            # Return the sort keys so that we can make a cursor for the next
+            # page.
+            mfields.update({key: 1 for key, dir in sort})
         logger.info('Query %r', ((query, offset, limit, sort, mfields), ))
         cursor = None
         if not offset and sort is not None and allowUnsorted:
@@ -289,23 +453,28 @@ class TaxiViaMongoCompact(TaxiViaMongo):
                                      manipulate=False, slave_okay=True,
                                      compile_re=False)
             total = cursor.count()
+        result = {'count': total}
+        rows = cursor
+        if sort:
+            rows = dataencode.trackCursor(
+                cursor, result, querySort,
+                lambda row: [row.get(key) for key, dir in sort])
         if fields:
             columns = {fields[col]: col for col in xrange(len(fields))}
             mcol = [self.KeyTable.get(fields[col], fields[col])
                     for col in xrange(len(fields))]
-            result = {
-                'count': total,
+            result.update({
                 'format': 'list',
                 'fields': fields,
                 'columns': columns,
-                'data': [[row[k] for k in mcol] for row in cursor]
-            }
+                'data': [[row[k] for k in mcol] for row in rows]
+            })
         else:
-            result = {'count': total, 'data': [{
+            result['data'] = [{
                 self.RevTable.get(k, k): v for k, v in row.items()
                 if k != '_id'}
-                for row in cursor
-            ]}
+                for row in rows
+            ]
         return result
 
     def getParamValue(self, field, value):
@@ -397,6 +566,8 @@ class TaxiViaPostgres(datapostgres.ViaPostgres):
         self.fieldTable = TaxiFieldTable
         self.tableName = 'trips'
         self.queryBase = 'taxi'
+        self.spatialKeys = TaxiSpatialKeys
+        self.partitionField = 'pickup_datetime'
 
 
 class TaxiViaPostgresSeconds(TaxiViaPostgres):
@@ -417,6 +588,9 @@ class TaxiViaPostgresRandom(datapostgres.ViaPostgres):
         self.fieldTable = TaxiFieldTableRand
         self.tableName = 'trips'
         self.queryBase = 'taxirandom'
+        self.spatialKeys = TaxiSpatialKeys
+        self.partitionField = 'pickup_datetime'
+        self.rollup = datarollup.TripsRollup
         self.defaultSort = [('rand1', 1), ('rand2', 1)]
 
 
@@ -449,6 +623,7 @@ class InstagramViaPostgres(datapostgres.ViaPostgres):
         self.tableName = 'instagram'
         self.alwaysUseIdSort = False
         self.queryBase = 'instagram'
+        self.partitionField = 'posted_date'
 
 
 # -------- Message classes and code --------
@@ -512,6 +687,8 @@ class MessageViaPostgres(datapostgres.ViaPostgres):
         self.defaultSort = [('rand1', 1), ('rand2', 1)]
         self.decoder = HTMLParser.HTMLParser()
         self.queryBase = 'message'
+        self.partitionField = 'msg_date'
+        self.rollup = datarollup.MessagesRollup
 
 
 class RealTimeViaPostgres(MessageViaPostgres):
@@ -668,6 +845,90 @@ class DataViaMongo():
 
 # -------- General classes and code --------
 
+# Endpoint parameters that don't affect the results of a find query.
+ResultCacheIgnoredParams = ('clientid', 'initwait', 'parallel', 'poll',
+                            'wait')
+# The largest encoded result that is shared between identical concurrent
+# queries when the result cache is disabled.
+ResultShareMaxBytes = 256 * 1024 * 1024
+# Bin sizes that can be used for date histograms.
+HistogramBins = ('hour', 'day', 'week', 'month')
+# The maximum number of cells in a density grid.
+GridMaxCells = 1024 * 1024
+# The locations that can be used for density grids of each type of data.  The
+# first location is the default.
+TaxiGridLocations = collections.OrderedDict([
+    ('pickup', ('pickup_latitude', 'pickup_longitude')),
+    ('dropoff', ('dropoff_latitude', 'dropoff_longitude')),
+])
+MessageGridLocations = collections.OrderedDict([
+    ('message', ('latitude', 'longitude')),
+    ('last', ('last_latitude', 'last_longitude')),
+])
+InstagramGridLocations = collections.OrderedDict([
+    ('message', ('latitude', 'longitude')),
+])
+# The default maximum number of points in a data tile.
+DataTileMaxPoints = 10000
+# The default zoom level at which data tiles include every point.  Each zoom
+# level out from this includes a quarter as many points, using the rand1
+# shuffle so that the sample is consistent between tiles and zoom levels.
+DataTileFullZoom = 16
+# The default size in pixels of a cell in an aggregated data tile.
+DataTileCellSize = 8
+# When a request that is waiting for data is woken by a notification, wait
+# this long in seconds before querying so that a burst of ingested data is
+# picked up by one query.
+NotifySettleTime = 0.25
+# The default duration in seconds of an event stream.  Clients reconnect
+# automatically, resuming from the last event they received, so this only
+# limits how long a server thread is held by one connection.
+StreamDefaultDuration = 600
+# Each event stream holds a server thread, so the duration of a stream and the
+# number of concurrent streams per source are limited.  Sources can override
+# these with "streammaxduration" and "maxstreams".
+StreamMaxDuration = 3600
+StreamMaxPerSource = 4
+# The formats supported by export endpoints and their content types.
+ExportFormats = collections.OrderedDict([
+    ('csv', 'text/csv'),
+    ('tsv', 'text/tab-separated-values'),
+])
+# The maximum number of new rows sent in one event stream update.  If there
+# are more new rows than this, the client is told to reset its stream.
+StreamUpdateLimit = 10000
+
+
+def exportDescription(desc, fieldTable, defaultDbKey):
+    """
+    Generate a description for an export endpoint that automatically adds all
+    the fields from a field table.
+
+    :param desc: the primary description of this endpoint.
+    :param fieldTable: an ordered dictionary with the fields that can be used.
+    :param defaultDbKey: the default database source.
+    :returns: the generated Description object.
+    """
+    description = (
+        Description(desc)
+        .notes('Only Postgres sources support exports.  The data is sent as '
+               'it is read from the database, so it is not sorted.  Dates are '
+               'in epoch milliseconds.')
+        .param('source', 'Database source (default %s).' % defaultDbKey,
+               required=False)
+        .param('format', 'The format of the export (default csv).  Both '
+               'formats include a header row.', required=False,
+               enum=list(ExportFormats))
+        .param('fields', 'A comma-separated list of fields to export '
+               '(default is all fields).', required=False)
+        .param('limit', 'The maximum number of rows to export (default is '
+               'all rows).', required=False, dataType='int')
+        .param('clientid', 'A string to use for a client id.  If specified '
+               'there is an extant query to this end point from the same '
+               'clientid, the extant query will be cancelled.', required=False))
+    return fieldParamsDescription(description, fieldTable)
+
+
 def findGeneralDescription(desc, sortKey, fieldTable, defaultDbKey):
     """
     Generate a description for a find endpoint that automatically adds all the
@@ -694,7 +955,18 @@ def findGeneralDescription(desc, sortKey, fieldTable, defaultDbKey):
         .param('fields', 'A comma-separated list of fields to return '
                '(default is all fields).', required=False)
         .param('format', 'The format to return the data (default is '
-               'list).', required=False, enum=['list', 'dict'])
+               'list).  columnar returns a binary payload with a JSON header '
+               'followed by one packed little-endian array per field.',
+               required=False, enum=['list', 'dict', 'columnar'])
+        .param('parallel', 'For sources that support it, split a large '
+               'query into up to this many ranges of the first sort key that '
+               'are queried concurrently (default is the source\'s parallel '
+               'setting).', required=False, dataType='int')
+        .param('cursor', 'The cursor returned with the previous page of '
+               'results.  Sources that support cursors resume after the last '
+               'row of that page, which is faster than using an offset; '
+               'other sources use the offset, so it should still be sent.',
+               required=False)
         .param('clientid', 'A string to use for a client id.  If specified '
                'there is an extant query to this end point from the same '
                'clientid, the extant query will be cancelled.', required=False)
@@ -708,6 +980,18 @@ def findGeneralDescription(desc, sortKey, fieldTable, defaultDbKey):
                'starting to poll for more data.  This is not counted as part '
                'of the wait duration (default=0).', required=False,
                dataType='float', default=0))
+    return fieldParamsDescription(description, fieldTable)
+
+
+def fieldParamsDescription(description, fieldTable):
+    """
+    Add the parameters that filter on each field of a field table to a
+    description.
+
+    :param description: the Description object.  Modified.
+    :param fieldTable: an ordered dictionary with the fields that can be used.
+    :returns: the Description object.
+    """
     for field in sorted(fieldTable):
         (fieldType, fieldDesc) = fieldTable[field]
         dataType = fieldType
@@ -728,6 +1012,125 @@ def findGeneralDescription(desc, sortKey, fieldTable, defaultDbKey):
     return description
 
 
+def gridDescription(desc, fieldTable, defaultDbKey, locations):
+    """
+    Generate a description for a density grid endpoint that automatically
+    adds all the fields from a field table.
+
+    :param desc: the primary description of this endpoint.
+    :param fieldTable: an ordered dictionary with the fields that can be used.
+    :param defaultDbKey: the default database source.
+    :param locations: an ordered dictionary of the locations that can be
+                      binned.
+    :returns: the generated Description object.
+    """
+    description = (
+        Description(desc)
+        .notes('The result is in list format with fields of col, row, and '
+               'count.  Column 0 is the west edge and row 0 is the north edge '
+               'of the bounding box.  Empty cells are omitted.  The grid '
+               'value of the result describes the grid.  If zoom is '
+               'specified, the grid is in web mercator pixels; otherwise it '
+               'is evenly spaced in latitude and longitude.')
+        .param('source', 'Database source (default %s).' % defaultDbKey,
+               required=False)
+        .param('bbox', 'The bounding box of the grid as a comma-separated '
+               'list of longitude, latitude, longitude, latitude of opposite '
+               'corners.', required=True)
+        .param('location', 'The location to bin (default %s).' % (
+               locations.keys()[0], ), required=False,
+               enum=locations.keys())
+        .param('cols', 'The number of columns in a latitude and longitude '
+               'grid (default 256).', required=False, dataType='int')
+        .param('rows', 'The number of rows in a latitude and longitude grid '
+               '(default 256).', required=False, dataType='int')
+        .param('zoom', 'If specified, use a web mercator grid at this zoom '
+               'level.', required=False, dataType='int')
+        .param('cellsize', 'The size of a web mercator grid cell in pixels '
+               '(default 1).', required=False, dataType='int')
+        .param('clientid', 'A string to use for a client id.  If specified '
+               'there is an extant query to this end point from the same '
+               'clientid, the extant query will be cancelled.', required=False))
+    return fieldParamsDescription(description, fieldTable)
+
+
+def tileDescription(desc, fieldTable, defaultDbKey, locations):
+    """
+    Generate a description for a data tile endpoint that automatically adds
+    all the fields from a field table.
+
+    :param desc: the primary description of this endpoint.
+    :param fieldTable: an ordered dictionary with the fields that can be used.
+    :param defaultDbKey: the default database source.
+    :param locations: an ordered dictionary of the locations that can be used
+                      to select data.
+    :returns: the generated Description object.
+    """
+    description = (
+        Description(desc)
+        .notes('Tiles use the standard web mercator z/x/y numbering.  In '
+               'points mode, the result is the same as the find endpoint '
+               'restricted to the tile.  Below fullzoom, points are sampled '
+               'using the rand1 shuffle, keeping a quarter as many points per '
+               'zoom level.  In grid mode, the result is the same as the grid '
+               'endpoint for the tile at its zoom level.')
+        .param('z', 'The zoom level of the tile.', paramType='path',
+               required=True, dataType='int')
+        .param('x', 'The column of the tile.', paramType='path',
+               required=True, dataType='int')
+        .param('y', 'The row of the tile.', paramType='path', required=True,
+               dataType='int')
+        .param('source', 'Database source (default %s).' % defaultDbKey,
+               required=False)
+        .param('mode', 'Whether to return points or aggregated grid cells '
+               '(default points).', required=False, enum=['points', 'grid'])
+        .param('location', 'The location used to select data (default %s).' %
+               (locations.keys()[0], ), required=False, enum=locations.keys())
+        .param('limit', 'The maximum number of points (default %d).' %
+               DataTileMaxPoints, required=False, dataType='int')
+        .param('fullzoom', 'The zoom level at which all points are returned '
+               '(default %d).' % DataTileFullZoom, required=False,
+               dataType='int')
+        .param('cellsize', 'The size of a grid cell in pixels (default %d).' %
+               DataTileCellSize, required=False, dataType='int')
+        .param('fields', 'A comma-separated list of fields to return '
+               '(default is all fields).', required=False)
+        .param('format', 'The format to return points (default is list).',
+               required=False, enum=['list', 'dict', 'columnar']))
+    return fieldParamsDescription(description, fieldTable)
+
+
+def histogramDescription(desc, fieldTable, defaultDbKey, defaultDateField):
+    """
+    Generate a description for a histogram endpoint that automatically adds
+    all the fields from a field table.
+
+    :param desc: the primary description of this endpoint.
+    :param fieldTable: an ordered dictionary with the fields that can be used.
+    :param defaultDbKey: the default database source.
+    :param defaultDateField: the default field used for binning.
+    :returns: the generated Description object.
+    """
+    description = (
+        Description(desc)
+        .notes('The result is in list format with fields of date (the start '
+               'of each bin in epoch milliseconds), count, and the total of '
+               'each of the sums fields (named (field)_sum).  Bins are in UTC '
+               'and weeks start on Sunday.  Empty bins are omitted.')
+        .param('source', 'Database source (default %s).' % defaultDbKey,
+               required=False)
+        .param('bin', 'The size of each bin (default day).', required=False,
+               enum=list(HistogramBins))
+        .param('datefield', 'The date field to bin (default %s).' % (
+               defaultDateField, ), required=False)
+        .param('sums', 'A comma-separated list of numeric fields to total in '
+               'each bin.', required=False)
+        .param('clientid', 'A string to use for a client id.  If specified '
+               'there is an extant query to this end point from the same '
+               'clientid, the extant query will be cancelled.', required=False))
+    return fieldParamsDescription(description, fieldTable)
+
+
 def wrap_findData(cls, datainfo):
     """
     Wrap findData with specific access information.
@@ -749,14 +1152,31 @@ class GeoAppResource(girder.api.rest.Resource):
     def __init__(self):
         self.resourceName = 'geoapp'
         self.route('POST', ('ingest', ), self.ingestMessages)
+        self.route('POST', ('notify', ), self.notifyData)
         self.route('GET', ('instagram', ), self.findInstagram)
+        self.route('GET', ('instagram', 'export'), self.exportInstagram)
+        self.route('GET', ('instagram', 'grid'), self.gridInstagram)
+        self.route('GET', ('instagram', 'histogram'), self.histogramInstagram)
         self.route('GET', ('intents', ), self.getIntents)
         self.route('GET', ('message', ), self.findMessage)
+        self.route('GET', ('message', 'export'), self.exportMessage)
+        self.route('GET', ('message', 'grid'), self.gridMessage)
+        self.route('GET', ('message', 'histogram'), self.histogramMessage)
+        self.route('GET', ('message', 'stream'), self.streamMessage)
         self.route('PUT', ('reporttest', ), self.storeTestResults)
         self.route('PUT', ('reporttest', ':id'), self.updateTestResults)
+        self.route('GET', ('stats', ), self.getStats)
         self.route('GET', ('taxi', ), self.findTaxi)
+        self.route('GET', ('taxi', 'export'), self.exportTaxi)
+        self.route('GET', ('taxi', 'grid'), self.gridTaxi)
+        self.route('GET', ('taxi', 'histogram'), self.histogramTaxi)
         self.route('GET', ('tiles', 'blank', ':wc1', ':wc2', ':wc3'),
                    self.blankTiles)
+        self.route('GET', ('tiles', 'instagram', ':z', ':x', ':y'),
+                   self.instagramTiles)
+        self.route('GET', ('tiles', 'message', ':z', ':x', ':y'),
+                   self.messageTiles)
+        self.route('GET', ('tiles', 'taxi', ':z', ':x', ':y'), self.taxiTiles)
         self.route('GET', ('tiles', ':tilename', ':wc1', ':wc2', ':wc3'),
                    self.gridTiles)
         config = girder.utility.config.getConfig()
@@ -803,8 +1223,15 @@ class GeoAppResource(girder.api.rest.Resource):
                     continue
                 if db['class'] in globals():
                     accessDict[key] = (globals()[db['class']],
-                                       db.get('params', {}))
+                                       db.get('params', {}), db)
             setattr(self, attrKey, accessDict)
+        self.resultCache = self.createResultCache(config)
+        self.queryCoalescer = querycache.QueryCoalescer()
+        self.dataNotifier = datanotify.DataNotifier()
+        # The open event streams of each source, each with the time by which
+        # it will have ended.
+        self.streams = {}
+        self.streamsLock = threading.Lock()
 
     def findGeneral(self, params, sortKey, fieldTable, accessList,
                     defaultDbKey, **kwargs):
@@ -827,78 +1254,492 @@ class GeoAppResource(girder.api.rest.Resource):
         fields = params.get('fields', '').replace(',', ' ').strip().split()
         if not fields or not len(fields):
             fields = fieldTable.keys()
-        accessObj = accessList[params.get('source', defaultDbKey)]
-        if isinstance(accessObj, tuple):
-            accessObj = accessObj[0](**accessObj[1])
-            accessList[params.get('source', defaultDbKey)] = accessObj
-        wait = params.get('wait', None)
-        wait = None if not wait or wait <= 0 else float(wait)
-        poll = params.get('poll', None)
-        poll = 10 if not poll or poll <= 0 else float(poll)
-        initwait = params.get('initwait', None)
-        initwait = None if not initwait or initwait <= 0 else float(initwait)
+        source = params.get('source', defaultDbKey)
+        accessObj = self.getAccessObject(accessList, source)
+        notifyKey = self.notifyKey(accessObj)
+        wait, poll, initwait = self.getWaitParameters(params)
         kwargs['wait'] = wait
         kwargs['poll'] = poll
         kwargs['initwait'] = initwait
+        kwargs['cursor'] = self.getCursorParameter(params)
+        kwargs['parallel'] = self.getParallelParameter(params, accessObj)
+        # Backends that support it can return their rows as an iterator rather
+        # than a list.  We need to be able to count the rows when waiting for
+        # data, so only stream when we aren't waiting.
+        kwargs['stream'] = not wait
+        outputFormat = params.get('format', 'list')
+        cherrypy.response.headers['Content-Type'] = dataencode.contentType(
+            outputFormat)
+        # A new request from a client supersedes any queries it was waiting
+        # on.  Shared queries are only cancelled if no one else is waiting.
+        self.queryCoalescer.release(params.get('clientid', '').strip())
+        cacheKey, cacheTTL = self.resultCacheKey(
+            accessObj, source, params, fields, sort, limit, offset, **kwargs)
+        cached = self.resultCache.get(cacheKey) if cacheTTL else None
+        if cached is not None:
+            def cachedResultFunc():
+                yield cached[1]
+            cherrypy.response.headers['Content-Type'] = cached[0]
+            return cachedResultFunc
 
         def resultFunc():
-            if wait and initwait:
-                time.sleep(initwait)
-                yield ' '
-            starttime = time.time()
-            while True:
-                result = accessObj.find(
-                    params, limit, offset, sort, fields, **kwargs)
+            entry, shared, queryParams = self.joinSharedQuery(
+                cacheKey, accessObj, params)
+            if shared is not None:
+                yield shared[1]
+                return
+            if queryParams is None:
+                # Superseded, as if our query had been cancelled.
+                cherrypy.response.status = 500
+                return
+            # If the query fails or our client goes away, requests waiting on
+            # this query run their own.  Finishing a shared query that has
+            # already finished does nothing.
+            try:
+                if wait and initwait:
+                    time.sleep(initwait)
+                    yield ' '
+                starttime = time.time()
+                while True:
+                    version = self.dataNotifier.version(notifyKey)
+                    result = accessObj.find(
+                        queryParams, limit, offset, sort, fields, **kwargs)
+                    if result is None:
+                        # This error code may not get to the client because we
+                        # are using a generator function
+                        cherrypy.response.status = 500
+                        raise StopIteration
+                    curtime = time.time()
+                    if (not wait or not isinstance(result.get('data'), list) or
+                            len(result['data']) or curtime >= starttime + wait):
+                        break
+                    # Keep alive that should have no ill-effect on the json
+                    # output
+                    yield ' '
+                    self.waitForData(notifyKey, version, max(
+                        min(poll, starttime + wait - curtime), poll * 0.5))
+                    yield ' '
+                    if '_id_min' in params and 'nextId' in result:
+                        params['_id_min'] = result['nextId']
+                result['limit'] = limit
+                result['offset'] = offset
+                result['sort'] = sort
+                encoder = dataencode.encodeResult(
+                    result, outputFormat, fields, fieldTable)
+                if cacheKey:
+                    encoder = self.resultShare(
+                        encoder, result, cacheKey, cacheTTL,
+                        dataencode.contentType(outputFormat), entry)
+                for chunk in encoder:
+                    yield chunk
+            finally:
+                self.queryCoalescer.finish(entry, None)
+
+        return resultFunc
+
+    def aggregateGeneral(self, params, accessList, defaultDbKey, method,
+                         resultInfo=None, **kwargs):
+        """
+        Perform a database aggregation, such as a histogram, for a general
+        endpoint.  Results are cached and shared between identical concurrent
+        requests in the same way as find results.
+
+        :param params: the parameters of the endpoint call.
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param defaultDbKey: the default database source.  Used with the
+                             accessList.
+        :param method: the name of the access object method that performs the
+                       aggregation.  This is passed params and kwargs and
+                       returns a result dictionary in list format or None on
+                       failure.
+        :param resultInfo: an optional dictionary of values to add to the
+                           result.
+        :returns: a function that yields the encoded response.
+        """
+        source = params.get('source', defaultDbKey)
+        if source not in accessList:
+            raise RestException('Unknown source %s.' % source)
+        accessObj = self.getAccessObject(accessList, source)
+        if not hasattr(accessObj, method):
+            raise RestException('The %s source does not support %s.' % (
+                source, method))
+        kwargs['aggregate'] = method
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        cacheKey, cacheTTL = self.resultCacheKey(
+            accessObj, source, params, (), None, 0, 0, **kwargs)
+        cached = self.resultCache.get(cacheKey) if cacheTTL else None
+
+        def resultFunc():
+            if cached is not None:
+                yield cached[1]
+                return
+            entry, shared, queryParams = self.joinSharedQuery(
+                cacheKey, accessObj, params)
+            if shared is not None:
+                yield shared[1]
+                return
+            if queryParams is None:
+                cherrypy.response.status = 500
+                return
+            # See findGeneral.
+            try:
+                result = getattr(accessObj, method)(queryParams, **kwargs)
                 if result is None:
-                    # This error code may not get to the client because we are
-                    # using a generator function
                     cherrypy.response.status = 500
-                    raise StopIteration
-                result['datacount'] = len(result.get('data', []))
-                curtime = time.time()
-                if (not wait or result['datacount'] or
-                        curtime >= starttime + wait):
-                    break
-                # Keep alive that should have no ill-effect on the json output
-                yield ' '
-                time.sleep(max(min(poll, starttime + wait - curtime),
-                               poll * 0.5))
-                yield ' '
-                if '_id_min' in params and 'nextId' in result:
-                    params['_id_min'] = result['nextId']
-            result['limit'] = limit
-            result['offset'] = offset
-            result['sort'] = sort
-            if (params.get('format', 'list') == 'list' and
-                    result.get('format', '') != 'list'):
-                result['fields'] = fields
-                result['columns'] = {fields[col]: col
-                                     for col in xrange(len(fields))}
-                if 'data' in result:
-                    result['data'] = [
-                        [row.get(field, None) for field in fields]
-                        for row in result['data']
-                    ]
-                result['format'] = 'list'
-            elif (params.get('format', 'list') != 'list' and
-                    result.get('format', '') == 'list'):
-                if 'data' in result:
-                    result['data'] = [{
-                        result['fields'][col]: row[col] for col
-                        in xrange(len(row))} for row in result['data']]
-                result['format'] = 'dict'
-                del result['columns']
-            # We could let Girder convert the results into JSON, but it is
-            # marginally faster to dump the JSON ourselves, since we can
-            # exclude sorting and reduce whitespace
-            # return result
-            yield json.dumps(
-                result, check_circular=False, separators=(',', ':'),
-                sort_keys=False, default=str)
+                    return
+                result.update(resultInfo or {})
+                encoder = dataencode.encodeResult(
+                    result, 'list', result.get('fields', []))
+                if cacheKey:
+                    encoder = self.resultShare(
+                        encoder, result, cacheKey, cacheTTL,
+                        'application/json', entry)
+                for chunk in encoder:
+                    yield chunk
+            finally:
+                self.queryCoalescer.finish(entry, None)
 
-        cherrypy.response.headers['Content-Type'] = 'application/json'
         return resultFunc
 
+    def dataTiles(self, params, z, x, y, sortKey, fieldTable, accessList,
+                  defaultDbKey, locations, **kwargs):
+        """
+        Get the data in a web mercator tile for a general data tile endpoint.
+        Points are returned using findGeneral and aggregated cells using
+        gridGeneral, so tiles are cached and shared the same way.
+
+        :param params: the parameters of the endpoint call.
+        :param z: the zoom level of the tile.
+        :param x: the column of the tile.
+        :param y: the row of the tile.
+        :param sortKey: the default sortKey for point queries.
+        :param fieldTable: an ordered dictionary with the fields that can be
+                           used.
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param defaultDbKey: the default database source.
+        :param locations: an ordered dictionary of the locations that can be
+                          used to select data.  Each value is a tuple of the
+                          latitude and longitude fields.
+        :returns: a function that yields the encoded response.
+        """
+        try:
+            z, x, y = int(z), int(x), int(y)
+        except ValueError:
+            raise RestException('z, x, and y must be integers.')
+        if not 0 <= z <= 30 or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            raise RestException('Invalid tile.')
+        source = params.get('source', defaultDbKey)
+        if source not in accessList:
+            raise RestException('Unknown source %s.' % source)
+        location = params.get('location', locations.keys()[0])
+        if location not in locations:
+            raise RestException('location must be one of %s.' % ', '.join(
+                locations.keys()))
+        west, south, east, north = datagrid.tileBounds(z, x, y)
+        params = {key: value for key, value in params.iteritems()
+                  if key not in ('wait', 'poll', 'initwait')}
+        self.tileCacheHeaders(self.getAccessObject(accessList, source))
+        if params.get('mode', 'points') == 'grid':
+            params['bbox'] = '%r,%r,%r,%r' % (west, south, east, north)
+            params['zoom'] = str(z)
+            params.setdefault('cellsize', DataTileCellSize)
+            return self.gridGeneral(
+                params, fieldTable, accessList, defaultDbKey, locations,
+                **kwargs)
+        latfield, lonfield = locations[location]
+        for field, low, high in ((latfield, south, north),
+                                 (lonfield, west, east)):
+            params[field + '_min'] = max(
+                float(params.get(field + '_min', low)), low)
+            params[field + '_max'] = min(
+                float(params.get(field + '_max', high)), high)
+        fullzoom = int(params.get('fullzoom', DataTileFullZoom))
+        if 'rand1' in fieldTable and z < fullzoom:
+            threshold = int(1000000000 * 0.25 ** (fullzoom - z))
+            params['rand1_max'] = min(
+                int(params.get('rand1_max', threshold)), threshold)
+        if 'rand1' in fieldTable:
+            params.setdefault('sort', 'rand1')
+        params.setdefault('limit', DataTileMaxPoints)
+        return self.findGeneral(
+            params, sortKey, fieldTable, accessList, defaultDbKey, **kwargs)
+
+    def createResultCache(self, config):
+        """
+        Create the cache used for find results based on the querycache section
+        of the config file.
+
+        :param config: the server configuration.
+        :returns: a cache object, or None if caching is disabled.
+        """
+        cacheConfig = config.get('querycache', {})
+        if not cacheConfig.get('maxbytes'):
+            return None
+        return querycache.LRUCache(
+            cacheConfig['maxbytes'], cacheConfig.get('ttl', 300),
+            lambda value: len(value[1]))
+
+    def dataIngested(self, accessObj, payload=None):
+        """
+        Handle a notification that another process has added data to a
+        database.  Requests waiting for data are woken, and cached results
+        from sources that read the same data are discarded.
+
+        :param accessObj: the access object of the database.
+        :param payload: information about the added data from the
+                        notification, or None if there isn't any.
+        """
+        if hasattr(accessObj, 'dataAdded'):
+            accessObj.dataAdded(payload)
+        notifyKey = self.notifyKey(accessObj)
+        self.dataNotifier.notify(notifyKey)
+        if self.resultCache:
+            sources = set(
+                source for accessList in (self.instagramAccess, self.taxiAccess)
+                for source, obj in accessList.items()
+                if not isinstance(obj, tuple) and
+                self.notifyKey(obj) == notifyKey)
+            self.resultCache.invalidate(lambda key: key[0] in sources)
+
+    def getAccessObject(self, accessList, source):
+        """
+        Get the access object for a database source, creating it if it
+        hasn't been used before.
+
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param source: the key of the database source in the accessList.
+        :returns: the access object.
+        """
+        accessObj = accessList[source]
+        if isinstance(accessObj, tuple):
+            accessClass, accessParams, sourceConfig = accessObj
+            accessObj = accessClass(**accessParams)
+            # Keep the configuration of the source (such as cache durations)
+            # with the access object.
+            accessObj.sourceConfig = sourceConfig
+            accessList[source] = accessObj
+            if sourceConfig.get('listen') and hasattr(
+                    accessObj, 'listenForData'):
+                accessObj.listenForData(functools.partial(
+                    self.dataIngested, accessObj))
+        return accessObj
+
+    def joinSharedQuery(self, cacheKey, accessObj, params):
+        """
+        Join an identical query that is already in progress, or register this
+        query so that later identical queries can share its result.
+
+        :param cacheKey: the key of the query from resultCacheKey.  If None,
+                         the query is not shared.
+        :param accessObj: the access object that will perform the query.
+        :param params: the parameters of the endpoint call.
+        :returns: a tuple of the coalescer entry if this request should run
+                  the query and share its result, otherwise None; the content
+                  type and encoded result of another request's query, or None
+                  if this request must run the query itself; and the
+                  parameters to use for the query, or None if a newer request
+                  from the same client superseded this one while it waited.
+                  A shared query uses its own client id so that it is only
+                  cancelled when every request waiting on it has been
+                  released.
+        """
+        if not cacheKey:
+            return None, None, params
+        client = params.get('clientid', '').strip() or None
+        entry, leader = self.queryCoalescer.join(
+            cacheKey, client, getattr(accessObj, 'cancelClient', None))
+        if leader:
+            queryParams = params.copy()
+            queryParams['clientid'] = entry['id']
+            return entry, None, queryParams
+        # If the shared query fails or is too large to share, we run our own
+        # query without sharing it, so a failing query isn't repeated by every
+        # waiting request in turn.
+        shared, released = self.queryCoalescer.wait(entry, client)
+        return None, shared, params if not released else None
+
+    def resultCacheKey(self, accessObj, source, params, fields, sort, limit,
+                       offset, **kwargs):
+        """
+        Determine if the results of a find query can be shared with identical
+        concurrent queries or cached, and, if so, get a key to identify the
+        query.  Queries that wait for data are never shared or cached.
+        Results from realtime sources are shared but never cached.
+
+        :param accessObj: the access object that will perform the query.
+        :param source: the key of the database source.
+        :param params: the parameters of the endpoint call.
+        :param fields: the list of fields that will be returned.
+        :param sort: the sort of the query.
+        :param limit: the limit of the query.
+        :param offset: the offset of the query.
+        :param **kwargs: additional arguments that will be passed to the
+                         access object's find method.
+        :returns: a tuple of the key, or None if the results should not be
+                  shared or cached, and the duration in seconds that the
+                  result is valid in the cache, or None if the result should
+                  not be cached.
+        """
+        if kwargs.get('wait'):
+            return None, None
+        ttl = None
+        if self.resultCache and not getattr(accessObj, 'realtime', False):
+            ttl = getattr(accessObj, 'sourceConfig', {}).get(
+                'cachettl', self.resultCache.ttl) or None
+        key = (
+            source,
+            kwargs.get('queryBase'),
+            tuple(sorted((k, v) for k, v in params.iteritems()
+                         if k not in ResultCacheIgnoredParams)),
+            tuple(fields),
+            repr(sort),
+            limit,
+            offset,
+            tuple(kwargs.get('whereClauses') or ()),
+            kwargs.get('aggregate'),
+        )
+        return key, ttl
+
+    def resultShare(self, chunks, result, cacheKey, cacheTTL, contentType,
+                    entry=None):
+        """
+        Pass through the encoded chunks of a result, keeping a copy.  When
+        the result is complete, add it to the result cache and hand it to any
+        requests that are waiting on the same query.  Results that are larger
+        than the cache and results where an error occurred while reading the
+        data are not stored or shared.
+
+        :param chunks: an iterable of encoded strings.
+        :param result: the result dictionary that is being encoded.
+        :param cacheKey: the key to use in the result cache.
+        :param cacheTTL: the duration in seconds that the result is valid, or
+                         None to not cache the result.
+        :param contentType: the content type of the encoded result.
+        :param entry: the query coalescer entry to finish, or None.
+        :yields: the encoded strings.
+        """
+        maxSize = (self.resultCache.maxSize if self.resultCache else
+                   ResultShareMaxBytes)
+        captured = []
+        capturedSize = 0
+        value = None
+        try:
+            for chunk in chunks:
+                if captured is not None:
+                    capturedSize += len(chunk)
+                    if capturedSize > maxSize:
+                        captured = None
+                    else:
+                        captured.append(chunk)
+                yield chunk
+            if captured is not None and 'error' not in result:
+                value = (contentType, ''.join(captured))
+                if cacheTTL:
+                    self.resultCache.set(cacheKey, value, cacheTTL)
+        finally:
+            # If our client went away before we finished, waiting requests
+            # will run the query themselves.
+            self.queryCoalescer.finish(entry, value)
+
+    def tileCacheHeaders(self, accessObj):
+        """
+        Set the response headers that let clients and proxies cache a data
+        tile.  Tiles from realtime sources are not cached.
+
+        :param accessObj: the access object that will perform the query.
+        """
+        ttl = getattr(accessObj, 'sourceConfig', {}).get(
+            'cachettl', self.resultCache.ttl if self.resultCache else None)
+        if getattr(accessObj, 'realtime', False) or not ttl:
+            cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        else:
+            cherrypy.response.headers['Cache-Control'] = (
+                'public, max-age=%d' % ttl)
+
+    def notifyKey(self, accessObj):
+        """
+        Get the key used to signal that an access object has new data.
+        Access objects that read the same database table share a key.
+
+        :param accessObj: the access object.
+        :returns: a hashable key.
+        """
+        if hasattr(accessObj, 'notifyKey'):
+            return accessObj.notifyKey()
+        return id(accessObj)
+
+    def waitForData(self, notifyKey, version, timeout):
+        """
+        Wait until new data is ingested or a timeout expires.  Not all data
+        sources send notifications, so the timeout should be the polling
+        interval.
+
+        :param notifyKey: the key from notifyKey.
+        :param version: the data version from before the last query.
+        :param timeout: the maximum duration in seconds to wait.
+        :returns: True if new data was ingested.
+        """
+        if self.dataNotifier.wait(notifyKey, version, timeout):
+            time.sleep(NotifySettleTime)
+            return True
+        return False
+
+    def getCursorParameter(self, params):
+        """
+        Get the decoded cursor from the parameters of a find endpoint.
+
+        :param params: the parameters of the endpoint call.
+        :returns: the decoded cursor, or None if no cursor was specified.
+        """
+        if not params.get('cursor'):
+            return None
+        try:
+            return dataencode.decodeCursor(params['cursor'])
+        except ValueError:
+            raise RestException('Invalid cursor.')
+
+    def getParallelParameter(self, params, accessObj):
+        """
+        Get the number of concurrent queries that a find may be split into.
+
+        :param params: the parameters of the endpoint call.
+        :param accessObj: the access object that will perform the query.  The
+                          source's 'parallel' configuration value is the
+                          default.
+        :returns: the number of concurrent queries, or None.
+        """
+        parallel = params.get('parallel', getattr(
+            accessObj, 'sourceConfig', {}).get('parallel'))
+        if not parallel:
+            return None
+        try:
+            return int(parallel)
+        except ValueError:
+            raise RestException('parallel must be an integer.')
+
+    def getWaitParameters(self, params):
+        """
+        Get the parameters that control waiting for data from a find
+        endpoint.
+
+        :param params: the parameters of the endpoint call.
+        :returns: wait: the maximum duration in seconds to wait for data, or
+                  None to not wait.
+        :returns: poll: the interval in seconds between checking for data.
+        :returns: initwait: the initial delay in seconds before checking for
+                  data, or None for no delay.
+        """
+        wait = params.get('wait', None)
+        wait = None if not wait or wait <= 0 else float(wait)
+        poll = params.get('poll', None)
+        poll = 10 if not poll or poll <= 0 else float(poll)
+        initwait = params.get('initwait', None)
+        initwait = None if not initwait or initwait <= 0 else float(initwait)
+        return wait, poll, initwait
+
     def getUserAndFolder(self):
         """
         Get the geoapp user and test results folder.  If the geoapp user,
@@ -957,6 +1798,86 @@ class GeoAppResource(girder.api.rest.Resource):
             }
         return metadata
 
+    def exportGeneral(self, params, fieldTable, accessList, defaultDbKey,
+                      **kwargs):
+        """
+        Export data in bulk for a general export endpoint.
+
+        :param params: the parameters of the endpoint call.
+        :param fieldTable: an ordered dictionary with the fields that can be
+                           used.
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param defaultDbKey: the default database source.  Used with the
+                             accessList.
+        :returns: a function that yields the exported data.
+        """
+        source = params.get('source', defaultDbKey)
+        if source not in accessList:
+            raise RestException('Unknown source %s.' % source)
+        accessObj = self.getAccessObject(accessList, source)
+        if not hasattr(accessObj, 'export'):
+            raise RestException('The %s source does not support exports.' % (
+                source, ))
+        outputFormat = params.get('format', 'csv')
+        if outputFormat not in ExportFormats:
+            raise RestException('format must be one of %s.' % ', '.join(
+                ExportFormats))
+        fields = params.get('fields', '').replace(',', ' ').strip().split()
+        for field in fields:
+            if field not in fieldTable:
+                raise RestException('Unknown field %s.' % field)
+        try:
+            limit = int(params.get('limit', 0))
+        except ValueError:
+            raise RestException('limit must be an integer.')
+        cherrypy.response.headers['Content-Type'] = ExportFormats[outputFormat]
+        cherrypy.response.headers['Content-Disposition'] = (
+            'attachment; filename="%s.%s"' % (
+                kwargs.get('queryBase', 'export'), outputFormat))
+
+        rows = accessObj.export(
+            params, fields or None, outputFormat, limit, **kwargs)
+        if rows is None:
+            raise RestException('Failed to connect to the database.', code=500)
+
+        def resultFunc():
+            for chunk in rows:
+                yield chunk
+
+        return resultFunc
+
+    @access.public
+    def exportInstagram(self, params):
+        return self.exportGeneral(
+            params, InstagramFieldTable, self.instagramAccess, 'postgres',
+            queryBase='instagram')
+    exportInstagram.description = exportDescription(
+        'Export instagram data.', InstagramFieldTable, 'postgres')
+
+    @access.public
+    def exportMessage(self, params):
+        where = []
+        if not self.boolParam('nullgeo', params, default=False):
+            where.append('latitude is not NULL')
+        return self.exportGeneral(
+            params, MessageFieldTable, self.instagramAccess, 'rtmsg',
+            queryBase='message', whereClauses=where)
+    exportMessage.description = (
+        exportDescription(
+            'Export message data.', MessageFieldTable, 'rtmsg')
+        .param('nullgeo', 'Include messages without latitude and longitude '
+               '(default=false).', required=False, dataType='boolean',
+               default=False))
+
+    @access.public
+    def exportTaxi(self, params):
+        return self.exportGeneral(
+            params, TaxiFieldTableRand, self.taxiAccess, 'mongo',
+            queryBase='taxi')
+    exportTaxi.description = exportDescription(
+        'Export taxi data.', TaxiFieldTableRand, 'mongo')
+
     @access.public
     def findData(self, params={}, datainfo={}):
         return self.findGeneral(
@@ -997,28 +1918,167 @@ class GeoAppResource(girder.api.rest.Resource):
         'Get a set of taxi data.', 'pickup_datetime', TaxiFieldTableRand,
         'mongo')
 
+    def gridGeneral(self, params, fieldTable, accessList, defaultDbKey,
+                    locations, **kwargs):
+        """
+        Count the results of a database search in the cells of a spatial grid
+        for a general density grid endpoint.
+
+        :param params: the parameters of the endpoint call.
+        :param fieldTable: an ordered dictionary with the fields that can be
+                           used.
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param defaultDbKey: the default database source.
+        :param locations: an ordered dictionary of the locations that can be
+                          binned.  Each value is a tuple of the latitude and
+                          longitude fields.
+        :returns: a function that yields the encoded response.
+        """
+        location = params.get('location', locations.keys()[0])
+        if location not in locations:
+            raise RestException('location must be one of %s.' % ', '.join(
+                locations.keys()))
+        try:
+            bbox = [float(val) for val in params.get('bbox', '').split(',')]
+            zoom = int(params['zoom']) if params.get('zoom') else None
+            grid = datagrid.makeGrid(
+                *bbox, cols=int(params.get('cols', 256)),
+                rows=int(params.get('rows', 256)), zoom=zoom,
+                cellSize=int(params.get('cellsize', 1)))
+        except (TypeError, ValueError, ZeroDivisionError):
+            raise RestException('bbox must be four numbers, and cols, rows, '
+                                'zoom, and cellsize must be integers.')
+        if (grid['cols'] < 1 or grid['rows'] < 1 or
+                grid['cols'] * grid['rows'] > GridMaxCells or
+                grid['east'] <= grid['west'] or
+                grid['north'] <= grid['south']):
+            raise RestException(
+                'The grid must have an area and at most %d cells.' %
+                GridMaxCells)
+        latfield, lonfield = locations[location]
+        return self.aggregateGeneral(
+            params, accessList, defaultDbKey, 'densityGrid', resultInfo={
+                'grid': grid, 'location': location},
+            latfield=latfield, lonfield=lonfield, grid=grid, **kwargs)
+
+    @access.public
+    def gridInstagram(self, params):
+        return self.gridGeneral(
+            params, InstagramFieldTable, self.instagramAccess, 'postgres',
+            InstagramGridLocations, queryBase='instagram')
+    gridInstagram.description = gridDescription(
+        'Get a spatial density grid of instagram data.', InstagramFieldTable,
+        'postgres', InstagramGridLocations)
+
+    @access.public
+    def gridMessage(self, params):
+        return self.gridGeneral(
+            params, MessageFieldTable, self.instagramAccess, 'rtmsg',
+            MessageGridLocations, queryBase='message')
+    gridMessage.description = gridDescription(
+        'Get a spatial density grid of message data.', MessageFieldTable,
+        'rtmsg', MessageGridLocations)
+
+    @access.public
+    def gridTaxi(self, params):
+        return self.gridGeneral(
+            params, TaxiFieldTableRand, self.taxiAccess, 'mongo',
+            TaxiGridLocations, queryBase='taxi')
+    gridTaxi.description = gridDescription(
+        'Get a spatial density grid of taxi data.', TaxiFieldTableRand,
+        'mongo', TaxiGridLocations)
+
+    def histogramGeneral(self, params, fieldTable, accessList, defaultDbKey,
+                         defaultDateField, **kwargs):
+        """
+        Count the results of a database search in date bins for a general
+        histogram endpoint.
+
+        :param params: the parameters of the endpoint call.
+        :param fieldTable: an ordered dictionary with the fields that can be
+                           used.
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param defaultDbKey: the default database source.
+        :param defaultDateField: the default field used for binning.
+        :returns: a function that yields the encoded response.
+        """
+        bin = params.get('bin', 'day')
+        if bin not in HistogramBins:
+            raise RestException('bin must be one of %s.' % ', '.join(
+                HistogramBins))
+        datefield = params.get('datefield', defaultDateField)
+        if fieldTable.get(datefield, ('', ))[0] != 'date':
+            raise RestException('datefield must be a date field.')
+        sums = params.get('sums', '').replace(',', ' ').strip().split()
+        for field in sums:
+            if fieldTable.get(field, ('', ))[0] not in (
+                    'int', 'bigint', 'float'):
+                raise RestException('sums must be numeric fields.')
+        return self.aggregateGeneral(
+            params, accessList, defaultDbKey, 'histogram', bin=bin,
+            datefield=datefield, sums=sums, **kwargs)
+
+    @access.public
+    def histogramInstagram(self, params):
+        return self.histogramGeneral(
+            params, InstagramFieldTable, self.instagramAccess, 'postgres',
+            'posted_date', queryBase='instagram')
+    histogramInstagram.description = histogramDescription(
+        'Get a date histogram of instagram data.', InstagramFieldTable,
+        'postgres', 'posted_date')
+
+    @access.public
+    def histogramMessage(self, params):
+        where = []
+        if not self.boolParam('nullgeo', params, default=False):
+            where.append('latitude is not NULL')
+        return self.histogramGeneral(
+            params, MessageFieldTable, self.instagramAccess, 'rtmsg',
+            'msg_date', queryBase='message', whereClauses=where)
+    histogramMessage.description = (
+        histogramDescription(
+            'Get a date histogram of message data.', MessageFieldTable,
+            'rtmsg', 'msg_date')
+        .param('nullgeo', 'Include messages without latitude and longitude '
+               '(default=false).', required=False, dataType='boolean',
+               default=False))
+
+    @access.public
+    def histogramTaxi(self, params):
+        return self.histogramGeneral(
+            params, TaxiFieldTableRand, self.taxiAccess, 'mongo',
+            'pickup_datetime', queryBase='taxi')
+    histogramTaxi.description = histogramDescription(
+        'Get a date histogram of taxi data.', TaxiFieldTableRand, 'mongo',
+        'pickup_datetime')
+
     @access.public
     def ingestMessages(self, params):
         starttime = time.time()
         res = {'ingested': 0}
         defaultDbKey = 'rtmsg'
         accessList = self.instagramAccess
-        accessObj = accessList[params.get('source', defaultDbKey)]
+        accessObj = self.getAccessObject(
+            accessList, params.get('source', defaultDbKey))
         ingestFrom = params.get('from', None)
         nodup = params.get('nodup', False)
-        if isinstance(accessObj, tuple):
-            accessObj = accessObj[0](**accessObj[1])
-            accessList[params.get('source', defaultDbKey)] = accessObj
         log = None
         if 'log' in params and params['log'].isdigit():
             log = int(params['log'])
         db = accessObj.connect('fresh')
         c = db.cursor()
+        ingestedIds = []
         for line in cherrypy.request.body:
             try:
                 data = json.loads(line.decode('utf8'))
-                if accessObj.ingestTwitter(db, c, data, ingestFrom, nodup):
+                newId = accessObj.ingestTwitter(
+                    db, c, data, ingestFrom, nodup)
+                if newId:
+                    ingestedIds.append(newId)
                     res['ingested'] += 1
+                    self.dataNotifier.notify(self.notifyKey(accessObj))
                     if log and not res['ingested'] % log:
                         duration = time.time() - starttime
                         if duration:
@@ -1028,6 +2088,9 @@ class GeoAppResource(girder.api.rest.Resource):
                     res['skipped'] = res.get('skipped', 0) + 1
             except ValueError:
                 res['badjson'] = res.get('badjson', 0) + 1
+        if ingestedIds and hasattr(accessObj, 'notifyIngested'):
+            accessObj.notifyIngested(db, min(ingestedIds), max(ingestedIds))
+        db.close()
         if res['ingested'] and cherrypy.response.status == 500:
             cherrypy.response.status = 200
         res['duration'] = time.time() - starttime
@@ -1051,6 +2114,214 @@ class GeoAppResource(girder.api.rest.Resource):
                dataType='bool', default=False, required=False)
         .errorResponse('Invalid JSON passed in request body.'))
 
+    @access.public
+    def notifyData(self, params):
+        source = params.get('source', 'rtmsg')
+        for accessList in (self.instagramAccess, self.taxiAccess):
+            if source in accessList:
+                accessObj = self.getAccessObject(accessList, source)
+                self.dataIngested(accessObj)
+                return {'notified': source}
+        raise RestException('Unknown source %s.' % source)
+    notifyData.description = (
+        Description('Signal that new data has been added to a database.')
+        .notes('External ingest processes call this so that requests '
+               'waiting for new data query the database immediately rather '
+               'than at their next polling interval.  Sources that are '
+               'configured to listen for Postgres notifications don\'t need '
+               'this.')
+        .param('source', 'Database source (default rtmsg).', required=False)
+        .errorResponse('Unknown source.'))
+
+    def streamGeneral(self, params, sortKey, fieldTable, accessList,
+                      defaultDbKey, **kwargs):
+        """
+        Stream data from a realtime database source as Server-Sent Events.
+        The first event is a snapshot of the data that matches the query.
+        After that, the source is queried for new data whenever data is
+        ingested or the polling interval elapses, and only the new rows are
+        sent.
+
+        :param params: the parameters of the endpoint call.
+        :param sortKey: the default sortKey for the snapshot.
+        :param fieldTable: an ordered dictionary with the fields that can be
+                           used.
+        :param accessList: a dictionary of access classes used to query
+                           different databases.
+        :param defaultDbKey: the default database source.  Used with the
+                             accessList.
+        :returns: a function that yields the event stream.
+        """
+        limit, offset, sort = self.getPagingParameters(params, sortKey)
+        if sort is None and sortKey:
+            sort = sortKey
+        fields = params.get('fields', '').replace(',', ' ').strip().split()
+        if not fields or not len(fields):
+            fields = fieldTable.keys()
+        source = params.get('source', defaultDbKey)
+        if source not in accessList:
+            raise RestException('Unknown source %s.' % source)
+        accessObj = self.getAccessObject(accessList, source)
+        if not getattr(accessObj, 'realtime', False):
+            raise RestException('The %s source is not a realtime source.' % (
+                source, ))
+        notifyKey = self.notifyKey(accessObj)
+        wait, poll, initwait = self.getWaitParameters(params)
+        sourceConfig = getattr(accessObj, 'sourceConfig', {})
+        duration = self.streamDuration(params, sourceConfig)
+        lastId = cherrypy.request.headers.get(
+            'Last-Event-ID', params.get('lastid')) or None
+        queryParams = {key: value for key, value in params.iteritems()
+                       if key not in ('lastid', 'duration', 'wait', 'poll',
+                                      'initwait', '_id_min', '_id_max')}
+        # Realtime sources track what each client has seen by its client id,
+        # so the stream needs one even if the client didn't send it.
+        if not queryParams.get('clientid', '').strip():
+            queryParams['clientid'] = 'stream-%s' % uuid.uuid4().hex
+        # A stream that ends late is forgotten by streamSlot, so a slot isn't
+        # lost if the stream is never started.
+        endtime = time.time() + duration
+        slot = self.streamSlot(source, sourceConfig.get(
+            'maxstreams', StreamMaxPerSource), endtime + poll)
+        kwargs['stream'] = False
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        # Tell nginx and similar proxies to pass events through immediately.
+        cherrypy.response.headers['X-Accel-Buffering'] = 'no'
+
+        def resultFunc():
+            try:
+                for event in streamEvents():
+                    yield event
+            finally:
+                with self.streamsLock:
+                    self.streams.get(source, {}).pop(slot, None)
+
+        def streamEvents():
+            nextId = lastId
+            while True:
+                version = self.dataNotifier.version(notifyKey)
+                if nextId is not None:
+                    queryParams['_id_min'] = str(nextId)
+                result = accessObj.find(
+                    queryParams, limit if nextId is None else StreamUpdateLimit,
+                    offset if nextId is None else 0, sort, fields, **kwargs)
+                if result is None or (nextId is not None and len(
+                        result.get('data') or []) >= StreamUpdateLimit):
+                    yield dataencode.sseEvent('reset', '{}')
+                    return
+                if nextId is None or len(result.get('data') or []):
+                    result['limit'] = limit
+                    result['sort'] = sort
+                    yield dataencode.sseEvent(
+                        'snapshot' if nextId is None else 'data',
+                        ''.join(dataencode.encodeResult(
+                            result, 'list', fields, fieldTable)),
+                        result.get('nextId'))
+                nextId = result.get('nextId', nextId)
+                curtime = time.time()
+                if nextId is None or curtime >= endtime:
+                    return
+                if not self.waitForData(
+                        notifyKey, version, min(poll, endtime - curtime)):
+                    # A comment keeps proxies from closing an idle connection.
+                    yield ': keepalive\n\n'
+
+        return resultFunc
+
+    def streamDuration(self, params, sourceConfig):
+        """
+        Get the duration of an event stream, limited to the maximum for the
+        source.
+
+        :param params: the parameters of the endpoint call.
+        :param sourceConfig: the configuration of the database source.
+        :returns: the duration in seconds.
+        """
+        try:
+            duration = float(params.get('duration', StreamDefaultDuration))
+        except ValueError:
+            duration = None
+        if not duration > 0:
+            raise RestException('duration must be a positive number.')
+        return min(duration, float(sourceConfig.get(
+            'streammaxduration', StreamMaxDuration)))
+
+    def streamSlot(self, source, maxStreams, endtime):
+        """
+        Reserve one of a source's event streams.
+
+        :param source: the key of the database source.
+        :param maxStreams: the maximum number of concurrent streams for the
+                           source.
+        :param endtime: the time by which the stream will have ended.
+        :returns: an identifier for the slot.  Remove it from self.streams
+                  when the stream ends.
+        """
+        curtime = time.time()
+        with self.streamsLock:
+            streams = self.streams.setdefault(source, {})
+            for key, streamEnd in streams.items():
+                if streamEnd < curtime:
+                    del streams[key]
+            if len(streams) >= maxStreams:
+                raise RestException(
+                    'Too many streams from the %s source.  Try again later.' %
+                    source, code=503)
+            slot = uuid.uuid4().hex
+            streams[slot] = endtime
+        return slot
+
+    @access.public
+    def streamMessage(self, params):
+        where = []
+        if not self.boolParam('nullgeo', params, default=False):
+            where.append('latitude is not NULL')
+        return self.streamGeneral(
+            params, [('rand1', 1), ('rand2', 1)], MessageFieldTable,
+            self.instagramAccess, 'rtmsg', queryBase='message',
+            whereClauses=where)
+    streamMessage.description = (
+        fieldParamsDescription(
+            Description(
+                'Stream message data from a realtime source as Server-Sent '
+                'Events.  A snapshot event contains the data that matches '
+                'the filters when the stream starts; each data event '
+                'contains messages that have been ingested since the '
+                'previous event.  A reset event means that the stream could '
+                'not be continued and the client should reconnect without a '
+                'last event id.  Both snapshot and data events are in list '
+                'format.')
+            .param('source', 'Database source (default rtmsg).',
+                   required=False)
+            .param('limit', 'Result set size limit for the snapshot '
+                   '(default=50).', required=False, dataType='int')
+            .param('sort', 'Field to sort the snapshot by (default=rand1)',
+                   required=False)
+            .param('sortdir', '1 for ascending, -1 for descending '
+                   '(default=1)', required=False, dataType='int')
+            .param('fields', 'A comma-separated list of fields to return '
+                   '(default is all fields).', required=False)
+            .param('clientid', 'A string used to identify the client.',
+                   required=False)
+            .param('lastid', 'Resume the stream after this event id rather '
+                   'than sending a snapshot.  The Last-Event-ID header is '
+                   'used if present.', required=False)
+            .param('poll', 'The maximum duration in seconds between checks '
+                   'for new data (default=10).', required=False,
+                   dataType='float')
+            .param('duration', 'The duration in seconds of the stream before '
+                   'it is closed (default=%d, maximum %d unless configured '
+                   'for the source).' % (
+                       StreamDefaultDuration, StreamMaxDuration),
+                   required=False, dataType='float')
+            .param('nullgeo', 'Include messages without latitude and '
+                   'longitude (default=false).', required=False,
+                   dataType='boolean', default=False),
+            MessageFieldTable)
+        .errorResponse()
+        .errorResponse('Too many streams from the source.', 503))
+
     @access.public
     def storeTestResults(self, params):
         user, folder = self.getUserAndFolder()
@@ -1102,6 +2373,34 @@ class GeoAppResource(girder.api.rest.Resource):
         .param('wc2', 'Ignored', paramType='path', required=True)
         .param('wc3', 'Ignored', paramType='path', required=True))
 
+    @access.public
+    def instagramTiles(self, z, x, y, params):
+        return self.dataTiles(
+            params, z, x, y, '_id', InstagramFieldTable, self.instagramAccess,
+            'postgres', InstagramGridLocations, queryBase='instagram')
+    instagramTiles.description = tileDescription(
+        'Get a data tile of instagram data.', InstagramFieldTable, 'postgres',
+        InstagramGridLocations)
+
+    @access.public
+    def messageTiles(self, z, x, y, params):
+        return self.dataTiles(
+            params, z, x, y, [('rand1', 1), ('rand2', 1)], MessageFieldTable,
+            self.instagramAccess, 'rtmsg', MessageGridLocations,
+            queryBase='message')
+    messageTiles.description = tileDescription(
+        'Get a data tile of message data.', MessageFieldTable, 'rtmsg',
+        MessageGridLocations)
+
+    @access.public
+    def taxiTiles(self, z, x, y, params):
+        return self.dataTiles(
+            params, z, x, y, 'pickup_datetime', TaxiFieldTableRand,
+            self.taxiAccess, 'mongo', TaxiGridLocations, queryBase='taxi')
+    taxiTiles.description = tileDescription(
+        'Get a data tile of taxi data.', TaxiFieldTableRand, 'mongo',
+        TaxiGridLocations)
+
     @access.public
     def gridTiles(self, tilename, wc1, wc2, wc3, params):
         raise cherrypy.HTTPRedirect('/built/tile%s.png' % tilename)
@@ -1140,6 +2439,30 @@ class GeoAppResource(girder.api.rest.Resource):
         Description('Get intents from the configured intents server.  This '
                     'function works around CORS issues.'))
 
+    @access.public
+    def getStats(self, params):
+        return {
+            'resultCache': (self.resultCache.stats() if self.resultCache
+                            else None),
+            'sharedQueries': self.queryCoalescer.stats(),
+            'searchCache': querycache.SearchCache.stats(),
+            'notifications': self.dataNotifier.stats(),
+            'postgresPools': datapool.poolStats(),
+            'highWaterMarks': datanotify.highWaterMarkStats(),
+            'postgresListeners': datalisten.listenerStats(),
+            'postgresReplicas': datapool.routerStats(),
+        }
+    getStats.description = (
+        Description('Get statistics about the result cache, shared queries, '
+                    'compiled searches, data notifications, realtime '
+                    'high-water marks, database connection pools, '
+                    'database listeners, and read replica routing.')
+        .notes('Each Postgres pool reports the connections that are in use '
+               'and idle, the number of requests waiting for a connection, '
+               'and the total and maximum time spent waiting.  Each replica '
+               'router reports how many connections went to the primary '
+               'database and to replicas, and which replicas are ejected.'))
+
 
 def load(info):
     """
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains classes used to cache and share query results.
+
+import collections
+import threading
+import time
+
+
+# The number of compiled search expressions to keep.  Realtime clients repeat
+# the same search on every poll, so this only needs to cover the searches
+# that are in active use.
+SearchCacheSize = 1000
+
+
+class LRUCache():
+
+    def __init__(self, maxSize, ttl=None, sizeFunc=None):
+        """
+        A thread-safe least-recently-used cache with a total size budget and
+        optional expiration.
+
+        :param maxSize: the maximum total size of all entries in the cache.
+                        If sizeFunc is None, this is the maximum number of
+                        entries.
+        :param ttl: the default duration in seconds that entries are valid.
+                    None or 0 for no expiration.
+        :param sizeFunc: a function that is passed a value and returns its
+                         size.  None to count each entry as 1.
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.sizeFunc = sizeFunc
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Get a value from the cache.
+
+        :param key: the key of the value.
+        :returns: the value, or None if it is not in the cache or has expired.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry['expires'] and (
+                    time.time() >= entry['expires']):
+                self.size -= entry['size']
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry['value']
+
+    def invalidate(self, matchFunc=None):
+        """
+        Remove entries from the cache.
+
+        :param matchFunc: a function that is passed each key and returns True
+                          if the entry should be removed.  None to remove all
+                          entries.
+        """
+        with self.lock:
+            for key in self.entries.keys():
+                if matchFunc is None or matchFunc(key):
+                    self.size -= self.entries.pop(key)['size']
+
+    def set(self, key, value, ttl=None):
+        """
+        Add a value to the cache, evicting the least recently used entries as
+        needed to stay within the size budget.  Values that are larger than
+        the whole budget are not stored.
+
+        :param key: the key of the value.
+        :param value: the value to store.
+        :param ttl: the duration in seconds that the entry is valid.  None to
+                    use the cache's default.
+        :returns: True if the value was stored.
+        """
+        size = self.sizeFunc(value) if self.sizeFunc else 1
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)['size']
+            if size > self.maxSize:
+                return False
+            while self.size + size > self.maxSize and len(self.entries):
+                self.size -= self.entries.popitem(last=False)[1]['size']
+                self.evictions += 1
+            self.entries[key] = {
+                'value': value,
+                'size': size,
+                'expires': time.time() + ttl if ttl else None,
+            }
+            self.size += size
+        return True
+
+    def stats(self):
+        """
+        Get statistics about the cache.
+
+        :returns: a dictionary of statistics.
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': float(self.hits) / total if total else None,
+                'evictions': self.evictions,
+            }
+
+
+class QueryCoalescer():
+
+    def __init__(self, waitTimeout=600):
+        """
+        Track queries that are in progress so that identical concurrent
+        queries can share a single database query.  The first caller for a
+        key runs the query; later callers wait for and share its result.
+
+        :param waitTimeout: the maximum duration in seconds that a caller will
+                            wait for another caller's query.
+        """
+        self.waitTimeout = waitTimeout
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self.nextId = 1
+        self.shared = 0
+
+    def finish(self, entry, value):
+        """
+        Mark that a shared query has finished and wake any callers that are
+        waiting for it.
+
+        :param entry: the entry returned by join for the leading caller.  If
+                      None, this does nothing.
+        :param value: the shared result, or None if the query failed or the
+                      result can't be shared.  Waiting callers will run their
+                      own query in that case.  Ignored if the entry has
+                      already finished.
+        """
+        if entry is None:
+            return
+        with self.lock:
+            if entry['finished']:
+                return
+            if self.inflight.get(entry['key']) is entry:
+                del self.inflight[entry['key']]
+            entry['value'] = value
+            entry['finished'] = True
+            waiters = entry['waiters'][:]
+        for client, event in waiters:
+            event.set()
+
+    def join(self, key, client=None, cancel=None):
+        """
+        Join a query.  If there isn't already a query in progress for the key,
+        the caller is the leader and must run the query and call finish.
+
+        :param key: a hashable key that identifies the query.
+        :param client: the client id of the caller, or None.
+        :param cancel: a function that is called with the entry's shared
+                       client id to cancel the query if every caller that is
+                       interested in it has been released.  Only used by the
+                       leader.
+        :returns: a tuple of the entry for the query, whose 'id' is a client
+                  id that the leader should use for the database query, and
+                  True if the caller is the leader.
+        """
+        with self.lock:
+            entry = self.inflight.get(key)
+            leader = entry is None
+            if leader:
+                entry = self.inflight[key] = {
+                    'key': key,
+                    'id': 'coalesce-%d' % self.nextId,
+                    # A (client, event) tuple for each caller in wait.
+                    'waiters': [],
+                    'clients': {},
+                    'anonymous': 0,
+                    'cancel': cancel,
+                    'finished': False,
+                    'value': None,
+                }
+                self.nextId += 1
+            else:
+                self.shared += 1
+            if client:
+                entry['clients'][client] = entry['clients'].get(client, 0) + 1
+            else:
+                entry['anonymous'] += 1
+        return entry, leader
+
+    def release(self, client):
+        """
+        Mark that a client is no longer interested in any query it was waiting
+        for, such as when it issues a new query.  The client's callers that
+        are waiting stop waiting.  Any shared query that no longer has
+        interested callers is cancelled.
+
+        :param client: the client id to release.
+        """
+        if not client:
+            return
+        cancel = []
+        wake = []
+        with self.lock:
+            for key, entry in self.inflight.items():
+                if client not in entry['clients']:
+                    continue
+                del entry['clients'][client]
+                wake.extend(event for waiter, event in entry['waiters']
+                            if waiter == client)
+                if not len(entry['clients']) and not entry['anonymous']:
+                    del self.inflight[key]
+                    if entry['cancel']:
+                        cancel.append(entry)
+        for event in wake:
+            event.set()
+        for entry in cancel:
+            entry['cancel'](entry['id'])
+
+    def released(self, entry, client):
+        """
+        Check if a client's interest in a query has been released.  This must
+        be called with the lock held.
+
+        :param entry: the entry returned by join.
+        :param client: the client id that was passed to join.
+        :returns: True if the client has been released.
+        """
+        return client is not None and client not in entry['clients']
+
+    def stats(self):
+        """
+        Get statistics about shared queries.
+
+        :returns: a dictionary of statistics.
+        """
+        with self.lock:
+            return {'inflight': len(self.inflight), 'shared': self.shared}
+
+    def wait(self, entry, client=None):
+        """
+        Wait for a query that another caller is running.
+
+        :param entry: the entry returned by join.
+        :param client: the client id that was passed to join.
+        :returns: a tuple of the shared result, which is None if the query
+                  failed, couldn't be shared, or took too long, and True if
+                  the client was released while waiting.
+        """
+        waiter = (client, threading.Event())
+        with self.lock:
+            waiting = (not entry['finished'] and
+                       not self.released(entry, client))
+            if waiting:
+                entry['waiters'].append(waiter)
+        if waiting:
+            waiter[1].wait(self.waitTimeout)
+        with self.lock:
+            if waiter in entry['waiters']:
+                entry['waiters'].remove(waiter)
+            if entry['finished']:
+                return entry['value'], False
+            if self.released(entry, client):
+                return None, True
+            # We gave up waiting, so we are no longer interested in the query.
+            if client:
+                entry['clients'][client] -= 1
+                if not entry['clients'][client]:
+                    del entry['clients'][client]
+            else:
+                entry['anonymous'] -= 1
+            return None, False
+
+
+SearchCache = LRUCache(SearchCacheSize)
+
+
+def memoize(cache, key, func, *args):
+    """
+    Get a value from a cache, computing and storing it if it isn't there.
+    Values are shared between callers, so they must not be modified.
+
+    :param cache: an LRUCache.
+    :param key: the key of the value.
+    :param func: a function that is passed args and returns the value.  It
+                 must not return None.
+    :returns: the value.
+    """
+    value = cache.get(key)
+    if value is None:
+        value = func(*args)
+        cache.set(key, value)
+    return value
@@ -28,11 +28,12 @@ kafka = None
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(
     __file__)), '../server')))
+from datalisten import notifyIngested, notifyServer
 from geoapp import insertItemIntoPostgres
 
 
 def ingestES(es, pg, poll=10, batch=100, skipEpoch=None, maxEpoch=None,
-             nodup=True, **kwargs):
+             nodup=True, notify=None, **kwargs):
     """
     Ingest from Elasticsearch to Postgres.
 
@@ -47,6 +48,8 @@ def ingestES(es, pg, poll=10, batch=100, skipEpoch=None, maxEpoch=None,
                      Also, add items in descending order.
     :param nodup: if True, check for duplicates and make some effort to avoid
                   them.
+    :param notify: if not None, the url of a geoapp notify endpoint to call
+                   after ingesting data.
     """
     starttime = time.time()
     if not es.startswith('https://'):
@@ -102,15 +105,22 @@ def ingestES(es, pg, poll=10, batch=100, skipEpoch=None, maxEpoch=None,
             results = results['hits']['hits']
             oldProcessed = processed
             oldIngested = ingested
+            ingestedIds = []
             for row in results:
                 processed += 1
                 item = convertInstagramJSONToItem(row['_source'])
                 if item is None:
                     continue
-                if insertItemIntoPostgres(pdb, pcursor, item, nodup):
+                newId = insertItemIntoPostgres(pdb, pcursor, item, nodup)
+                if newId:
                     ingested += 1
+                    ingestedIds.append(newId)
                 nextEpoch = str(int(row['_source']['created_time']) + (
                     - 1 if not maxEpoch else 1))
+            if ingestedIds:
+                notifyIngested(pdb, 'messages', min(ingestedIds),
+                               max(ingestedIds))
+                notifyServer(notify)
             if (len(results) < batch and
                     processed - ingested > oldProcessed - oldIngested):
                 processed = max(0, processed - 1000)
@@ -132,7 +142,7 @@ def ingestES(es, pg, poll=10, batch=100, skipEpoch=None, maxEpoch=None,
             return
 
 
-def ingestKafka(kafkaInfo, pg, nodup=True, **kwargs):
+def ingestKafka(kafkaInfo, pg, nodup=True, notify=None, **kwargs):
     """
     Ingest from Elasticsearch to Postgres.
 
@@ -140,6 +150,8 @@ def ingestKafka(kafkaInfo, pg, nodup=True, **kwargs):
     :param pg: postgres connection information.
     :param nodup: if True, check for duplicates and make some effort to avoid
                   them.
+    :param notify: if not None, the url of a geoapp notify endpoint to call
+                   after ingesting data.
     """
     global kafka
     if kafka is None:
@@ -158,14 +170,21 @@ def ingestKafka(kafkaInfo, pg, nodup=True, **kwargs):
     for message in consumer:
         try:
             results = json.loads(message.value)
+            ingestedIds = []
             for row in results:
                 processed += 1
                 item = convertInstagramJSONToItem(row)
                 if item is None:
                     continue
-                if insertItemIntoPostgres(pdb, pcursor, item, nodup):
+                newId = insertItemIntoPostgres(pdb, pcursor, item, nodup)
+                if newId:
                     ingested += 1
+                    ingestedIds.append(newId)
                 nextEpoch = str(int(row['created_time']) - 1)
+            if ingestedIds:
+                notifyIngested(pdb, 'messages', min(ingestedIds),
+                               max(ingestedIds))
+                notifyServer(notify)
             curtime = time.time()
             rate = ingested / (curtime - starttime)
             if curtime - laststatus > 1:
@@ -281,6 +300,10 @@ if __name__ == '__main__':
     parser.add_argument(
         '--dup', help='Skip duplicate checks.  This is faster, but duplicates '
         'are allowed', dest='nodup', action='store_false')
+    parser.add_argument(
+        '--notify', help='The url of a geoapp server\'s notify endpoint to '
+        'call after ingesting data.  For example, '
+        'http://localhost:8001/api/v1/geoapp/notify?source=rtmsg.')
     parser.set_defaults(nodup=True)
     args = vars(parser.parse_args())
     if args.get('kafkaInfo', None):
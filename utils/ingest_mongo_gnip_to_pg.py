@@ -29,11 +29,12 @@ from bson.objectid import ObjectId
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(
     __file__)), '../server')))
+from datalisten import notifyIngested, notifyServer
 from geoapp import insertItemIntoPostgres
 
 
 def ingest(mongo, mongoCollection, pg, poll=10, batch=100, skipId=None,
-           nodup=True):
+           nodup=True, notify=None):
     """
     Ingest from Mongo to Postgres.
 
@@ -46,6 +47,8 @@ def ingest(mongo, mongoCollection, pg, poll=10, batch=100, skipId=None,
                    this value.
     :param nodup: if True, check for duplicates and make some effort to avoid
                   them.
+    :param notify: if not None, the url of a geoapp notify endpoint to call
+                   after ingesting data.
     """
     starttime = time.time()
     if not mongo.startswith('mongodb://'):
@@ -72,14 +75,21 @@ def ingest(mongo, mongoCollection, pg, poll=10, batch=100, skipId=None,
                 print('%d to ingest' % numrows)
                 firstPass = False
             oldProcessed = processed
+            ingestedIds = []
             for row in mcursor:
                 processed += 1
                 item = convertGnipToTwitterItem(row)
                 if item is None:
                     continue
-                if insertItemIntoPostgres(pdb, pcursor, item, nodup):
+                newId = insertItemIntoPostgres(pdb, pcursor, item, nodup)
+                if newId:
                     ingested += 1
+                    ingestedIds.append(newId)
                 skipId = row['_id']
+            if ingestedIds:
+                notifyIngested(pdb, 'messages', min(ingestedIds),
+                               max(ingestedIds))
+                notifyServer(notify)
             if oldProcessed == processed:
                 time.sleep(poll)
                 continue
@@ -181,6 +191,10 @@ if __name__ == '__main__':
     parser.add_argument(
         '--dup', help='Skip duplicate checks.  This is faster, but duplicates '
         'are allowed', dest='nodup', action='store_false')
+    parser.add_argument(
+        '--notify', help='The url of a geoapp server\'s notify endpoint to '
+        'call after ingesting data.  For example, '
+        'http://localhost:8001/api/v1/geoapp/notify?source=rtmsg.')
     parser.set_defaults(nodup=True)
     args = vars(parser.parse_args())
     ingest(**args)
@@ -1,7 +1,13 @@
 import json
+import os
 import sys
 
 import fileutil
+import pgpartition
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(
+    __file__)), '../server')))
+from datagrid import zorderKey
 
 KeyTable = {
     'medallion': 'm',
@@ -28,13 +34,18 @@ KeyTable = {
 }
 
 
-if len(sys.argv) != 3 or '--help' in sys.argv:
+args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+if len(args) != 2 or '--help' in sys.argv:
     print """Convert JSON load file for Mongo to a load file for Postgres.
 
-Syntax: load_pg.py (existing json file) (target pg file)"""
+Syntax: load_pg.py [--partition] (existing json file) (target pg file)
+
+--partition moves the data into monthly child tables of the trips table."""
     sys.exit()
-dptr = fileutil.OpenWithoutCaching(sys.argv[2], 'wb')
-dptr.write("""DROP TABLE trips;
+partition = '--partition' in sys.argv[1:]
+months = set()
+dptr = fileutil.OpenWithoutCaching(args[1], 'wb')
+dptr.write("""DROP TABLE trips CASCADE;
 
 CREATE TABLE trips (
     medallion text,
@@ -58,16 +69,18 @@ CREATE TABLE trips (
     tip_amount real,
     tolls_amount real,
     total_amount real,
+    pickup_zkey bigint,
+    dropoff_zkey bigint,
     _id int
 );
 
 COPY trips (""")
 keys = KeyTable.keys()
 dptr.write(','.join(keys))
-dptr.write(""",_id) FROM stdin;
+dptr.write(""",pickup_zkey,dropoff_zkey,_id) FROM stdin;
 """)
 skeys = [KeyTable[key] for key in keys]
-fptr = fileutil.OpenWithoutCaching(sys.argv[1])
+fptr = fileutil.OpenWithoutCaching(args[0])
 processed = 0
 for line in fptr:
     data = json.loads(line)
@@ -76,7 +89,13 @@ for line in fptr:
         continue
     data[KeyTable['pickup_datetime']] /= 1000
     data[KeyTable['dropoff_datetime']] /= 1000
-    data = [data.get(key, None) for key in skeys]
+    if partition:
+        months.add(pgpartition.monthOf(data[KeyTable['pickup_datetime']]))
+    data = [data.get(key, None) for key in skeys] + [
+        zorderKey(data.get(KeyTable['pickup_latitude']),
+                  data.get(KeyTable['pickup_longitude'])),
+        zorderKey(data.get(KeyTable['dropoff_latitude']),
+                  data.get(KeyTable['dropoff_longitude']))]
     data = ['\\N' if item is None else str(item).replace('\\', '\\\\')
             for item in data]
     dptr.write('\t'.join(data) + '\t%d\n' % processed)
@@ -90,7 +109,17 @@ CREATE INDEX id_idx ON trips (_id);
 CREATE INDEX medallion_idx ON trips (medallion);
 CREATE INDEX hack_license_idx ON trips (hack_license);
 CREATE INDEX pickup_datetime_idx ON trips (pickup_datetime);
+CREATE INDEX pickup_zkey_idx ON trips (pickup_zkey);
+CREATE INDEX dropoff_zkey_idx ON trips (dropoff_zkey);
 """)
+if partition:
+    # The months aren't known until all of the data has been read, so the
+    # rows are copied into the trips table and then moved to the children.
+    dptr.write(pgpartition.partitionSql('trips', 'pickup_datetime', months))
+    dptr.write(pgpartition.partitionMoveSql('trips'))
+    dptr.write(pgpartition.partitionIndexSql('trips', months, [
+        '(_id)', '(medallion)', '(hack_license)', '(pickup_datetime)',
+        '(pickup_zkey)', '(dropoff_zkey)']))
 dptr.close()
 fptr.close()
 sys.stderr.write('%d\n' % processed)
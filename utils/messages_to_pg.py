@@ -45,12 +45,19 @@ except ImportError:
     pass
 
 import fileutil
+import pgpartition
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(
+    __file__)), '../server')))
+from datagrid import zorderKey
+import datarollup
 
 
 KeyList = [
     'user_name', 'user_id', 'posted_date', 'url', 'image_url', 'caption',
     'latitude', 'longitude', 'location_id', 'location_name',
-    'comment_count', 'like_count'  # , 'comments', 'likes', 'scraped_date'
+    'comment_count', 'like_count',  # 'comments', 'likes', 'scraped_date'
+    'zkey'
 ]
 MessageKeyList = [
     'user_name', 'user_id', 'msg_date', 'url', 'image_url', 'msg',
@@ -72,6 +79,30 @@ InstagramMentionPattern = re.compile(
     '@[a-zA-Z0-9_][a-zA-Z0-9_.]{0,28}[a-zA-Z0-9_]?')
 IngestTime = time.time()
 
+# When the output is partitioned by month, each child table gets these
+# indexes, matching those of the instagram table below and of the messages
+# table in realtimemsg.pg.
+PartitionIndexes = {
+    'instagram': [
+        '(_id)', '(posted_date)', '(zkey)', 'USING gin (caption_tsv)',
+        'USING gin (caption gin_trgm_ops)'],
+    'message': [
+        '(rand1, rand2)', '(msg_date)', 'USING gin (msg_tsv)',
+        'USING gin (msg gin_trgm_ops)', '(region, rand1, rand2)', '(_id)',
+        '(region)', '(zkey)'],
+}
+PartitionColumns = {'instagram': 'posted_date', 'message': 'msg_date'}
+# Each child table also gets the row triggers of its parent table.
+PartitionTriggers = {
+    'instagram': [
+        ('caption_tsv_trigger', "tsvector_update_trigger(caption_tsv, "
+         "'pg_catalog.english', caption)")],
+    'message': [
+        ('msg_tsv_trigger', "tsvector_update_trigger(msg_tsv, "
+         "'pg_catalog.english', msg)"),
+        ('zkey_trigger', 'messages_zkey_update()')],
+}
+
 DateLookup = {}
 
 
@@ -91,6 +122,7 @@ def adjustItemForStorage(item, format=None, ingestSource=None, service=None,
             item['url'].startswith('https://instagram.com/p/')):
         item['url'] = (
             'i/' + item['url'].split('://instagram.com/p/', 1)[1])
+    item['zkey'] = zorderKey(item.get('latitude'), item.get('longitude'))
     if format == 'message' or format == 'json':
         item['msg_date'] = int(item['posted_date'])
         item['msg_date_ms'] = int(float(item['posted_date']) * 1000)
@@ -517,6 +549,11 @@ def processFiles(files, items, fileData, format='instagram'):
             trackLikes(fileData.get('mentions', None), item,
                        fileData.get('likes', False))
             adjustItemForStorage(item, format, ingestSource, service, region)
+            fileData.setdefault('months', set()).add(
+                pgpartition.monthOf(item['posted_date']))
+            if format == 'message':
+                datarollup.rollupAdd(datarollup.MessagesRollup,
+                                     fileData.setdefault('rollup', {}), item)
             if format == 'json':
                 item = json.dumps({jkey: item[jkey] for jkey in keylist
                                    if item.get(jkey, None) is not None})
@@ -695,8 +732,8 @@ if __name__ == '__main__':
         print """Load instagram and twitter data files to a Postgres table.
 
 Syntax: messages_to_pg.py [--noclear] [--message|--json] [--match=(file)]
-        [--mentions=(file) [--likes]] [--table=(table name)] (files)
-        > (data.pg)
+        [--mentions=(file) [--likes]] [--table=(table name)] [--partition]
+        (files) > (data.pg)
 
 Files must not start with a dash.  Files can be json or csv, either plain or
 stored in zip, bzip2, or gzip files.  Zip, bzip2, and gzip files must end with
@@ -710,6 +747,8 @@ compressed file ending with .json or .csv are ingested.
 --message outputs data that can be added to the real-time message table rather
     than to the original instagram message table.  It always implies --noclear.
 --noclear doesn't drop or create the postgres table.
+--partition loads the data into monthly child tables of the table.  This is
+    ignored with --json.
 --table specifies the output table name.
 """
         sys.exit()
@@ -754,8 +793,10 @@ compressed file ending with .json or .csv are ingested.
 
     # Output the results
     dptr = sys.stdout
+    months = fileData.get('months', ())
+    partition = '--partition' in sys.argv[1:] and format != 'json'
     if '--noclear' not in sys.argv[1:] and format == 'instagram':
-        dptr.write("""DROP TABLE %s;
+        dptr.write("""DROP TABLE %s CASCADE;
 
 CREATE TABLE %s (
     user_name text,
@@ -773,10 +814,20 @@ CREATE TABLE %s (
     comments text,
     likes text,
     scraped_date int,
+    caption_tsv tsvector,
+    zkey bigint, -- Z-order key of latitude and longitude
     _id serial
 );
-""" % (table, table))
 
+CREATE TRIGGER %s_caption_tsv_trigger BEFORE INSERT OR UPDATE ON %s
+    FOR EACH ROW EXECUTE PROCEDURE
+    tsvector_update_trigger(caption_tsv, 'pg_catalog.english', caption);
+""" % (table, table, table, table))
+
+    if partition:
+        dptr.write(pgpartition.partitionSql(
+            table, PartitionColumns[format], months,
+            PartitionTriggers[format]))
     if format == 'instagram':
         dptr.write("""
 COPY %s (_id,""" % table)
@@ -796,9 +847,18 @@ COPY %s (""" % table)
         dptr.write("""
 CREATE INDEX instagram_id_ix ON %s (_id);
 CREATE INDEX instagram_posted_date_ix ON %s (posted_date);
-CREATE INDEX instagram_caption_ix ON %s USING gin
-    (to_tsvector('english', caption));
-""" % (table, table, table))
+CREATE INDEX instagram_zkey_ix ON %s (zkey);
+CREATE INDEX instagram_caption_tsv_ix ON %s USING gin (caption_tsv);
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX instagram_caption_trgm_ix ON %s USING gin
+    (caption gin_trgm_ops);
+""" % (table, table, table, table, table))
+    if partition:
+        dptr.write(pgpartition.partitionIndexSql(
+            table, months, PartitionIndexes[format]))
+    if format == 'message':
+        dptr.write(datarollup.rollupCopySql(
+            datarollup.MessagesRollup, fileData.get('rollup', {})))
     sys.stderr.write('\n%d of %d\n' % (lenItems, processed))
     for arg in sys.argv[1:]:
         if arg.startswith('--match='):
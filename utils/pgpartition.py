@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# This file contains functions used by the loaders to split a table into
+# monthly child tables.  A child table is named (table)_p(YYYY)(MM) and
+# inherits from the table.  Rows inserted into the parent table are routed to
+# the child of their month by a trigger; rows without a child stay in the
+# parent.  The server reads only the children that a date-bounded query needs.
+#
+# To add a month to an existing table without reloading it, load the month
+# into a table created with
+#   CREATE TABLE trips_p201402 (LIKE trips INCLUDING DEFAULTS,
+#       CHECK (pickup_datetime >= 1391212800 AND
+#              pickup_datetime < 1393632000));
+# add its indexes and the row triggers of the parent, such as the search
+# vector and Z-order key triggers of the messages table, then attach it with
+#   ALTER TABLE trips_p201402 INHERIT trips;
+# and regenerate the routing trigger to include it.
+
+import calendar
+import datetime
+
+
+def monthOf(epoch):
+    """
+    Get the month of a time.
+
+    :param epoch: a time in seconds since the epoch.
+    :returns: a (year, month) tuple.
+    """
+    date = datetime.datetime.utcfromtimestamp(int(epoch))
+    return date.year, date.month
+
+
+def monthRange(month):
+    """
+    Get the start and end of a month.
+
+    :param month: a (year, month) tuple.
+    :returns: the start of the month and the start of the next month in
+              seconds since the epoch.
+    """
+    year, mon = month
+    start = calendar.timegm((year, mon, 1, 0, 0, 0))
+    if mon == 12:
+        year, mon = year + 1, 1
+    else:
+        mon += 1
+    return start, calendar.timegm((year, mon, 1, 0, 0, 0))
+
+
+def partitionMoveSql(table):
+    """
+    Get the sql that moves the rows in the parent table itself to the child
+    tables by inserting them again through the routing trigger.  Rows without
+    a child stay in the parent.
+
+    :param table: the name of the parent table.
+    :returns: the sql.
+    """
+    return ('WITH moved AS (DELETE FROM ONLY %s RETURNING *)\n'
+            '    INSERT INTO %s SELECT * FROM moved;\n' % (table, table))
+
+
+def partitionName(table, month):
+    """
+    Get the name of the child table of a month.
+
+    :param table: the name of the parent table.
+    :param month: a (year, month) tuple.
+    :returns: the name of the child table.
+    """
+    return '%s_p%04d%02d' % (table, month[0], month[1])
+
+
+def partitionIndexSql(table, months, indexes):
+    """
+    Get the sql that indexes the child tables.  Indexes are not inherited, so
+    each child needs its own.
+
+    :param table: the name of the parent table.
+    :param months: a list of (year, month) tuples.
+    :param indexes: a list of index descriptions, such as '(pickup_datetime)'
+                    or 'USING gin (msg_tsv)'.
+    :returns: the sql.
+    """
+    sql = []
+    for month in sorted(months):
+        for index in indexes:
+            sql.append('CREATE INDEX ON %s %s;\n' % (
+                partitionName(table, month), index))
+    return ''.join(sql)
+
+
+def partitionSql(table, column, months, triggers=()):
+    """
+    Get the sql that creates a child table for each month and the trigger
+    that routes rows inserted into the parent table to them.  The trigger is
+    named so that it runs after any other trigger on the parent table.
+    Triggers are not inherited, so each child gets its own copy of the row
+    triggers of the parent; these maintain rows that are updated or copied
+    into the child directly.
+
+    :param table: the name of the parent table.
+    :param column: the column with the time of each row in seconds since the
+                   epoch.
+    :param months: a list of (year, month) tuples.
+    :param triggers: a list of (name, procedure) tuples of the BEFORE INSERT
+                     OR UPDATE row triggers of the parent table.  The name is
+                     appended to the name of the child, such as
+                     'msg_tsv_trigger'.
+    :returns: the sql.
+    """
+    sql = []
+    conditions = []
+    for month in sorted(months):
+        start, end = monthRange(month)
+        name = partitionName(table, month)
+        sql.append(
+            'CREATE TABLE IF NOT EXISTS %s (CHECK (%s >= %d AND %s < %d)) '
+            'INHERITS (%s);\n' % (name, column, start, column, end, table))
+        for trigger, procedure in triggers:
+            sql.append(
+                'DROP TRIGGER IF EXISTS %s_%s ON %s;\n'
+                'CREATE TRIGGER %s_%s BEFORE INSERT OR UPDATE ON %s\n'
+                '    FOR EACH ROW EXECUTE PROCEDURE %s;\n' % (
+                    name, trigger, name, name, trigger, name, procedure))
+        conditions.append(
+            '    %s NEW.%s >= %d AND NEW.%s < %d THEN\n'
+            '        INSERT INTO %s VALUES (NEW.*);\n' % (
+                'ELSIF' if conditions else 'IF', column, start, column, end,
+                name))
+    if not conditions:
+        return ''.join(sql)
+    sql.append("""
+CREATE OR REPLACE FUNCTION %s_partition_insert() RETURNS trigger AS $$
+BEGIN
+%s    ELSE
+        RETURN NEW;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS %s_zz_partition_trigger ON %s;
+CREATE TRIGGER %s_zz_partition_trigger BEFORE INSERT ON %s
+    FOR EACH ROW EXECUTE PROCEDURE %s_partition_insert();
+""" % (table, ''.join(conditions), table, table, table, table, table))
+    return ''.join(sql)
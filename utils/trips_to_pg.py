@@ -33,6 +33,12 @@ import time
 import zipfile
 
 import fileutil
+import pgpartition
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(
+    __file__)), '../server')))
+from datagrid import zorderKey
+import datarollup
 
 TypeTable = {
     'dropoff_datetime': 'date',
@@ -150,9 +156,18 @@ KeyList = [
     'total_amount',
 
     'ingest_source', 'service', 'region',
+
+    'pickup_zkey', 'dropoff_zkey',
 ]
 IngestTime = time.time()
 
+# When the output is partitioned by month, each child table gets these
+# indexes, matching those of the trips table in taxijuly.pg.
+PartitionIndexes = [
+    '(rand1, rand2)', '(pickup_datetime)', '(region, rand1, rand2)', '(_id)',
+    '(region)', '(pickup_zkey)', '(dropoff_zkey)',
+]
+
 
 def bikeShareToItems(fptr):
     """
@@ -401,6 +416,14 @@ def processFiles(files, items, fileData):
             item['region'] = region
             item['service'] = service
             item['ingest_source'] = ingestSource
+            item['pickup_zkey'] = zorderKey(item.get('pickup_latitude'),
+                                            item.get('pickup_longitude'))
+            item['dropoff_zkey'] = zorderKey(item.get('dropoff_latitude'),
+                                             item.get('dropoff_longitude'))
+            fileData.setdefault('months', set()).add(
+                pgpartition.monthOf(item['pickup_datetime']))
+            datarollup.rollupAdd(datarollup.TripsRollup, fileData.setdefault(
+                'rollup', {}), item)
             item = [item.get(lkey, None) for lkey in keylist]
             # Escape for Postgres bulk import
             item = ['\\N' if col is None else unicode(col).replace(
@@ -511,8 +534,8 @@ if __name__ == '__main__':
     if len(sys.argv) < 2 or '--help' in sys.argv:
         print """Load taxi and bike share data files to a Postgres table.
 
-Syntax: trips_to_pg.py [--bikeshare=(file)] [--rainbow=(file)] (files)
-                       > (data.pg)
+Syntax: trips_to_pg.py [--bikeshare=(file)] [--rainbow=(file)] [--partition]
+                       (files) > (data.pg)
 
 Files must not start with a dash.  Files can be json or csv, either plain or
 stored in zip, bzip2, or gzip files.  Zip, bzip2, and gzip files must end with
@@ -520,6 +543,7 @@ stored in zip, bzip2, or gzip files.  Zip, bzip2, and gzip files must end with
 compressed file ending with .json or .csv are ingested.
 --bikeshare specifies a json file with coordinates for Bike Share addresses.
 --rainbow specifies a json file with medallion and hack dictionaries.
+--partition loads the data into monthly child tables of the trips table.
 """
         sys.exit()
 
@@ -554,6 +578,10 @@ compressed file ending with .json or .csv are ingested.
 
     # Output the results
     dptr = sys.stdout
+    partition = '--partition' in sys.argv[1:]
+    if partition:
+        dptr.write(pgpartition.partitionSql(
+            'trips', 'pickup_datetime', fileData.get('months', ())))
     dptr.write("""
 COPY trips (""")
     dptr.write(','.join(KeyList))
@@ -562,4 +590,9 @@ COPY trips (""")
     outputFiles(fileData, dptr)
     dptr.write("""\\.
 """)
+    if partition:
+        dptr.write(pgpartition.partitionIndexSql(
+            'trips', fileData.get('months', ()), PartitionIndexes))
+    dptr.write(datarollup.rollupCopySql(
+        datarollup.TripsRollup, fileData.get('rollup', {})))
     sys.stderr.write('\n%d\n' % (processed))